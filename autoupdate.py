@@ -1,9 +1,29 @@
 #!/usr/bin/env python
 import logging
 import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from psh_logging import outputError
-from psh_utility import runCommand, SOURCE_OP_TOOLS_VERSION
+from psh_cache import enforceCacheBudget, getCacheEnv
+from psh_discovery import findDependencyFiles
+from psh_git import commit, filterChangedPaths, getStatusSnapshot, stagePaths
+from psh_history import setRunDetail
+from psh_lockdiff import buildChangeReport, describeChanges
+from psh_logging import configureLogging, outputError
+from psh_plan import describePlan, planUpdates
+from psh_probe import probesEnabled, runProbe
+from psh_resources import applyLimits, describeViolation, getLimitEnv, getLimits, summarizeUsage
+from psh_schedule import BUDGET_RESERVE, describeSchedule, getTimeBudget, scheduleUpdates
+from psh_shard import ENVVAR_SHARD, getShardSpec, selectShard
+from psh_trace import getSpans, report, span
+from psh_utility import getEnvNumber, runCommand, SOURCE_OP_TOOLS_VERSION
+
+DEFAULT_MAX_WORKERS = 4
+ENVVAR_MAX_WORKERS = 'PSH_SOP_MAX_WORKERS'
+# seconds an individual updater may run before we stop it. 0 means no limit
+ENVVAR_UPDATE_TIMEOUT = 'PSH_SOP_UPDATE_TIMEOUT'
 
 
 def main():
@@ -11,15 +31,39 @@ def main():
 
     :return:
     """
+    # ecosystem groups updaters that share a tool; concurrency (optional) caps how many updaters of that ecosystem may
+    # run at the same time; probe (optional) is a cheap command that lists upgradable packages so we can skip the full
+    # update when there aren't any (exitCodes lists the exit codes that mean it worked, only 0 if not given); env
+    # (optional) holds environmental variables the updater needs; memoryEnv (optional) tells the tool its memory budget
+    # (PSH_SOP_MEMORY_LIMIT, in MB) so it fails cleanly instead of being killed; limitAddressSpace: False skips
+    # `ulimit -v` for runtimes that reserve far more address space than they use
     updaters = {
-        'composer.json': {'command': 'composer update', 'lock': 'composer.lock'},
-        'Pipfile': {'command': 'pipenv update', 'lock': 'Pipfile.lock'},
-        'poetry.lock': {'command': 'poetry update --lock', 'lock': 'poetry.lock'},
-        'Gemfile': {'command': 'bundle update --all', 'lock': 'Gemfile.lock'},
-        'go.mod': {'command': 'go get -u ./... && go mod tidy', 'lock': 'go.sum go.mod'},
-        'package-lock.json': {'command': 'npm update', 'lock': 'package-lock.json'},
+        'composer.json': {'command': 'composer update', 'lock': 'composer.lock', 'ecosystem': 'composer',
+                          'memoryEnv': {'COMPOSER_MEMORY_LIMIT': '{}M'},
+                          'probe': {'command': 'composer outdated --locked --format=json --no-interaction',
+                                    'format': 'composer'}},
+        # When running `pipenv update` the update is being run inside a virtualenv. The default is to run with user set
+        # to `true` which results in the error
+        # `Can not perform a '--user' install. User site-packages are not visible in this virtualenv`
+        # We'll need to set the config for user to false before running the update
+        'Pipfile': {'command': 'pipenv update', 'lock': 'Pipfile.lock', 'ecosystem': 'pipenv',
+                    'env': {'PIP_USER': '0'}},
+        'poetry.lock': {'command': 'poetry update --lock', 'lock': 'poetry.lock', 'ecosystem': 'poetry',
+                        'probe': {'command': 'poetry show --outdated --no-ansi', 'format': 'lines'}},
+        'Gemfile': {'command': 'bundle update --all', 'lock': 'Gemfile.lock', 'ecosystem': 'bundler',
+                    'probe': {'command': 'bundle outdated --parseable', 'format': 'lines', 'exitCodes': (0, 1)}},
+        'go.mod': {'command': 'go get -u ./... && go mod tidy', 'lock': 'go.sum go.mod', 'ecosystem': 'go',
+                   'concurrency': 1, 'memoryEnv': {'GOMEMLIMIT': '{}MiB'}, 'limitAddressSpace': False,
+                   'probe': {'command': "go list -u -m -f '{{if .Update}}{{.Path}}{{end}}' all", 'format': 'lines'}},
+        # workspaceCommand (optional) replaces command when the file is the root of a workspace we resolve as a whole
+        'package-lock.json': {'command': 'npm update', 'lock': 'package-lock.json', 'ecosystem': 'npm',
+                              'workspaceCommand': 'npm update --workspaces --include-workspace-root',
+                              'memoryEnv': {'NODE_OPTIONS': '--max-old-space-size={}'}, 'limitAddressSpace': False,
+                              'probe': {'command': 'npm outdated --all --json', 'format': 'npm',
+                                        'exitCodes': (0, 1)}},
         'yarn.lock': {'command': 'hash yarn >/dev/null 2>&1 && yarn upgrade || corepack yarn upgrade',
-                      'lock': 'yarn.lock package.json'}
+                      'lock': 'yarn.lock package.json', 'ecosystem': 'yarn',
+                      'memoryEnv': {'NODE_OPTIONS': '--max-old-space-size={}'}, 'limitAddressSpace': False}
     }
 
     appFile = '.platform.app.yaml'
@@ -27,29 +71,14 @@ def main():
     gitCommitMsg = 'Auto dependency updates via source operation'
 
     def find_dependency_files(projectPath):
-        updateFiles = []
-        for (dirpath, dirnames, filenames) in os.walk(projectPath):
-            # do we have any updater files in this directory?
-            # @todo is there a way to combine this with the platform.app.yaml check?
-            toUpdate = list(set(filenames) & set(updaters.keys()))
-
-            if appFile in filenames and 0 < len(toUpdate):
-                # dirpath is the full path to the file, and we only want the relative path. if the two are equal, we
-                # dont even need it
-                if dirpath == projectPath:
-                    dirpath = ''
-                else:
-                    # otherwise we just want the relative bit
-                    # full path location: /mnt/source/app
-                    # path to composer.json: /mnt/source/app/drupal
-                    # We only want to record `drupal`
-                    # note, to add a cross-os-compatible ending directory slash, you path.join the path with empty. :shrug:
-                    dirpath = dirpath.replace(os.path.join(projectPath, ''), '')
-
-                updateFiles += list(map(lambda file: os.path.join(dirpath, file), toUpdate))
-
-        return updateFiles
+        """
+        Finds every dependency management file that lives in the root of an app
+        :param string projectPath: full path to the project
+        :return: list: paths to the dependency management files, relative to projectPath
+        """
+        return findDependencyFiles(projectPath, updaters.keys(), appFile)
 
+    started = time.monotonic()
     logging.info("Beginning update process using version v{} of Source Ops Toolkit...".format(SOURCE_OP_TOOLS_VERSION))
     # get the path to our app. yes, it's different. in a source op container, we're in a different location
     appPath = os.getenv('PLATFORM_SOURCE_DIR', os.getcwd())
@@ -61,60 +90,174 @@ def main():
         return outputError('Gathering dependency definition file(s)',
                            "I was unable to locate any dependency definition files")
 
-    doCommit = False
+    # updaters of the same ecosystem may be capped, and two updaters in the same directory would fight over the same
+    # files (ie package.json) so they always take turns
+    ecosystemLimits = {}
+    for updater in updaters.values():
+        if updater.get('concurrency'):
+            ecosystemLimits[updater['ecosystem']] = threading.BoundedSemaphore(updater['concurrency'])
+    directoryLocks = defaultdict(threading.Lock)
 
-    for fileFull in appfiles:
-        # split the file into the actual file & relative path
-        dependencyFilePath, dependencyFile = os.path.split(fileFull)
-        # When running `pipenv update` the update is being run inside a virtualenv. The default is to run with user set
-        # to `true` which results in the error
-        # `Can not perform a '--user' install. User site-packages are not visible in this virtualenv`
-        # We'll need to set the config for user to false before running the update
-        # @see 
-        if 'Pipfile' == dependencyFile:
-            rCommand = 'export PIP_USER=0;' + updaters[dependencyFile]['command']
-        else:
-            rCommand = updaters[dependencyFile]['command']
-
-        logging.info("Found a {} file...".format(dependencyFile))
-        logging.info("Running {}".format(rCommand))
-        # run the update process
-        procUpdate = runCommand(rCommand, os.path.join(appPath, dependencyFilePath))
-
-        if not procUpdate['result']:
-            return outputError(rCommand, procUpdate['message'])
-        # now let's see if we have updates
-        logging.info("Seeing if there are any updates to commit.")
-        procStatus = runCommand('git status --porcelain=1', appPath)
-
-        if not procStatus['message']:
-            # no updates so nothing to add, not a failure, but we are done
-            logging.info("No updates available, nothing to commit. Exiting...")
+    def run_updater(invocation):
+        """
+        Runs a single planned update command
+        :param dict invocation: from planUpdates
+        :return: tuple: the command we ran and the runCommand result
+        """
+        fileFull = invocation['file']
+        dependencyFilePath = invocation['path']
+        rCommand = invocation['command']
+        updater = updaters[invocation['updater']]
+        ecosystem = updater['ecosystem']
+        # point the package manager at our persistent cache so we don't start from a cold cache every run
+        updaterEnv = dict(updater.get('env', {}))
+        updaterEnv.update(getCacheEnv(ecosystem))
+        limits = getLimits(ecosystem)
+        updaterEnv.update(getLimitEnv(updater, limits))
+
+        ecosystemLimit = ecosystemLimits.get(ecosystem)
+        with directoryLocks[dependencyFilePath]:
+            if ecosystemLimit:
+                ecosystemLimit.acquire()
+            try:
+                timeout = updateTimeout
+                # with a time budget, an update may only run until the budget is up, and only starts while it isn't
+                budgetBound = False
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if 0 >= remaining:
+                        return rCommand, {'result': True, 'message': '', 'deferred': True}
+                    budgetBound = timeout is None or remaining < timeout
+                    timeout = remaining if budgetBound else timeout
+                with span(fileFull, 'updater', command=rCommand) as updaterSpan:
+                    logging.info("Found a {} file...".format(fileFull))
+                    probe = invocation['probe']
+                    if probe and probesEnabled() and 0 == runProbe(probe, os.path.join(appPath, dependencyFilePath),
+                                                                   fileFull, updaterEnv):
+                        logging.info("Nothing to update for {}, skipping {}".format(fileFull, rCommand))
+                        updaterSpan['args']['skipped'] = True
+                        return rCommand, {'result': True, 'message': '', 'skipped': True}
+
+                    logging.info("Running {}".format(rCommand))
+                    # run the update process. Resolvers can be very chatty, so we stream their output instead of
+                    # holding all of it in memory
+                    updateRun = runCommand(applyLimits(rCommand, updater, limits),
+                                           os.path.join(appPath, dependencyFilePath), updaterEnv, stream=True,
+                                           timeout=timeout, label=fileFull)
+                    if budgetBound and updateRun.get('timedOut'):
+                        # stopped because the budget ran out, not because it failed
+                        updaterSpan['args']['deferred'] = True
+                        return rCommand, {'result': True, 'message': '', 'deferred': True}
+                    usage = updateRun.get('usage')
+                    if usage:
+                        updaterSpan['args'].update(usage)
+                        logging.info("{} used {:.1f}s user and {:.1f}s system CPU, peaking at {} MB".format(
+                            fileFull, usage['cpuUser'], usage['cpuSystem'], usage['maxRssMb']))
+                    violation = describeViolation(updateRun, limits)
+                    if violation:
+                        updaterSpan['args']['limitViolation'] = violation
+                        updateRun['message'] = '{}. {}'.format(violation, updateRun['message'])
+                    return rCommand, updateRun
+            finally:
+                if ecosystemLimit:
+                    ecosystemLimit.release()
+
+    maxWorkers = max(1, getEnvNumber(ENVVAR_MAX_WORKERS, DEFAULT_MAX_WORKERS))
+    updateTimeout = getEnvNumber(ENVVAR_UPDATE_TIMEOUT, 0, float) or None
+
+    # workspaces are resolved once from their root, and updates that depend on another one wait for it
+    waves = planUpdates(appPath, appfiles, updaters)
+    describePlan(waves, len(appfiles))
+
+    # a sharded trigger runs us once per shard, each on its own update branch
+    shardName = os.getenv(ENVVAR_SHARD)
+    if shardName:
+        waves = selectShard(waves, updaters, shardName, getShardSpec())
+        if waves is False:
+            return False
+        if not waves:
+            logging.info("Nothing to update in shard {}. Exiting...".format(shardName))
             return True
+        gitCommitMsg += ' ({})'.format(shardName)
 
-        possibleUpdates = updaters[dependencyFile]['lock'].split()
-        for updatedFile in possibleUpdates:
-            if updatedFile in procStatus['message']:
-                lockFileLocation = procAdd = None
-                lockFileLocation = os.path.join(dependencyFilePath, updatedFile)
-                logging.info("Updates are available, adding {}...".format(lockFileLocation))
-                procAdd = runCommand('git add {}'.format(lockFileLocation), appPath)
-                if not procAdd['result']:
-                    return outputError('git add', procAdd['message'])
-                else:
-                    gitCommitMsg += '\nAdded updated {}'.format(lockFileLocation)
-                    doCommit = True
-
-    if doCommit:
-        cmd = 'git commit -m "{}"'.format(gitCommitMsg)
-        procCommit = runCommand(cmd, appPath)
-
-        if not procCommit['result']:
-            return outputError('git commit', procCommit['message'])
-        else:
-            logging.info("Changes successfully committed.")
+    # with a time budget, only the updates we expect to finish in time run, the rest wait for a later run
+    deadline = None
+    budget = getTimeBudget()
+    if budget:
+        # part of the budget is kept for committing what finished
+        deadline = started + budget * (1 - BUDGET_RESERVE)
+        schedule = scheduleUpdates(waves, deadline - time.monotonic(), maxWorkers)
+        describeSchedule(schedule, budget, maxWorkers)
+        waves = schedule['waves']
+        if not waves:
+            logging.info("No update fits in what is left of the time budget. Exiting...")
             return True
+    invocations = [invocation for wave in waves for invocation in wave]
+
+    # updaters spend most of their time waiting on the network, so threads are all we need
+    updateRuns = []
+    with span('dependency updates'), ThreadPoolExecutor(max_workers=min(maxWorkers, len(invocations))) as pool:
+        for wave in waves:
+            updateRuns += list(pool.map(run_updater, wave))
+
+    enforceCacheBudget()
+    summarizeUsage(getSpans('updater'), maxWorkers)
+
+    deferredRuns = [invocation['file'] for invocation, (rCommand, procUpdate) in zip(invocations, updateRuns)
+                    if procUpdate.get('deferred')]
+    if deferredRuns:
+        logging.warning("The time budget ran out before {} update(s) finished, they wait for a later run: {}".format(
+            len(deferredRuns), ', '.join(deferredRuns)))
+        # whatever they managed to change is incomplete, so only the updates that finished are committed
+        invocations = [invocation for invocation in invocations if invocation['file'] not in deferredRuns]
+
+    skippedRuns = [procUpdate for rCommand, procUpdate in updateRuns if procUpdate.get('skipped')]
+    if skippedRuns:
+        logging.info("Outdated probes let us skip {} of {} update(s).".format(len(skippedRuns), len(updateRuns)))
+
+    failedRuns = [(rCommand, procUpdate) for rCommand, procUpdate in updateRuns if not procUpdate['result']]
+    for rCommand, procUpdate in failedRuns:
+        outputError(rCommand, procUpdate['message'])
+    if failedRuns:
+        return False
+
+    # git doesn't like being run concurrently in the same repository, so everything from here on happens one at a time
+    # now let's see if we have updates. One snapshot covers every updater
+    logging.info("Seeing if there are any updates to commit.")
+    changedPaths = getStatusSnapshot(appPath)
+    if changedPaths is None:
+        return False
+
+    lockFiles = []
+    for invocation in invocations:
+        updatedFiles = filterChangedPaths(changedPaths, invocation['locks'])
+        if not updatedFiles:
+            logging.info("No updates available for {}.".format(invocation['file']))
+        for lockFileLocation in updatedFiles:
+            # two updaters in the same directory can share a file (ie package.json)
+            if lockFileLocation not in lockFiles:
+                logging.info("Updates are available, adding {}...".format(lockFileLocation))
+                lockFiles.append(lockFileLocation)
+
+    setRunDetail('changedLockFiles', len(lockFiles))
+    if not lockFiles:
+        # no updates so nothing to add, not a failure, but we are done
+        logging.info("No updates available, nothing to commit. Exiting...")
+        return True
+
+    if not stagePaths(appPath, lockFiles):
+        return False
+
+    # list what changed in each lock file, when we know how to read it
+    changeReport = buildChangeReport(appPath, lockFiles)
+    for lockFileLocation in lockFiles:
+        gitCommitMsg += '\nAdded updated {}'.format(lockFileLocation)
+        if changeReport.get(lockFileLocation):
+            gitCommitMsg += ''.join('\n' + line for line in describeChanges(changeReport[lockFileLocation]))
+    return commit(appPath, gitCommitMsg)
 
 
 if __name__ == '__main__':
+    configureLogging()
     main()
+    report('sop-autoupdate')
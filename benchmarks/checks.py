@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Checks the parts of the toolkit whose results are easy to get subtly wrong without any run failing: the order and
+estimates the time budget schedules updates with, and the lock file parsers the change report is built from.
+
+    python3 benchmarks/checks.py
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from contextlib import closing
+from unittest import mock
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLKIT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, TOOLKIT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import psh_history  # noqa: E402
+import psh_lockdiff  # noqa: E402
+from psh_schedule import DEFAULT_UPDATE_ESTIMATE, scheduleUpdates  # noqa: E402
+from synthetic import INITIAL_VERSION, renderLockFile  # noqa: E402
+
+COMMAND = 'sop-autoupdate'
+
+
+def recordHistory(runs):
+    """
+    Writes synthetic runs straight into the history
+    :param list runs: one {started: time.time(), updaters: {file: (duration, exit code, skipped)}} per run
+    :return: void
+    """
+    with closing(psh_history.connect()) as connection, connection:
+        for run in runs:
+            cursor = connection.execute(
+                'INSERT INTO runs (command, started, duration, result, version, changed_lock_files) '
+                'VALUES (?, ?, ?, 1, ?, 0)', (COMMAND, run['started'], 1.0, 'checks'))
+            connection.executemany(
+                'INSERT INTO phases (run_id, name, category, duration, exit_code, skipped) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(cursor.lastrowid, name, 'updater', duration, exitCode, int(skipped))
+                 for name, (duration, exitCode, skipped) in run['updaters'].items()])
+
+
+def scheduledFiles(schedule):
+    return [invocation['file'] for wave in schedule['waves'] for invocation in wave]
+
+
+class ScheduleChecks(unittest.TestCase):
+    def setUp(self):
+        cacheDir = tempfile.mkdtemp(prefix='sop-checks-')
+        self.addCleanup(shutil.rmtree, cacheDir, True)
+        environment = mock.patch.dict(os.environ, {'PLATFORM_CACHE_DIR': cacheDir, 'PSH_SOP_HISTORY': '1'})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.waves = [[{'file': 'a/composer.json'}, {'file': 'b/package.json'}, {'file': 'c/Gemfile'}]]
+
+    def testWithoutHistoryOnlyTheFirstInLineIsGuessedAt(self):
+        schedule = scheduleUpdates(self.waves, 30, 1, COMMAND)
+        # nothing to go on, so the first in line runs to find out how long it takes, even if the guess doesn't fit
+        self.assertEqual(['a/composer.json'], scheduledFiles(schedule))
+        self.assertEqual(['b/package.json', 'c/Gemfile'], [invocation['file'] for invocation in schedule['deferred']])
+        self.assertEqual([], schedule['unschedulable'])
+        self.assertEqual({DEFAULT_UPDATE_ESTIMATE}, set(schedule['estimates'].values()))
+
+    def testLeastRecentlyCompletedGoFirst(self):
+        recordHistory([
+            {'started': 100.0, 'updaters': {'a/composer.json': (10.0, 0, False), 'b/package.json': (20.0, 0, False)}},
+            {'started': 200.0, 'updaters': {'a/composer.json': (10.0, 0, False)}},
+        ])
+        schedule = scheduleUpdates(self.waves, 40, 1, COMMAND)
+        # c never completed and gets the median of the others, b completed before a
+        self.assertEqual({'a/composer.json': 10.0, 'b/package.json': 20.0, 'c/Gemfile': 15.0}, schedule['estimates'])
+        self.assertEqual({'a/composer.json': 200.0, 'b/package.json': 100.0, 'c/Gemfile': None},
+                         schedule['lastCompleted'])
+        self.assertEqual(['b/package.json', 'c/Gemfile'], scheduledFiles(schedule))
+        self.assertEqual(['a/composer.json'], [invocation['file'] for invocation in schedule['deferred']])
+
+    def testDeferredUpdatesMoveUp(self):
+        recordHistory([{'started': 100.0, 'updaters': {'a/composer.json': (30.0, 0, False),
+                                                       'b/package.json': (30.0, 0, False),
+                                                       'c/Gemfile': (30.0, 0, False)}}])
+        order = []
+        for started in (200.0, 300.0, 400.0):
+            files = scheduledFiles(scheduleUpdates(self.waves, 40, 1, COMMAND))
+            order.append(files)
+            recordHistory([{'started': started, 'updaters': {name: (30.0, 0, False) for name in files}}])
+        self.assertEqual([['a/composer.json'], ['b/package.json'], ['c/Gemfile']], order)
+
+    def testStoppedAndSkippedRuns(self):
+        recordHistory([
+            {'started': 100.0, 'updaters': {'a/composer.json': (10.0, 0, False), 'b/package.json': (40.0, 0, False)}},
+            {'started': 200.0, 'updaters': {'a/composer.json': (50.0, -9, False), 'b/package.json': (1.0, 0, True)}},
+        ])
+        schedule = scheduleUpdates(self.waves, 1000, 4, COMMAND)
+        # a was stopped after longer than it ever took, b's probe found nothing to do, which took it no time at all
+        self.assertEqual(50.0, schedule['estimates']['a/composer.json'])
+        self.assertEqual(40.0, schedule['estimates']['b/package.json'])
+        # a stopped run didn't complete, a skipped one did
+        self.assertEqual(100.0, schedule['lastCompleted']['a/composer.json'])
+        self.assertEqual(200.0, schedule['lastCompleted']['b/package.json'])
+
+    def testUpdatesLongerThanTheBudgetAreUnschedulable(self):
+        recordHistory([{'started': 100.0, 'updaters': {'a/composer.json': (120.0, 0, False),
+                                                       'b/package.json': (20.0, 0, False)}}])
+        schedule = scheduleUpdates(self.waves, 60, 1, COMMAND)
+        self.assertEqual(['a/composer.json'], [invocation['file'] for invocation in schedule['unschedulable']])
+        # c never ran, so it's first in line, and runs although it's guessed at the median of the others (70s). That
+        # leaves no room for b this time
+        self.assertEqual(70.0, schedule['estimates']['c/Gemfile'])
+        self.assertEqual(['c/Gemfile'], scheduledFiles(schedule))
+        self.assertEqual(['b/package.json'], [invocation['file'] for invocation in schedule['deferred']])
+
+
+class LockDiffChecks(unittest.TestCase):
+    def parse(self, fileName, content):
+        return psh_lockdiff.LOCK_PARSERS[fileName](io.StringIO(content))
+
+    def testEverySyntheticLockFile(self):
+        packages = {'composer.lock': 'psr/log', 'package-lock.json': 'left-pad', 'Pipfile.lock': 'requests',
+                    'yarn.lock': 'left-pad', 'poetry.lock': 'requests', 'Gemfile.lock': 'rack',
+                    'go.sum': 'example.com/dep'}
+        self.assertEqual(set(psh_lockdiff.LOCK_PARSERS), set(packages))
+        for fileName, package in packages.items():
+            version = 'v{}'.format(INITIAL_VERSION) if 'go.sum' == fileName else INITIAL_VERSION
+            self.assertEqual({package: version}, self.parse(fileName, renderLockFile(fileName, INITIAL_VERSION)),
+                             fileName)
+
+    def testJsonTokensSplitAcrossChunks(self):
+        content = '{"packages": [{"name": "vendor/\\"quoted\\"", "version": "1.2.3"}, ' \
+                  '{"version": "2.0.0", "name": "other/pkg", "extra": [1, true, null, {"deep": -1.5e3}]}], ' \
+                  '"packages-dev": [{"name": "dev/pkg", "version": "dev-main"}]}'
+        expected = {'vendor/"quoted"': '1.2.3', 'other/pkg': '2.0.0', 'dev/pkg': 'dev-main'}
+        for chunkSize in (1, 2, 3, 7, 64):
+            with mock.patch.object(psh_lockdiff, 'READ_CHUNK_SIZE', chunkSize):
+                self.assertEqual(expected, self.parse('composer.lock', content), chunkSize)
+
+    def testNestedNpmLock(self):
+        content = '{"lockfileVersion": 1, "dependencies": {"a": {"version": "1.0.0", "dependencies": ' \
+                  '{"b": {"version": "2.0.0"}}}, "c": {"version": "3.0.0"}}}'
+        self.assertEqual({'a': '1.0.0', 'a/node_modules/b': '2.0.0', 'c': '3.0.0'},
+                         self.parse('package-lock.json', content))
+
+    def testYarnBerryAndGoSum(self):
+        yarn = '__metadata:\n  version: 6\n\n"@scope/pkg@npm:^1.0.0, @scope/pkg@npm:^1.1.0":\n  version: 1.2.0\n'
+        self.assertEqual({'@scope/pkg': '1.2.0'}, self.parse('yarn.lock', yarn))
+        goSum = 'example.com/a v1.0.0 h1:x=\nexample.com/a v1.1.0 h1:y=\nexample.com/a v1.1.0/go.mod h1:z=\n'
+        self.assertEqual({'example.com/a': 'v1.0.0, v1.1.0'}, self.parse('go.sum', goSum))
+
+    def testDiffVersions(self):
+        self.assertEqual({'added': {'new': '1.0'}, 'removed': {'old': '1.0'}, 'updated': {'kept': ['1.0', '2.0']}},
+                         psh_lockdiff.diffVersions({'old': '1.0', 'kept': '1.0', 'same': '1.0'},
+                                                   {'new': '1.0', 'kept': '2.0', 'same': '1.0'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
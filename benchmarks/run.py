@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Times the toolkit end to end against a synthetic project, with stubs standing in for the platform cli and every package
+manager, so it runs offline and the results only depend on our own code and the configured stub latency.
+
+    python3 benchmarks/run.py --apps 50 --depth 4 --latency 0.05 --output results.json
+
+Results are written as json (see RESULTS_SCHEMA) and summarized as a table.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLKIT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, TOOLKIT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import generateRepository  # noqa: E402
+
+# bump whenever the structure of the results changes so whatever reads them can tell
+RESULTS_SCHEMA = 1
+SCENARIOS = ['discovery', 'discovery-indexed', 'autoupdate', 'trigger', 'trigger-native']
+# every tool the toolkit runs, all of them answered by stub.py
+STUBBED_TOOLS = ['platform', 'git', 'composer', 'npm', 'yarn', 'corepack', 'pipenv', 'poetry', 'bundle', 'go']
+# the dependency management files autoupdate looks for
+MANIFESTS = ['composer.json', 'Pipfile', 'poetry.lock', 'Gemfile', 'go.mod', 'package-lock.json', 'yarn.lock']
+APP_FILE = '.platform.app.yaml'
+
+
+def installStubs(binDir):
+    """
+    Writes a wrapper for every stubbed tool, each handing its call to stub.py
+    :param string binDir: directory to put them in, which then goes first in PATH
+    :return: void
+    """
+    os.makedirs(binDir)
+    for tool in STUBBED_TOOLS:
+        wrapperPath = os.path.join(binDir, tool)
+        with open(wrapperPath, 'w') as wrapper:
+            wrapper.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable,
+                                                                     os.path.join(BENCH_DIR, 'stub.py'), tool))
+        os.chmod(wrapperPath, 0o755)
+
+
+def resetStubs(workDir):
+    """
+    Gives the platform stub a fresh project and forgets the calls made so far
+    :param string workDir: benchmark working directory
+    :return: void
+    """
+    from stub import FAKE_PROJECT
+    with open(os.environ['BENCH_STUB_STATE'], 'w') as stateFile:
+        json.dump(FAKE_PROJECT, stateFile)
+    open(os.environ['BENCH_STUB_LOG'], 'w').close()
+
+
+def countStubCalls():
+    """
+    :return: dict: how many times each stubbed tool was called since the last resetStubs()
+    """
+    calls = {}
+    with open(os.environ['BENCH_STUB_LOG']) as logFile:
+        for line in logFile:
+            tool = line.split(' ', 1)[0]
+            calls[tool] = calls.get(tool, 0) + 1
+    return calls
+
+
+def getScenarios(repoPath):
+    """
+    :param string repoPath: the synthetic project
+    :return: dict: scenario name => (function to time, whether to run it once untimed first)
+    """
+    from autoupdate import main as autoupdateMain
+    from cron_trigger_autoupdate import trigger_autoupdate
+    from psh_discovery import findDependencyFiles
+    from psh_checkpoint import CHECKPOINT_SUBDIR
+    from psh_metadata import invalidateMetadata
+    from psh_utility import getCacheDir
+
+    def runTrigger():
+        # every run starts from a cold metadata cache and without a checkpoint to resume from (left by a failed run) so
+        # runs are comparable. --force since the fake production never moves
+        invalidateMetadata()
+        shutil.rmtree(getCacheDir(CHECKPOINT_SUBDIR), ignore_errors=True)
+        return trigger_autoupdate({'force': True})
+
+    def runTriggerNative():
+        # the same run, with the native API client talking to the API stub instead of going through the cli
+        from stub import serveApi
+        import psh_api
+        server, apiUrl = serveApi()
+        environment = {psh_api.ENVVAR_API_CLIENT: 'native', psh_api.ENVVAR_API_URL: apiUrl,
+                       psh_api.ENVVAR_AUTH_URL: apiUrl}
+        previous = {name: os.environ.get(name) for name in environment}
+        os.environ.update(environment)
+        # every run gets a new client, so it exchanges the token (and opens its connections) the way a cron run would
+        psh_api.clients.clear()
+        try:
+            return runTrigger()
+        finally:
+            server.shutdown()
+            server.server_close()
+            psh_api.clients.clear()
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    return {
+        'discovery': (lambda: findDependencyFiles(repoPath, MANIFESTS, APP_FILE, useIndex=False), False),
+        # warmed up so the index exists, the way it would after the first cron run
+        'discovery-indexed': (lambda: findDependencyFiles(repoPath, MANIFESTS, APP_FILE, useIndex=True), True),
+        'autoupdate': (autoupdateMain, False),
+        'trigger': (runTrigger, False),
+        'trigger-native': (runTriggerNative, False),
+    }
+
+
+def runScenario(name, func, warmUp, repeat, workDir):
+    """
+    Runs a scenario repeat times and records how long each run, and each phase within it, took
+    :param string name: scenario name
+    :param function func: what to time
+    :param bool warmUp: whether to run it once untimed first
+    :param int repeat: how many timed runs
+    :param string workDir: benchmark working directory
+    :return: dict: the scenario's results
+    """
+    import psh_trace
+    if warmUp:
+        resetStubs(workDir)
+        func()
+
+    runs = []
+    for attempt in range(repeat):
+        resetStubs(workDir)
+        psh_trace.reset()
+        started = time.perf_counter()
+        outcome = func()
+        seconds = time.perf_counter() - started
+
+        phases = {}
+        for record in psh_trace.getSpans():
+            if record['cat'] in ('phase', 'updater'):
+                phases[record['name']] = phases.get(record['name'], 0) + record['duration']
+        runs.append({'seconds': round(seconds, 6), 'result': outcome is not False,
+                     'phases': {phase: round(duration, 6) for phase, duration in phases.items()},
+                     'commands': len(psh_trace.getSpans('command')), 'requests': len(psh_trace.getSpans('request')),
+                     'stubCalls': countStubCalls()})
+        logging.warning("{} run {}/{}: {:.3f}s".format(name, attempt + 1, repeat, seconds))
+
+    durations = [run['seconds'] for run in runs]
+    phaseNames = sorted(set(phase for run in runs for phase in run['phases']))
+    return {
+        'runs': runs,
+        'median': round(statistics.median(durations), 6),
+        'min': min(durations),
+        'max': max(durations),
+        'failures': len([run for run in runs if not run['result']]),
+        'phases': {phase: round(statistics.median([run['phases'].get(phase, 0) for run in runs]), 6)
+                   for phase in phaseNames},
+    }
+
+
+def printSummary(results):
+    rowFormat = "{:<20} {:>10} {:>10} {:>10} {:>9}"
+    print(rowFormat.format('Scenario', 'Median', 'Min', 'Max', 'Failures'))
+    for name, scenario in results['scenarios'].items():
+        print(rowFormat.format(name, '{:.3f}'.format(scenario['median']), '{:.3f}'.format(scenario['min']),
+                               '{:.3f}'.format(scenario['max']), scenario['failures']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--apps', type=int, default=20, help='apps in the synthetic project')
+    parser.add_argument('--depth', type=int, default=3, help='depth of each installed dependency tree')
+    parser.add_argument('--width', type=int, default=4, help='packages per level of each installed dependency tree')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic project layout')
+    parser.add_argument('--latency', type=float, default=0, help='seconds every stubbed call takes')
+    parser.add_argument('--fail', default='', help='stubbed tools (or tool:subcommand) that fail, comma separated')
+    parser.add_argument('--fail-rate', type=float, default=0, help='chance of any stubbed call failing')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='scenarios to run, comma separated')
+    parser.add_argument('--output', help='where to write the json results')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--verbose', action='store_true', help="show the toolkit's own logging")
+    arguments = parser.parse_args()
+
+    scenarioNames = [name.strip() for name in arguments.scenarios.split(',') if name.strip()]
+    unknown = set(scenarioNames) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario(s): {}'.format(', '.join(sorted(unknown))))
+
+    workDir = tempfile.mkdtemp(prefix='sop-bench-')
+    repoPath = os.path.join(workDir, 'project')
+    config = {'apps': arguments.apps, 'depth': arguments.depth, 'width': arguments.width, 'seed': arguments.seed,
+              'latency': arguments.latency, 'fail': arguments.fail, 'failRate': arguments.fail_rate,
+              'repeat': arguments.repeat}
+    try:
+        # generated with the real git, before the stubs are on PATH
+        generated = generateRepository(repoPath, arguments.apps, arguments.depth, arguments.width, seed=arguments.seed)
+        realGit = shutil.which('git')
+        installStubs(os.path.join(workDir, 'bin'))
+        os.environ.update({
+            'PATH': os.pathsep.join((os.path.join(workDir, 'bin'), os.environ.get('PATH', ''))),
+            'BENCH_REAL_GIT': realGit,
+            'BENCH_STUB_LATENCY': str(arguments.latency),
+            'BENCH_STUB_FAIL': arguments.fail,
+            'BENCH_STUB_FAIL_RATE': str(arguments.fail_rate),
+            'BENCH_STUB_STATE': os.path.join(workDir, 'stub-state.json'),
+            'BENCH_STUB_LOG': os.path.join(workDir, 'stub-calls.log'),
+            'PLATFORM_CACHE_DIR': os.path.join(workDir, 'cache'),
+            'PLATFORM_SOURCE_DIR': repoPath,
+            'PLATFORMSH_CLI_TOKEN': 'benchmark',
+            'PSH_SOP_PROJECT': 'benchmark',
+            'PSH_SOP_TRACE_FILE': os.path.join(workDir, 'trace.json'),
+            'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+            'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@example.com',
+        })
+
+        # the toolkit's own logging is quiet unless asked for
+        from psh_logging import configureLogging
+        from psh_utility import runCommand, SOURCE_OP_TOOLS_VERSION
+        configureLogging('DEBUG' if arguments.verbose else 'WARNING')
+
+        revisionRun = runCommand('git rev-parse --short HEAD', TOOLKIT_DIR)
+        results = {
+            'schema': RESULTS_SCHEMA,
+            'toolkit': {'version': SOURCE_OP_TOOLS_VERSION,
+                        'revision': revisionRun['message'].strip() if revisionRun['result'] else None},
+            'python': platform.python_version(),
+            'config': config,
+            'project': generated,
+            'scenarios': {},
+        }
+        scenarios = getScenarios(repoPath)
+        for name in scenarioNames:
+            func, warmUp = scenarios[name]
+            results['scenarios'][name] = runScenario(name, func, warmUp, arguments.repeat, workDir)
+    finally:
+        if arguments.keep:
+            print("Working directory kept at {}".format(workDir))
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2, sort_keys=True)
+            outputFile.write('\n')
+    printSummary(results)
+    return 0 == sum(scenario['failures'] for scenario in results['scenarios'].values())
+
+
+if __name__ == '__main__':
+    sys.exit(int(not main()))
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Stands in for the platform cli, git and every package manager the toolkit runs, so it can be benchmarked offline.
+Installed by run.py as a set of wrappers on PATH, each calling this script with the name of the tool it replaces.
+serveApi() answers the same fake project over HTTP, for the native API client.
+
+Environmental variables:
+* BENCH_STUB_LATENCY - seconds every call takes (default 0)
+* BENCH_STUB_FAIL - comma separated tools (ie `composer`, or `api` for the API stub) or tool:subcommand pairs (ie
+  `platform:sync`) that fail
+* BENCH_STUB_FAIL_RATE - chance (0 to 1) of any call failing
+* BENCH_STUB_OUTDATED - set to 0 to have the outdated probes report nothing to update
+* BENCH_STUB_STATE - json file holding the fake project the platform stub works with
+* BENCH_STUB_LOG - file every call is appended to
+* BENCH_REAL_GIT - the git executable the git stub passes its calls on to
+"""
+import fcntl
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_PROJECT = {
+    'environments': {
+        'main': {'name': 'main', 'type': 'production', 'status': 'active', 'parent': None, 'head_commit': 'a' * 40},
+        'update': {'name': 'update', 'type': 'development', 'status': 'inactive', 'parent': 'main',
+                   'head_commit': 'b' * 40},
+    },
+    'integrations': {'integration1': {'id': 'integration1', 'type': 'github', 'prune_branches': True}},
+    'activities': {},
+}
+# the access token the API stub hands out, and then expects on every request
+STUB_ACCESS_TOKEN = 'stub-access-token'
+
+
+def loadState():
+    try:
+        with open(os.environ['BENCH_STUB_STATE']) as stateFile:
+            return json.load(stateFile)
+    except (KeyError, OSError, ValueError):
+        return json.loads(json.dumps(FAKE_PROJECT))
+
+
+def saveState(state):
+    if 'BENCH_STUB_STATE' in os.environ:
+        with open(os.environ['BENCH_STUB_STATE'], 'w') as stateFile:
+            json.dump(state, stateFile)
+
+
+def lockState():
+    """
+    Calls can come from several update branches (and the API stub) at once, each reading and writing the whole project
+    :return: file: hold on to it (ie `with lockState():`) for as long as the project is being worked with
+    """
+    lockFile = open(os.environ['BENCH_STUB_STATE'] + '.lock', 'a')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    return lockFile
+
+
+def logCall(tool, arguments):
+    if os.getenv('BENCH_STUB_LOG'):
+        with open(os.environ['BENCH_STUB_LOG'], 'a') as logFile:
+            # one line per call, even when an argument spans several (ie a commit message)
+            logFile.write('{} {}\n'.format(tool, ' '.join(arguments).replace('\n', ' ')))
+
+
+def shouldFail(tool, arguments):
+    failures = [failure.strip() for failure in os.getenv('BENCH_STUB_FAIL', '').split(',') if failure.strip()]
+    subcommand = '{}:{}'.format(tool, arguments[0] if arguments else '')
+    if tool in failures or subcommand in failures:
+        return True
+    return random.random() < float(os.getenv('BENCH_STUB_FAIL_RATE', '0') or 0)
+
+
+def runActivity(state, environment, action, data=None, finished=True):
+    """
+    Applies an environment action to the fake project and records an activity for it. One that isn't finished yet
+    finishes the next time it's looked at, so whatever tracks it has to poll at least once
+    :return: dict: the activity
+    """
+    environments = state['environments']
+    if 'activate' == action:
+        environments[environment]['status'] = 'active'
+    elif 'deactivate' == action:
+        environments[environment]['status'] = 'inactive'
+    elif 'synchronize' == action:
+        environments[environment]['head_commit'] = environments[environments[environment]['parent']]['head_commit']
+    elif 'branch' == action:
+        environments[data['name']] = {'name': data['name'], 'type': 'development', 'status': 'active',
+                                      'parent': environment, 'head_commit': environments[environment]['head_commit']}
+    activityID = str(len(state['activities']) + 1)
+    activity = {'id': activityID, 'type': action, 'state': 'complete', 'result': 'success',
+                'log': '{} {}\n'.format(action, environment)}
+    if not finished:
+        activity.update(state='in_progress', result=None, log='{} {} started\n'.format(action, environment))
+    state['activities'][activityID] = activity
+    return activity
+
+
+def projectCurl(state, arguments):
+    """
+    `platform project:curl`, answering the handful of API paths the toolkit uses
+    """
+    method, path, data = 'GET', '', None
+    remaining = list(arguments)
+    while remaining:
+        argument = remaining.pop(0)
+        if argument in ('-X', '--request'):
+            method = remaining.pop(0)
+        elif argument in ('-d', '--data'):
+            data = json.loads(remaining.pop(0))
+        elif argument in ('-H', '--header', '-p', '--project'):
+            remaining.pop(0)
+        elif not argument.startswith('-'):
+            path = argument
+    return answerApi(state, method, [part for part in path.split('/') if part], data)
+
+
+def answerApi(state, method, parts, data=None):
+    """
+    Answers the handful of API paths (relative to the project) the toolkit uses
+    :param dict state: the fake project, updated for us
+    :param string method: HTTP method
+    :param list parts: the path, split on /
+    :param dict data: decoded json body
+    :return: the response, raises KeyError for anything we don't know
+    """
+    if ['environments'] == parts:
+        return list(state['environments'].values())
+    if 2 == len(parts) and 'environments' == parts[0]:
+        return state['environments'][parts[1]]
+    if 3 == len(parts) and 'environments' == parts[0] and 'POST' == method:
+        if parts[1] not in state['environments']:
+            raise KeyError(parts[1])
+        return {'_embedded': {'activities': [runActivity(state, parts[1], parts[2], data, finished=False)]}}
+    if ['integrations'] == parts:
+        return list(state['integrations'].values())
+    if 2 == len(parts) and 'integrations' == parts[0]:
+        integration = state['integrations'][parts[1]]
+        if 'PATCH' == method:
+            integration.update(data or {})
+        return integration
+    if 2 <= len(parts) and 'activities' == parts[0]:
+        activity = state['activities'][parts[1]]
+        if 3 == len(parts) and 'cancel' == parts[2]:
+            activity.update(state='cancelled', result='failure')
+        elif 'in_progress' == activity['state']:
+            activity.update(state='complete', result='success', log=activity['log'] + 'done\n')
+        return activity
+    raise KeyError('/'.join(parts))
+
+
+def platform(arguments):
+    """
+    The platform cli, with a fake project behind it
+    """
+    state = loadState()
+    # every command may target a project, which doesn't matter to us
+    if '-p' in arguments:
+        index = arguments.index('-p')
+        arguments = arguments[:index] + arguments[index + 2:]
+    command = arguments[0] if arguments else ''
+    positional = [argument for argument in arguments[1:] if not argument.startswith('-')]
+
+    if command in ('auth:info', '--version'):
+        pass
+    elif 'project:curl' == command:
+        try:
+            print(json.dumps(projectCurl(state, arguments[1:])))
+        except KeyError:
+            return 22
+    elif 'integration:list' == command:
+        for integration in state['integrations'].values():
+            print('{},{}'.format(integration['id'], integration['type']))
+    elif 'integration:get' == command:
+        print(str(state['integrations'][positional[0]]['prune_branches']).lower())
+    elif 'integration:update' == command:
+        state['integrations'][positional[0]]['prune_branches'] = '--prune-branches=true' in arguments
+    elif command in ('environment:activate', 'e:activate'):
+        runActivity(state, positional[0], 'activate')
+    elif command in ('environment:branch', 'e:branch'):
+        runActivity(state, positional[1], 'branch', {'name': positional[0]})
+    elif 'sync' == command:
+        runActivity(state, arguments[arguments.index('-e') + 1], 'synchronize')
+    elif command in ('environment:delete', 'e:delete'):
+        runActivity(state, positional[0], 'deactivate')
+    elif 'source-operation:run' == command:
+        variables = [argument.split('=', 1)[1] for argument in arguments if argument.startswith('--variable=')]
+        print('Running source operation {}{}'.format(positional[0], ' with {}'.format(', '.join(variables))
+                                                     if variables else ''))
+    else:
+        print('Unknown command {}'.format(command), file=sys.stderr)
+        return 1
+
+    saveState(state)
+    return 0
+
+
+def bumpLockFile(fileName):
+    """
+    Rewrites a lock file in its real format with the patch version of its package bumped, so whatever reads it sees a
+    proper update
+    """
+    from synthetic import INITIAL_VERSION, renderLockFile
+    try:
+        with open(fileName) as lockFile:
+            versions = re.findall(r'(\d+)\.(\d+)\.(\d+)', lockFile.read())
+    except OSError:
+        versions = []
+    # the package's own version comes last in every format (ie after the range it was resolved from)
+    major, minor, patch = versions[-1] if versions else INITIAL_VERSION.split('.')
+    with open(fileName, 'w') as lockFile:
+        lockFile.write(renderLockFile(fileName, '{}.{}.{}'.format(major, minor, int(patch) + 1)))
+
+
+def packageManager(tool, arguments):
+    """
+    Any of the package managers: outdated checks report an update, updates bump the version in the lock file
+    """
+    outdated = '0' != os.getenv('BENCH_STUB_OUTDATED', '1')
+    if 'outdated' in arguments or '--outdated' in arguments or ('list' in arguments and '-u' in arguments):
+        if not outdated:
+            print('{"locked": []}' if 'composer' == tool else '{}' if 'npm' == tool else '')
+        elif 'composer' == tool:
+            print('{"locked": [{"name": "psr/log"}]}')
+        elif 'npm' == tool:
+            print('{"left-pad": {}}')
+        else:
+            print('example/package')
+        # like the real tools, npm and bundler exit 1 when something is outdated
+        return 1 if tool in ('npm', 'bundle') else 0
+
+    lockFiles = {'composer': 'composer.lock', 'npm': 'package-lock.json', 'yarn': 'yarn.lock', 'corepack': 'yarn.lock',
+                 'pipenv': 'Pipfile.lock', 'poetry': 'poetry.lock', 'bundle': 'Gemfile.lock', 'go': 'go.sum'}
+    if tool in lockFiles and arguments and arguments[0] in ('update', 'upgrade', 'get', 'yarn'):
+        bumpLockFile(lockFiles[tool])
+    return 0
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    """
+    The Platform.sh API (and its OAuth token endpoint), with the fake project behind it
+    """
+    # keep-alive, so the native client's connection pool gets used
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_PATCH(self):
+        self.answer('PATCH')
+
+    def answer(self, method):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        logCall('api', [method, path])
+        time.sleep(float(os.getenv('BENCH_STUB_LATENCY', '0') or 0))
+        if shouldFail('api', [path]):
+            return self.sendJson(500, {'message': 'api failed (injected by BENCH_STUB_FAIL)'})
+
+        if '/oauth2/token' == path:
+            if not parse_qs(body.decode('utf-8')).get('api_token'):
+                return self.sendJson(400, {'error': 'invalid_request'})
+            return self.sendJson(200, {'access_token': STUB_ACCESS_TOKEN, 'expires_in': 900, 'token_type': 'bearer'})
+        if 'Bearer {}'.format(STUB_ACCESS_TOKEN) != self.headers.get('Authorization'):
+            return self.sendJson(401, {'message': 'Invalid access token'})
+
+        # every project is the same fake project
+        parts = [part for part in path.split('/') if part]
+        if 2 > len(parts) or 'projects' != parts[0]:
+            return self.sendJson(404, {'message': 'Not found'})
+        try:
+            with lockState():
+                state = loadState()
+                response = answerApi(state, method, parts[2:], json.loads(body) if body else None)
+                saveState(state)
+        except (KeyError, ValueError):
+            return self.sendJson(404, {'message': 'Not found'})
+        self.sendJson(200, response)
+
+    def sendJson(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serveApi(port=0):
+    """
+    Starts answering the API (and its token exchange) in a background thread. Point the native client at it with
+    PSH_SOP_API_URL and PSH_SOP_AUTH_URL
+    :param int port: port to listen on, 0 for any free one
+    :return: tuple: the server (shutdown() when done) and its url
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def main():
+    tool, arguments = sys.argv[1], sys.argv[2:]
+    logCall(tool, arguments)
+
+    time.sleep(float(os.getenv('BENCH_STUB_LATENCY', '0') or 0))
+    if shouldFail(tool, arguments):
+        print('{} failed (injected by BENCH_STUB_FAIL)'.format(tool), file=sys.stderr)
+        return 1
+
+    if 'git' == tool:
+        os.execv(os.environ['BENCH_REAL_GIT'], ['git'] + arguments)
+    if 'platform' == tool:
+        if 'BENCH_STUB_STATE' not in os.environ:
+            return platform(arguments)
+        with lockState():
+            return platform(arguments)
+    return packageManager(tool, arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
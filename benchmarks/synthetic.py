@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import json
+import os
+import random
+import subprocess
+
+APP_FILE = '.platform.app.yaml'
+# version every synthetic lock file starts out with
+INITIAL_VERSION = '1.0.0'
+
+
+def renderLockFile(fileName, version):
+    """
+    A lock file in the real format, locking a single package at the given version
+    :param string fileName: name of the lock file
+    :param string version: version of the package
+    :return: string: the lock file's content
+    """
+    if 'composer.lock' == fileName:
+        return json.dumps({'packages': [{'name': 'psr/log', 'version': version}], 'packages-dev': []}, indent=4) + '\n'
+    if 'package-lock.json' == fileName:
+        return json.dumps({'lockfileVersion': 2, 'packages': {'': {'dependencies': {'left-pad': '^1.0.0'}},
+                                                              'node_modules/left-pad': {'version': version}}},
+                          indent=2) + '\n'
+    if 'Pipfile.lock' == fileName:
+        return json.dumps({'default': {'requests': {'version': '=={}'.format(version)}}, 'develop': {}},
+                          indent=4) + '\n'
+    if 'yarn.lock' == fileName:
+        return '# yarn lockfile v1\n\n\nleft-pad@^1.0.0:\n  version "{}"\n'.format(version)
+    if 'poetry.lock' == fileName:
+        return '[[package]]\nname = "requests"\nversion = "{}"\n'.format(version)
+    if 'Gemfile.lock' == fileName:
+        return 'GEM\n  remote: https://rubygems.org/\n  specs:\n    rack ({})\n'.format(version)
+    if 'go.sum' == fileName:
+        return 'example.com/dep v{0} h1:stub=\nexample.com/dep v{0}/go.mod h1:stub=\n'.format(version)
+    raise KeyError(fileName)
+
+
+# the files each kind of app gets, in the order apps are assigned to them
+APP_KINDS = [
+    {'composer.json': '{"require": {"psr/log": "^1.0"}}\n',
+     'composer.lock': renderLockFile('composer.lock', INITIAL_VERSION)},
+    {'package.json': '{"dependencies": {"left-pad": "^1.0.0"}}\n',
+     'yarn.lock': renderLockFile('yarn.lock', INITIAL_VERSION)},
+    {'go.mod': 'module example.com/app\n\ngo 1.20\n', 'go.sum': renderLockFile('go.sum', INITIAL_VERSION)},
+    {'Pipfile': '[packages]\nrequests = "*"\n', 'Pipfile.lock': renderLockFile('Pipfile.lock', INITIAL_VERSION)},
+    {'pyproject.toml': '[tool.poetry]\nname = "app"\n', 'poetry.lock': renderLockFile('poetry.lock', INITIAL_VERSION)},
+    {'Gemfile': "source 'https://rubygems.org'\n", 'Gemfile.lock': renderLockFile('Gemfile.lock', INITIAL_VERSION)},
+    {'package.json': '{"dependencies": {"left-pad": "^1.0.0"}}\n',
+     'package-lock.json': renderLockFile('package-lock.json', INITIAL_VERSION)},
+]
+# directories full of installed dependencies, which discovery should never have to walk through
+DEPENDENCY_DIRS = {'composer.json': 'vendor', 'package.json': 'node_modules', 'Gemfile': 'vendor/bundle'}
+
+
+def writeFile(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as syntheticFile:
+        syntheticFile.write(content)
+
+
+def buildDependencyTree(path, depth, width, manifest):
+    """
+    Builds a tree of fake installed packages, each with its own manifest, like a real node_modules or vendor directory
+    :param string path: root of the tree
+    :param int depth: how many levels of packages
+    :param int width: packages per level
+    :param string manifest: manifest file every package gets
+    :return: int: how many directories were created
+    """
+    if 0 >= depth:
+        return 0
+
+    created = 0
+    for package in range(width):
+        packagePath = os.path.join(path, 'package-{}'.format(package))
+        writeFile(os.path.join(packagePath, manifest), '{}\n')
+        created += 1 + buildDependencyTree(os.path.join(packagePath, os.path.basename(path)), depth - 1, width,
+                                           manifest)
+    return created
+
+
+def generateRepository(path, apps=10, depth=3, width=4, nesting=2, seed=0):
+    """
+    Generates a git repository shaped like a large project: many apps of every kind we support, some of them nested
+    inside group directories, each with a deep tree of installed dependencies
+    :param string path: where to create the repository. Must not exist yet
+    :param int apps: how many apps
+    :param int depth: depth of each app's installed dependency tree
+    :param int width: packages per level of that tree
+    :param int nesting: how many group directories apps are spread across
+    :param int seed: seed for the random layout
+    :return: dict: a description of what was generated
+    """
+    randomizer = random.Random(seed)
+    os.makedirs(path)
+    directories = 0
+    manifests = 0
+    for app in range(apps):
+        kind = APP_KINDS[app % len(APP_KINDS)]
+        group = 'group-{}'.format(randomizer.randrange(nesting)) if 0 < nesting else ''
+        appPath = os.path.join(path, group, 'app-{}'.format(app))
+        writeFile(os.path.join(appPath, APP_FILE), 'name: app-{}\n'.format(app))
+        for fileName, content in kind.items():
+            writeFile(os.path.join(appPath, fileName), content)
+            manifests += 1
+            if fileName in DEPENDENCY_DIRS:
+                directories += buildDependencyTree(os.path.join(appPath, DEPENDENCY_DIRS[fileName]), depth, width,
+                                                   fileName)
+        writeFile(os.path.join(appPath, 'src', 'index.txt'), 'app {}\n'.format(app))
+
+    # tooling at the root of the project, outside of any app
+    directories += buildDependencyTree(os.path.join(path, 'node_modules'), depth, width, 'package.json')
+
+    gitEnv = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+                  GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com')
+    subprocess.run(['git', 'init', '-q'], cwd=path, check=True, env=gitEnv)
+    # installed dependencies are never committed
+    writeFile(os.path.join(path, '.gitignore'), 'node_modules/\nvendor/\n')
+    subprocess.run(['git', 'add', '-A'], cwd=path, check=True, env=gitEnv)
+    subprocess.run(['git', 'commit', '-q', '-m', 'Synthetic project'], cwd=path, check=True, env=gitEnv)
+
+    return {'apps': apps, 'dependencyDirectories': directories, 'manifests': manifests}
+
+
+if __name__ == '__main__':
+    import sys
+    print(json.dumps(generateRepository(sys.argv[1], *(int(argument) for argument in sys.argv[2:])), indent=2))
@@ -1,19 +1,69 @@
 #!/usr/bin/env python
 # $ bash <(curl -fsS https://raw.githubusercontent.com/platformsh/source-operations/main/setup.sh) autoprsourceop
 # https://console.platform.sh/paul-gilzowatplatform-sh/rdj2cferlaluk/update/log/sqydnupxgbjqe
+import contextvars
+import json
 import os
+import shlex
 import sys
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import critical, error, info, warning, debug
+import psh_api
+import psh_metadata
 import psh_utility
+from psh_checkpoint import TriggerCheckpoint, readLastRun, recordLastRun
+from psh_lock import runSingleFlight
+from psh_shard import ENVVAR_SHARD, ENVVAR_SHARDS, getShardSpec
 from psh_utility import PSH_COMMON_MESSAGES, SOURCE_OP_TOOLS_VERSION
-from psh_logging import outputError, CBOLD, CRESET, CWARN
+from psh_logging import outputError, replayLogs, runWithBufferedLogs, CBOLD, CRESET, CWARN
+from psh_trace import traced
 
 DEFAULT_UPDATE_BRANCH = "update"
 ENVVAR_UPDATE_BRANCH = "PSH_SOP_UPDATE_BRANCH"
+# seconds the source operation may run before we give up on it. 0 means no limit
+ENVVAR_RUN_TIMEOUT = "PSH_SOP_RUN_TIMEOUT"
+# seconds during which a run that found nothing to update still counts, as long as production hasn't moved
+ENVVAR_FRESHNESS = "PSH_SOP_FRESHNESS"
+DEFAULT_FRESHNESS = 43200
+# cached in place of an integration ID when the project has no git integration, since empty answers are never cached
+NO_GIT_INTEGRATION = 'none'
 
 
-def trigger_autoupdate():
+class PreflightChecks(object):
+    """
+    Runs a set of checks concurrently. Whatever a check logs is held back until its result is asked for, so the output
+    reads exactly as if the checks had run one after the other
+    """
+    def __init__(self, checks):
+        self.pool = ThreadPoolExecutor(max_workers=len(checks))
+        self.futures = {}
+        for name, check in checks:
+            # copy the context so any context variables the caller has set carry over to the worker threads
+            self.futures[name] = self.pool.submit(contextvars.copy_context().run, runWithBufferedLogs, check)
+
+    def result(self, name):
+        """
+        Waits for a check to finish, logs what it logged and returns its result
+        :param string name: name of the check
+        :return: whatever the check returned
+        """
+        result, records = self.futures[name].result()
+        replayLogs(records)
+        return result
+
+    def abort(self):
+        """
+        Stops waiting on the checks we haven't needed yet. Anything they log is discarded
+        :return: bool: always False so it can be returned straight from a failed check
+        """
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        return False
+
+
+def trigger_autoupdate(config=None):
     """
     Handles everything necessary for an auto-update source operation to occur:
 
@@ -27,19 +77,43 @@ def trigger_autoupdate():
     * syncs the target branch with production
     * Runs the auto-update source operation
     * Returns the target branch back to an inactive status if that's what it was previously
+    :param dict config: per run settings that take precedence over the environmental variables: project (ID of the
+        project to update instead of the one we're running in), updateBranch, sourceOp, force (run even if nothing
+        has changed since the last run) and shards (instead of PSH_SOP_SHARDS). A sharded run also has the shard it's
+        for and the pruneGuard shared by all of them
     :return: bool
     """
     defaultSourceOpName = "auto-update"
     defaultSourceOpNameEnvVar = 'PSH_SOP_NAME'
-
+    config = config or {}
+    # with shards, we run once for each of them on its own update branch
+    if not config.get('shard') and getShardSpec(config):
+        from shard_autoupdate import shard_autoupdate
+        return shard_autoupdate(config)
+    # shards share prune_branches, so their orchestrator decides when it's re-enabled
+    pruneGuard = config.get('pruneGuard')
+    # production branch, git integration and token validity rarely change, so they're cached per project
+    projectID = config.get('project') or psh_api.getProjectID()
+    # talks to the API directly when PSH_SOP_API_CLIENT=native, otherwise None and we use the platform cli
+    apiClient = psh_api.getClient(projectID)
+    # starts activities without blocking on them and tracks them itself. The native client, or the cli if
+    # PSH_SOP_POLL_ACTIVITIES=1, otherwise None and the cli's --wait does the waiting
+    activityClient = psh_api.getActivityClient(projectID)
+    # every environment we need to know about comes from one listing, shared by everything that needs it
+    environmentListing = {}
+    environmentListingLock = threading.Lock()
+
+    @traced('trigger-sopupdate')
     def inner_trigger_autoupdate():
         """
         Main function. Controls the processing of the auto update run
         :return: bool
         """
-        updateBranchPreviousStatus = "inactive"
-        reactivatePruneBranches = False
         logging.info("Using Source Ops Toolkit v{}".format(SOURCE_OP_TOOLS_VERSION))
+        if pruneGuard:
+            pruneGuard.offer(config['shard'], enableGitIntPruneBranches)
+        # a follow-up run needs to see the environments as they are now
+        environmentListing.clear()
         logging.info("Beginning set up to perform the source operation update...")
 
         # Do we have a PSH CLI Token set up?
@@ -51,39 +125,70 @@ def trigger_autoupdate():
         else:
             logging.info('{}{}{}'.format(CBOLD, PSH_COMMON_MESSAGES['psh_cli_token']['success_message'], CRESET))
 
+        updateBranchName = getUpdateBranchName()
+        sourceOpName = getSourceOpName()
+        # everything else we need to know before we can start is independent, so we ask for all of it at once and then
+        # go through the answers in the same order we always have
+        preflightChecks = runPreflightChecks(updateBranchName)
+
         # Is the psh cli installed?
         logging.info(PSH_COMMON_MESSAGES['psh_cli']['event'])
-        if not psh_utility.verifyPshCliInstalled():
+        if not preflightChecks.result('installed'):
             outputError(PSH_COMMON_MESSAGES['psh_cli']['event'], PSH_COMMON_MESSAGES['psh_cli']['fail_message'])
-            return False
+            return preflightChecks.abort()
         else:
             logging.info('{}{}{}'.format(CBOLD, PSH_COMMON_MESSAGES['psh_cli']['success_message'], CRESET))
 
         # But is the cli token valid?
         logging.info(PSH_COMMON_MESSAGES['psh_cli_validity']['event'])
-        if not psh_utility.verifyPshCliTokenValidity():
+        if not preflightChecks.result('validity'):
             outputError(PSH_COMMON_MESSAGES['psh_cli_validity']['event'],
                         PSH_COMMON_MESSAGES['psh_cli_validity']['fail_message'])
-            return False
+            return preflightChecks.abort()
         else:
             logging.info('{}{}{}'.format(CBOLD, PSH_COMMON_MESSAGES['psh_cli_validity']['success_message'], CRESET))
 
         # now we need to get our production branch name. updateBranch and sourceOpName have defaults; only with the
         # productionBranch may we encounter a fatal error
-        productionBranchName = getProductionBranchName()
+        productionBranchName = preflightChecks.result('production')
         if not (productionBranchName):
-            return False
+            return preflightChecks.abort()
 
-        updateBranchName = getUpdateBranchName()
-        sourceOpName = getSourceOpName()
         # what do we need to do with the target branch before we can update it
-        updateBranchAction = determineBranchAction(updateBranchName)
+        updateBranchAction = preflightChecks.result('action')
+        if not updateBranchAction:
+            return preflightChecks.abort()
+        productionHead = getHeadCommit(productionBranchName)
+
+        # The rest of the run is a fixed sequence of steps, and we write a checkpoint after each one. If a run fails or
+        # gets killed part way through, the next one skips whatever is still valid and, most importantly, still
+        # restores the update branch and prune_branches afterwards
+        checkpoint = TriggerCheckpoint(projectID, updateBranchName)
+        # unless there's an interrupted run to finish, there's no point in running again if production hasn't moved
+        # since a recent run that found nothing to update
+        if not checkpoint.state and not config.get('force') and isUpToDate(productionHead, updateBranchName,
+                                                                          sourceOpName):
+            preflightChecks.abort()
+            logging.info("{}{}{}".format(CBOLD, "{} is already up to date.".format(updateBranchName), CRESET))
+            return True
+        if checkpoint.steps:
+            logging.info("Resuming the previous run, which stopped after: {}".format(', '.join(checkpoint.steps)))
+        if checkpoint.get('previousStatus') is None:
+            # only the run that first touched the update branch knows what state it was in before
+            checkpoint.update(previousStatus='active' if 'sync' == updateBranchAction else 'inactive')
+
+        def preparePruneBranches():
+            """
+            If we have to create the update branch, makes sure the git integration won't immediately delete it
+            :return: bool
+            """
+            if "create" != updateBranchAction:
+                return True
 
-        if "create" == updateBranchAction:
             logging.info("Your update branch '{}' does not exist so I need to create it".format(updateBranchName))
-            integrationID = getGitIntegrationID()
+            integrationID, pruneBranchesEnabled = getGitIntegration(updateBranchName)
             # first we need to check the integration status and if prune_branches is enabled
-            if integrationID != "" and getGitIntPruneBranchProp(integrationID, updateBranchName):
+            if integrationID != "" and pruneBranchesEnabled:
                 # we need to warn them
                 logging.warning('{}{}{}'.format(CWARN, "'prune_branches' enabled in git integration!", CRESET))
                 message = "You have a git integration with this project. If I create the update branch '{}'".format(
@@ -92,7 +197,8 @@ def trigger_autoupdate():
                 message += " Attempting to disable it now. "
                 logging.info(message)
 
-                if not disableGitIntPruneBranches(integrationID):
+                if not (pruneGuard.disable(integrationID, disableGitIntPruneBranches) if pruneGuard
+                        else disableGitIntPruneBranches(integrationID)):
                     # weird, we couldnt update the integration...
                     event = "Trying to update 'prune_branches' to false on git integration {}".format(integrationID)
                     message = "I was unable to disable the 'prune_branches' setting for git integration {}.".format(
@@ -103,85 +209,230 @@ def trigger_autoupdate():
                         updateBranchName)
                     message += " Exiting."
                     return outputError(event, message)
-                else:
-                    reactivatePruneBranches = True
-                    logging.info('{}{}{}'.format(CBOLD, "'prune_branches' disabled", CRESET))
-                    message = " I have disabled 'prune_branches' so I can create the branch and continue running "
-                    message += "updates. I will attempt to re-enable 'prune_branches' in your integration after the "
-                    message += "update process on branch '{}' has finished and been pushed to ".format(updateBranchName)
-                    message += "your remote git repository."
-                    logging.info(message)
-
-            if not createBranch(updateBranchName, productionBranchName):
-                return False
-        else:
-            if "activate" == updateBranchAction:
-                if not activateBranch(updateBranchName):
-                    return False
-            else:
-                updateBranchPreviousStatus = "active"
-
-            # for all existing branch situations, we need to verify the parent and then sync
-            if not validateUpdateBranchAncestory(updateBranchName, productionBranchName):
+
+                if pruneGuard:
+                    logging.info('{}{}{}'.format(CBOLD, "'prune_branches' disabled until every shard is done",
+                                                 CRESET))
+                    return True
+
+                # remembered straight away, so re-enabling it is never forgotten
+                checkpoint.update(pruneBranchesIntegration=integrationID)
+                logging.info('{}{}{}'.format(CBOLD, "'prune_branches' disabled", CRESET))
+                message = " I have disabled 'prune_branches' so I can create the branch and continue running "
+                message += "updates. I will attempt to re-enable 'prune_branches' in your integration after the "
+                message += "update process on branch '{}' has finished and been pushed to ".format(updateBranchName)
+                message += "your remote git repository."
+                logging.info(message)
+
+            return True
+
+        def prepareUpdateBranch():
+            """
+            Creates or activates the update branch as needed
+            :return: bool
+            """
+            if "create" == updateBranchAction:
+                return createBranch(updateBranchName, productionBranchName)
+
+            if "activate" == updateBranchAction and not activateBranch(updateBranchName):
                 return False
 
-            # now that we know it's active, let's sync
+            # for all existing branch situations, we need to verify the parent before we sync
+            return validateUpdateBranchAncestory(updateBranchName, productionBranchName)
+
+        def syncUpdateBranch():
+            """
+            Syncs the update branch with production, unless it already is
+            :return: bool
+            """
+            # We dont need to do it on a create action because we KNOW it's already sync'ed
+            if "create" == updateBranchAction:
+                checkpoint.update(syncedHead=productionHead)
+                return True
+
+            # an earlier run already synced the (still active) branch and production hasn't moved since
+            if ("sync" == updateBranchAction and productionHead and checkpoint.isComplete('sync')
+                    and productionHead == checkpoint.get('syncedHead')):
+                logging.info("Branch {} is already synced with {} at {}.".format(updateBranchName, productionBranchName,
+                                                                                 productionHead))
+                return True
+
             # Originally we were checking the `commits_behind` status of the branch and only doing a sync if it was
             # behind, but if a branch is already up-to-date with its parent, then performing a sync command on it will
-            # simply return a success exit status. We dont need to do it on a create action because we KNOW it's
-            # already sync'ed
+            # simply return a success exit status.
             if not syncBranch(updateBranchName, productionBranchName):
                 return False
 
-        # Hey, we can finally run the source operation!
-        if not runSourceOperations(sourceOpName, updateBranchName):
-            return False
+            checkpoint.update(syncedHead=productionHead)
+            return True
+
+        def runUpdate():
+            """
+            Runs the source operation, unless an earlier run already did for the same production head
+            :return: bool
+            """
+            if (productionHead and checkpoint.isComplete('source-operation')
+                    and productionHead == checkpoint.get('sourceOperationHead')
+                    and sourceOpName == checkpoint.get('sourceOperation')):
+                logging.info("Source operation '{}' already ran against {} at {}.".format(sourceOpName,
+                                                                                         productionBranchName,
+                                                                                         productionHead))
+                return True
+
+            # Hey, we can finally run the source operation! Whether the update branch's head moved tells us if it found
+            # anything to update
+            updateHead = getHeadCommit(updateBranchName, refresh=True)
+            # a shard's source operation needs to know which shard it's updating
+            variables = {ENVVAR_SHARD: config['shard'], ENVVAR_SHARDS: config['shards']} if config.get('shard') else {}
+            if not runSourceOperations(sourceOpName, updateBranchName, variables):
+                return False
+
+            updatedHead = getHeadCommit(updateBranchName, refresh=True)
+            checkpoint.update(sourceOperation=sourceOpName, sourceOperationHead=productionHead, updateHead=updatedHead,
+                              foundChanges=updateHead != updatedHead if updateHead and updatedHead else None)
+            return True
+
+        def restoreUpdateBranch(deactivate):
+            """
+            Puts the update branch and prune_branches back the way they were before we touched them. That and
+            re-enabling prune_branches don't depend on each other, so both get started right away. Whatever couldn't be
+            restored stays in the checkpoint so the next run tries again
+            :param bool deactivate: whether the update branch is due to be deactivated, if it was inactive before
+            :return: bool: whether everything was restored
+            """
+            integrationID = checkpoint.get('pruneBranchesIntegration')
+            if integrationID and pruneGuard:
+                # left disabled by an earlier run of this shard, so it waits for the other shards too
+                pruneGuard.adopt(integrationID)
+                integrationID = None
+            previouslyInactive = deactivate and "inactive" == checkpoint.get('previousStatus')
+            followUps = PreflightChecks([
+                ('deactivate', lambda: not previouslyInactive or deactivateUpdateBranch(updateBranchName)),
+                ('prune', lambda: not integrationID or enableGitIntPruneBranches(integrationID)),
+            ])
+            deactivated = pruneBranchesRestored = True
+            if previouslyInactive:
+                logging.info("{} branch was inactive previously so we will deactivate it.".format(updateBranchName))
+                deactivated = followUps.result('deactivate')
+            elif deactivate:
+                logging.info("Branch {} was previously active so we'll leave it alone.".format(updateBranchName))
+
+            if integrationID:
+                message = "'prune_branches' was enabled previously; I had to disable it temporarily. Attempting to "
+                message += " re-enable it now..."
+                logging.info(message)
+                # we need to reactivate the prune branches setting
+                pruneBranchesRestored = followUps.result('prune')
+                if not pruneBranchesRestored:
+                    event = "Trying to update 'prune_branches' to true on git integration {}".format(integrationID)
+                    message = "I was unable to re-enable the 'prune_branches' setting for git integration {}.".format(
+                        integrationID)
+                    message += " You will need to manually update the integration and re-enable this setting, or I "
+                    message += "will try again on the next run."
+
+                    outputError(event, message)
+                else:
+                    logging.info("'prune_branches' for integration {} was successfully re-enabled.".format(
+                        integrationID))
+
+            checkpoint.update(pruneBranchesIntegration=None if pruneBranchesRestored else integrationID)
+            return deactivated and pruneBranchesRestored
+
+        steps = [
+            ('prune_branches', preparePruneBranches),
+            ('update branch', prepareUpdateBranch),
+            ('sync', syncUpdateBranch),
+            ('source-operation', runUpdate),
+        ]
+        # the steps this run got through, as opposed to the ones an earlier run did
+        completedSteps = []
+        for step, runStep in steps:
+            if not runStep():
+                recordLastRun(projectID, updateBranchName, result=False, productionHead=productionHead)
+                # a failed step shouldn't leave the update branch active or prune_branches disabled until a run gets
+                # through every step, so whatever is due is restored now. The branch only needs deactivating if this
+                # run got as far as creating or activating it, and the next run activates it again
+                restoreUpdateBranch('update branch' in completedSteps)
+                logging.info("The next run will pick up from the '{}' step.".format(step))
+                return False
+            checkpoint.complete(step)
+            completedSteps.append(step)
+
+        recordLastRun(projectID, updateBranchName, result=True, productionHead=productionHead,
+                      updateHead=checkpoint.get('updateHead'), sourceOperation=sourceOpName,
+                      foundChanges=checkpoint.get('foundChanges'))
 
         # Now that we're done, let's restore the targeted update branch back to where it was before we touched it
-        if "inactive" == updateBranchPreviousStatus:
-            logging.info("{} branch was inactive previously so we will deactivate it.".format(updateBranchName))
-            deactivateUpdateBranch(updateBranchName)
-        else:
-            logging.info("Branch {} was previously active so we'll leave it alone.".format(updateBranchName))
-
-        if reactivatePruneBranches:
-            message = "'prune_branches' was enabled previously; I had to disable it temporarily. Attempting to "
-            message += " re-enable it now..."
-            logging.info(message)
-            # we need to reactivate the prune branches setting
-            if not enableGitIntPruneBranches(integrationID):
-                event = "Trying to update 'prune_branches' to true on git integration {}".format(integrationID)
-                message = "I was unable to re-enable the 'prune_branches' setting for git integration {}.".format(
-                    integrationID)
-                message += " You will need to manually update the integration and re-enable this setting. "
-
-                outputError(event, message)
-            else:
-                logging.info("'prune_branches' for integration {} was successfully re-enabled.".format(integrationID))
+        if restoreUpdateBranch(True):
+            checkpoint.clear()
 
         logging.info("{}{}{}".format(CBOLD, "Auto update of {} environment complete.".format(updateBranchName), CRESET))
         return True
 
+    def runPreflightChecks(updateBranchName):
+        """
+        Starts every independent check and lookup we need before we can begin, all at the same time. Each one takes a
+        round trip to the API, so together they take about as long as the slowest one instead of the sum of all of them
+        :param string updateBranchName: name of branch we will target for updates
+        :return: PreflightChecks
+        """
+        checks = [
+            ('installed', psh_utility.verifyPshCliInstalled),
+            ('validity', lambda: psh_metadata.getCachedMetadata(projectID, psh_metadata.getTokenKey('tokenValidity'),
+                                                                psh_utility.verifyPshCliTokenValidity)),
+            ('production', lambda: psh_metadata.getCachedMetadata(projectID, 'productionBranch',
+                                                                  getProductionBranchName)),
+            ('action', lambda: determineBranchAction(updateBranchName)),
+        ]
+        return PreflightChecks(checks)
+
+    def getGitIntegration(updateBranchName):
+        """
+        Looks up the git integration and whether its prune_branches is enabled. Only needed when we have to create the
+        update branch, so it isn't part of the preflight checks
+        :param string updateBranchName: name of branch we will target for updates
+        :return: tuple: the integration ID ("" if there isn't one) and whether prune_branches is enabled
+        """
+        integrationID = psh_metadata.getCachedMetadata(projectID, 'gitIntegrationID', getGitIntegrationID)
+        if integrationID in ("", NO_GIT_INTEGRATION):
+            return "", False
+        pruneBranchesEnabled = getGitIntPruneBranchProp(integrationID, updateBranchName)
+        if pruneBranchesEnabled is None:
+            # the integration we remembered may have been removed, so make sure we look it up again next time
+            psh_metadata.invalidateMetadata(projectID, 'gitIntegrationID')
+            pruneBranchesEnabled = False
+        return integrationID, pruneBranchesEnabled
+
+    @traced('re-enable prune_branches')
     def enableGitIntPruneBranches(integrationID):
         """
         Attempts to re-enable the 'prune_branches' property in the git integration
         :param integrationID: The git integration ID
         :return: bool
         """
-        command = "platform integration:update {} --prune-branches=true".format(integrationID)
-        pruneBranchesRun = psh_utility.runCommand(command)
+        if apiClient:
+            pruneBranchesRun = psh_api.callApi(apiClient.updateIntegration, integrationID, {'prune_branches': True})
+        else:
+            command = "platform integration:update {} --prune-branches=true".format(shlex.quote(integrationID))
+            pruneBranchesRun = runCliCommand(command)
         return pruneBranchesRun['result']
 
+    @traced('prune_branches lookup')
     def getGitIntPruneBranchProp(integrationID, updateBranchName):
         """
         Retrieves the status of 'prune_branches' property in the git integration
         :param string integrationID: The git integration ID
         :param string updateBranchName: Target branch name
-        :return: bool
+        :return: bool|None: None if we couldn't retrieve the integration
         """
         # now we need to get integration details
-        command = "platform integration:get {} --property prune_branches".format(integrationID)
-        integrationGetRun = psh_utility.runCommand(command)
+        if apiClient:
+            integrationGetRun = psh_api.callApi(apiClient.getIntegration, integrationID)
+            if integrationGetRun['result']:
+                integrationGetRun['message'] = str(bool(integrationGetRun['message'].get('prune_branches'))).lower()
+        else:
+            command = "platform integration:get {} --property prune_branches".format(shlex.quote(integrationID))
+            integrationGetRun = runCliCommand(command)
         # @todo, what should we do here if the retrieval of the integration fails? we're in a situation where things
         # *might* fail, but might not...
         if not integrationGetRun['result']:
@@ -193,13 +444,14 @@ def trigger_autoupdate():
             message += "then your git integration probably deleted it"
             outputError(event, message)
             # bail, cuz we can't do anything else
-            return False
+            return None
 
         if integrationGetRun['message'].strip() == "true":
             return True
         else:
             return False
 
+    @traced('disable prune_branches')
     def disableGitIntPruneBranches(integrationID):
         """
         Attempts to disable the 'prune_branches' property in the git integration
@@ -208,10 +460,14 @@ def trigger_autoupdate():
         """
         # so we know prune_branches is true, let's try to change it
 
-        command = "platform integration:update {} --prune-branches=false".format(integrationID)
-        pruneBranchesRun = psh_utility.runCommand(command)
+        if apiClient:
+            pruneBranchesRun = psh_api.callApi(apiClient.updateIntegration, integrationID, {'prune_branches': False})
+        else:
+            command = "platform integration:update {} --prune-branches=false".format(shlex.quote(integrationID))
+            pruneBranchesRun = runCliCommand(command)
         return pruneBranchesRun['result']
 
+    @traced('git integration lookup')
     def getGitIntegrationID():
         """
         Retrieves the integration ID for any git source integration
@@ -219,12 +475,19 @@ def trigger_autoupdate():
         @todo For now we can only have ONE git source integration per project. This may need to be updated in the future
         if that changes
 
-        :return: string The git integration ID
+        :return: string The git integration ID, NO_GIT_INTEGRATION if there isn't one, "" if we couldn't tell
         """
         import csv
         validGitIntegrations = ['github', 'gitlab', 'bitbucket']
-        command = "platform integration:list --columns=ID,Type --format=csv --no-header"
-        integrationRun = psh_utility.runCommand(command)
+        if apiClient:
+            integrationRun = psh_api.callApi(apiClient.getIntegrations)
+            if integrationRun['result']:
+                # same shape as the cli's csv output
+                integrationRun['message'] = '\n'.join('{},{}'.format(integration.get('id'), integration.get('type'))
+                                                      for integration in integrationRun['message'])
+        else:
+            command = "platform integration:list --columns=ID,Type --format=csv --no-header"
+            integrationRun = runCliCommand(command)
         # it's possible there are zero integrations which will return an exit code of 1/false, but we dont care
         if not integrationRun['result']:
             return ""
@@ -240,10 +503,11 @@ def trigger_autoupdate():
                 break
 
         if not integrationFound:
-            return ""
+            return NO_GIT_INTEGRATION
 
         return integrationID
 
+    @traced('production branch lookup')
     def getProductionBranchName():
         """
         Gets the production branch name
@@ -253,9 +517,11 @@ def trigger_autoupdate():
         handle it? an empty string should register as a false so it would work
         :return: bool|string: Name of the production branch
         """
-        command = "platform environment:list --type production --pipe 2>/dev/null"
         event = "Retrieving production environments"
-        prodBranchRun = psh_utility.runCommand(command)
+        prodBranchRun = getEnvironments()
+        if prodBranchRun['result']:
+            prodBranchRun['message'] = '\n'.join(name for name, environment in prodBranchRun['message'].items()
+                                                 if 'production' == environment.get('type'))
         if not prodBranchRun['result'] or "" == prodBranchRun['message'].strip():
             message = "I was unable to retrieve a list of production type branches for this project. Please create a"
             message += " ticket and ask that it be assigned to the DevRel team.\n\n"
@@ -271,6 +537,7 @@ def trigger_autoupdate():
 
         return prodEnvironments[0]
 
+    @traced('deactivate update branch')
     def deactivateUpdateBranch(targetEnvironment):
         """
         Sets the environment back to inactive status (ie Deletes the *environment* but not the git branch)
@@ -278,25 +545,44 @@ def trigger_autoupdate():
         :return: bool
         """
         logging.info("Deactivating environment {}".format(targetEnvironment))
-        command = "platform e:delete {} --no-delete-branch --no-wait --yes 2>/dev/null".format(targetEnvironment)
-        deactivateRun = psh_utility.runCommand(command)
+        command = "platform e:delete {} --no-delete-branch --no-wait --yes 2>/dev/null".format(
+            shlex.quote(targetEnvironment))
+        if apiClient:
+            deactivateRun = psh_api.callApi(apiClient.runEnvironmentAction, targetEnvironment, 'deactivate')
+        else:
+            deactivateRun = runCliCommand(command)
         if deactivateRun['result']:
             logging.info("{}{}{}".format(CBOLD, "Environment {} deactivated".format(targetEnvironment), CRESET))
+            return True
         else:
             return outputError(command, deactivateRun['message'])
 
-    def runSourceOperations(sourceoperation, targetEnvironment):
+    @traced('source operation')
+    def runSourceOperations(sourceoperation, targetEnvironment, variables=None):
         """
         Runs the named source operation against a target branch
         :param string sourceoperation: name of the source operation we want to run
         :param string targetEnvironment: name of the branch we want to perform the source operation against
+        :param dict variables: environmental variables to set for the source operation
         :return: bool: source operation success
         """
         logging.info(
             "Running source operation '{}' against environment '{}'... ".format(sourceoperation, targetEnvironment))
-        command = "platform source-operation:run {} --environment {} --wait".format(sourceoperation,
-                                                                                    targetEnvironment)
-        sourceOpRun = psh_utility.runCommand(command)
+        command = "platform source-operation:run {} --environment {} --wait".format(shlex.quote(sourceoperation),
+                                                                                    shlex.quote(targetEnvironment))
+        command += ''.join(' {}'.format(shlex.quote('--variable=env:{}={}'.format(name, value)))
+                           for name, value in (variables or {}).items())
+        runTimeout = psh_utility.getEnvNumber(ENVVAR_RUN_TIMEOUT, 0, float) or None
+        if activityClient:
+            data = {'operation': sourceoperation}
+            if variables:
+                data['variables'] = {'env': variables}
+            sourceOpRun = runAndWait(targetEnvironment, 'source-operation', data, label=sourceoperation,
+                                     timeout=runTimeout)
+        else:
+            # the source operation's log can be huge, so stream it as it arrives instead of holding all of it until
+            # the end
+            sourceOpRun = runCliCommand(command, stream=True, timeout=runTimeout, label=sourceoperation)
 
         if sourceOpRun['result']:
             logging.info("{}{}{}".format(CBOLD, "Source operation completed.", CRESET))
@@ -306,47 +592,60 @@ def trigger_autoupdate():
 
     def getUpdateBranchName():
         """
-        Gets the update branch name from the environmental variable PSH_SOP_UPDATE_BRANCH, or defaults to 'update'
+        Gets the update branch name from our config, the environmental variable PSH_SOP_UPDATE_BRANCH, or defaults to
+        'update'
         :return: string: targeted update branch name
         """
-        return os.getenv(ENVVAR_UPDATE_BRANCH, DEFAULT_UPDATE_BRANCH)
+        return config.get('updateBranch') or os.getenv(ENVVAR_UPDATE_BRANCH, DEFAULT_UPDATE_BRANCH)
 
     def getSourceOpName():
         """
-        Gets the source operation name from the environmental variable PSH_SOP_NAME, or defaults to 'auto-update'
+        Gets the source operation name from our config, the environmental variable PSH_SOP_NAME, or defaults to
+        'auto-update'
         :return: string: source operation name we want to run
         """
-        return os.getenv(defaultSourceOpNameEnvVar, defaultSourceOpName)
+        return config.get('sourceOp') or os.getenv(defaultSourceOpNameEnvVar, defaultSourceOpName)
 
+    @traced('update branch status lookup')
     def determineBranchAction(updateBranchName):
         """
         We need the update branch, and we need it to be synced with production
         This could mean we need to create the branch, or sync the branch, or do nothing
         :param string updateBranchName: name of branch we will target for updates
-        :return: string: action we need to perform on the target branch
+        :return: bool|string: action we need to perform on the target branch, False if we couldn't tell
         """
         action = 'sync'
-        # kill two birds with one stone here: if it doesn't exist, then we'll get an error & know we need to create it.
-        # If it exists, then we'll know if we need to sync it
-        command = "platform environment:info status -e {} 2>/dev/null".format(updateBranchName)
-        branchStatusRun = psh_utility.runCommand(command)
-
-        if not branchStatusRun['result']:
+        # kill two birds with one stone here: if it isn't listed, then we know we need to create it. If it is, then
+        # we'll know if we need to sync it
+        environmentsRun = getEnvironments()
+        if not environmentsRun['result']:
+            # not being able to list the environments doesn't mean the branch isn't there, and creating it would mean
+            # disabling prune_branches and forcing a branch over one that may well exist
+            return outputError("Retrieving the status of the update branch {}".format(updateBranchName),
+                               "I was unable to retrieve the list of environments: {}".format(
+                                   environmentsRun['message']))
+
+        updateEnvironment = environmentsRun['message'].get(updateBranchName)
+        if updateEnvironment is None:
             action = 'create'
-        elif 'inactive' == branchStatusRun['message'].strip():
+        elif 'inactive' == updateEnvironment.get('status'):
             action = 'activate'
 
         return action
 
+    @traced('activate update branch')
     def activateBranch(updateBranchName):
         """
         Activate a branch
         :param updateBranchName: name of branch to activate
         :return: bool
         """
-        command = "platform environment:activate {} --wait --yes 2>/dev/null".format(updateBranchName)
+        command = "platform environment:activate {} --wait --yes 2>/dev/null".format(shlex.quote(updateBranchName))
         logging.info("Activating branch {}...".format(updateBranchName))
-        activateBranchRun = psh_utility.runCommand(command)
+        if activityClient:
+            activateBranchRun = runAndWait(updateBranchName, 'activate')
+        else:
+            activateBranchRun = runCliCommand(command)
         if not activateBranchRun['result']:
             event = "Activating branch {}".format(updateBranchName)
             message = "I encountered an error while attempting to activate the branch {}. Please ".format(
@@ -357,6 +656,7 @@ def trigger_autoupdate():
         logging.info("{}{}{}".format(CBOLD, "Environment activated.", CRESET))
         return True
 
+    @traced('create update branch')
     def createBranch(updateBranchName, productionBranchName):
         """
         Creates the update branch so we can run source operations against it
@@ -366,9 +666,13 @@ def trigger_autoupdate():
         """
         event = "Creating environment {}".format(updateBranchName)
         logging.info("{}...".format(event))
-        command = "platform e:branch {} {} --no-clone-parent --force 2>/dev/null".format(updateBranchName,
-                                                                                         productionBranchName)
-        createBranchRun = psh_utility.runCommand(command)
+        command = "platform e:branch {} {} --no-clone-parent --force 2>/dev/null".format(
+            shlex.quote(updateBranchName), shlex.quote(productionBranchName))
+        if activityClient:
+            createBranchRun = runAndWait(productionBranchName, 'branch',
+                                         {'name': updateBranchName, 'title': updateBranchName, 'clone_parent': False})
+        else:
+            createBranchRun = runCliCommand(command)
         if not createBranchRun['result']:
             event = "Failure {}".format(event)
             message = "I encountered an error while attempting to create the branch {}.".format(updateBranchName)
@@ -379,6 +683,7 @@ def trigger_autoupdate():
 
         return createBranchRun['result']
 
+    @traced('update branch parent check')
     def validateUpdateBranchAncestory(updateBranchName, productionBranchName):
         """
         Makes sure the update branch is a direct child of production branch
@@ -386,8 +691,10 @@ def trigger_autoupdate():
         :param productionBranchName: Name of the production branch
         :return: bool
         """
-        command = "platform environment:info parent -e {} 2>/dev/null".format(updateBranchName)
-        branchAncestoryRun = psh_utility.runCommand(command)
+        branchAncestoryRun = getEnvironments()
+        if branchAncestoryRun['result']:
+            branchAncestoryRun['message'] = (branchAncestoryRun['message'].get(updateBranchName) or {}).get(
+                'parent') or ''
         if not branchAncestoryRun['result'] or productionBranchName != branchAncestoryRun['message'].strip():
             event = "Update Branch {} is not a direct descendant of {}".format(updateBranchName, productionBranchName)
             message = "The targeted update branch '{}', is not a direct descendant of the production branch".format(
@@ -400,6 +707,7 @@ def trigger_autoupdate():
 
         return True
 
+    @traced('sync update branch')
     def syncBranch(updateBranchName, productionBranchName):
         """
         Syncs the code from production down to our update branch before we run the auto-update source operation
@@ -408,9 +716,12 @@ def trigger_autoupdate():
         :return: bool
         """
         event = "Sync{} branch {} with {}"
-        command = "platform sync -e {} --yes --wait code 2>/dev/null".format(updateBranchName)
+        command = "platform sync -e {} --yes --wait code 2>/dev/null".format(shlex.quote(updateBranchName))
         logging.info(event.format('ing', updateBranchName, productionBranchName))
-        syncRun = psh_utility.runCommand(command)
+        if activityClient:
+            syncRun = runAndWait(updateBranchName, 'synchronize', {'synchronize_code': True, 'synchronize_data': False})
+        else:
+            syncRun = runCliCommand(command)
 
         if not syncRun['result']:
             failedEvent = "Failed to {}".format(event.format('', updateBranchName, productionBranchName))
@@ -422,5 +733,104 @@ def trigger_autoupdate():
 
         return syncRun['result']
 
-    # fire off our workhorse function
-    return inner_trigger_autoupdate()
+    @traced('environment listing')
+    def getEnvironments(refresh=False):
+        """
+        Lists every environment in the project, with its status, type, parent and head commit, in a single request.
+        The listing is only retrieved once per run (unless refresh is set) no matter how many checks need it
+        :param bool refresh: retrieve a new listing even if we already have one
+        :return: dict {result: boolean, message: dict of environments keyed by name|error message }
+        """
+        with environmentListingLock:
+            if refresh or not environmentListing.get('result'):
+                if apiClient:
+                    listingRun = psh_api.callApi(apiClient.getEnvironments)
+                else:
+                    # project:curl gives us the same structured listing the API does, where environment:list and
+                    # environment:info only give us a few properties at a time
+                    listingRun = runCliCommand("platform project:curl /environments 2>/dev/null")
+                    if listingRun['result']:
+                        try:
+                            listingRun['message'] = json.loads(listingRun['message'])
+                        except ValueError:
+                            listingRun = {'result': False, 'message': "Unable to parse the list of environments"}
+                if listingRun['result']:
+                    listingRun['message'] = {environment.get('name', environment.get('id')): environment
+                                             for environment in listingRun['message']}
+                environmentListing.clear()
+                environmentListing.update(listingRun)
+
+            return dict(environmentListing)
+
+    def runCliCommand(command, **kwargs):
+        """
+        Runs a platform cli command against the configured project, within the API rate limit
+        :param string command: platform cli command
+        :param kwargs: passed on to runCommand
+        :return: dict {result: boolean, message: string }
+        """
+        # the project can come from the config or PSH_SOP_PROJECT, and the cli only knows the one it's running in
+        if projectID:
+            platform, subcommand, options = (command.split(' ', 2) + [''])[:3]
+            command = ' '.join((platform, subcommand, '-p', shlex.quote(projectID), options))
+        psh_api.getRateLimiter().acquire()
+        return psh_utility.runCommand(command, **kwargs)
+
+    def getHeadCommit(environmentName, refresh=False):
+        """
+        Gets the commit an environment is currently at from the environment listing
+        :param string environmentName: name of the environment
+        :param bool refresh: retrieve a new listing first
+        :return: string|None: the commit sha, or None if we don't know it
+        """
+        environmentsRun = getEnvironments(refresh)
+        if not environmentsRun['result']:
+            return None
+        return (environmentsRun['message'].get(environmentName) or {}).get('head_commit')
+
+    def isUpToDate(productionHead, updateBranchName, sourceOpName):
+        """
+        Checks if the last run was successful, found nothing to update, happened less than PSH_SOP_FRESHNESS seconds
+        ago, and production is still at the same commit it was then
+        :param string productionHead: the commit production is at now
+        :param string updateBranchName: update branch name
+        :param string sourceOpName: source operation we would run
+        :return: bool
+        """
+        freshness = psh_utility.getEnvNumber(ENVVAR_FRESHNESS, DEFAULT_FRESHNESS, float)
+        lastRun = readLastRun(projectID, updateBranchName)
+        if (0 >= freshness or not productionHead or not lastRun.get('result')
+                or lastRun.get('foundChanges') is not False or productionHead != lastRun.get('productionHead')
+                or sourceOpName != lastRun.get('sourceOperation')
+                or time.time() - lastRun.get('finished', 0) > freshness):
+            return False
+
+        message = "Production is still at {}, and the run at {} found nothing to update, so I'm skipping this run. "
+        message += "Use --force to run anyway."
+        logging.info(message.format(productionHead, time.ctime(lastRun['finished'])))
+        return True
+
+    def runAndWait(environment, action, data=None, label=None, timeout=None):
+        """
+        Equivalent of a cli command run with --wait: triggers an environment action, then polls the activities it
+        started until they finish, logging their output as it arrives
+        :param string environment: environment name
+        :param string action: environment action (activate, branch, synchronize, source-operation, ...)
+        :param dict data: action parameters
+        :param string label: prefix for the activity log lines, defaults to the action
+        :param float timeout: seconds the activities may take before they're cancelled. None means no limit
+        :return: dict {result: boolean, message: error message }
+        """
+        actionRun = psh_api.callApi(activityClient.runEnvironmentAction, environment, action, data)
+        if not actionRun['result']:
+            return actionRun
+
+        deadline = time.time() + timeout if timeout else None
+        waitRun = psh_api.callApi(activityClient.waitForActivities, actionRun['message'], label or action, deadline)
+        if waitRun['result'] and not waitRun['message']:
+            return {'result': False, 'message': "The {} activity on {} failed".format(action, environment)}
+        return {'result': waitRun['result'], 'message': '' if waitRun['result'] else waitRun['message']}
+
+    # fire off our workhorse function. Runs that overlap for the same update branch are collapsed into one follow-up run
+    lockName = 'trigger-{}-{}'.format(projectID or 'default', getUpdateBranchName())
+    return runSingleFlight(lockName, inner_trigger_autoupdate)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import asyncio
+import json
+import logging
+import os
+import time
+
+import psh_api
+from cron_trigger_autoupdate import trigger_autoupdate
+from psh_logging import logPrefix, outputError, CBOLD, CRESET, CWARN
+from psh_trace import span
+from psh_utility import getEnvNumber
+
+ENVVAR_FLEET_MANIFEST = 'PSH_SOP_FLEET_MANIFEST'
+ENVVAR_FLEET_CONCURRENCY = 'PSH_SOP_FLEET_CONCURRENCY'
+DEFAULT_FLEET_CONCURRENCY = 4
+# unless PSH_SOP_API_RATE says otherwise, a fleet run keeps to this many API requests per second
+DEFAULT_FLEET_API_RATE = 10
+# the settings a project in the manifest may have, and the trigger_autoupdate config key each one maps to
+MANIFEST_KEYS = {'project': 'project', 'branch': 'updateBranch', 'sourceOp': 'sourceOp', 'shards': 'shards'}
+
+# asyncio logs its own housekeeping at debug level, which only clutters our output
+logging.getLogger('asyncio').setLevel(logging.INFO)
+
+
+def loadManifest(manifestPath):
+    """
+    Reads the fleet manifest: a json list with one entry per project. An entry is either a project ID or an object
+    with a `project` ID and optionally the update `branch`, `sourceOp` name and `shards` to use for that project.
+    Branch and source operation fall back to the same environmental variables trigger-sopupdate uses. Shards don't,
+    since they're specific to the layout of one project
+    :param string manifestPath: path to the manifest
+    :return: list|bool: trigger_autoupdate configs, or False if the manifest is unusable
+    """
+    event = "Reading fleet manifest {}".format(manifestPath)
+    try:
+        with open(manifestPath) as manifestFile:
+            manifest = json.load(manifestFile)
+    except (OSError, ValueError) as e:
+        return outputError(event, str(e))
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('projects')
+    if not isinstance(manifest, list) or not manifest:
+        return outputError(event, "The manifest must be a list of projects")
+
+    configs = []
+    for entry in manifest:
+        if not isinstance(entry, dict):
+            entry = {'project': entry}
+        if not entry.get('project'):
+            return outputError(event, "Every project in the manifest needs a project ID: {}".format(entry))
+        config = {configKey: str(entry[key]) for key, configKey in MANIFEST_KEYS.items() if entry.get(key)}
+        # PSH_SOP_SHARDS describes one project's apps, so it mustn't shard every project in the fleet
+        config.setdefault('shards', '')
+        configs.append(config)
+
+    return configs
+
+
+async def runProject(config, semaphore):
+    """
+    Runs the auto-update trigger for one project once there's room for it
+    :param dict config: trigger_autoupdate config
+    :param asyncio.Semaphore semaphore: limits how many projects run at once
+    :return: dict {project: string, result: bool, duration: float}
+    """
+    async with semaphore:
+        # every task runs in its own copy of the context, so this only prefixes what this project logs
+        logPrefix.set('[{}] '.format(config['project']))
+        start = time.perf_counter()
+        try:
+            with span(config['project'], 'project'):
+                result = await asyncio.to_thread(trigger_autoupdate, config)
+        except Exception as e:
+            # one broken project shouldn't take the rest of the fleet down with it
+            outputError("Auto update of project {}".format(config['project']), repr(e))
+            result = False
+
+        return {'project': config['project'], 'result': result is not False, 'duration': time.perf_counter() - start}
+
+
+async def runFleet(configs, concurrency):
+    """
+    Runs every project, at most concurrency at a time
+    :param list configs: trigger_autoupdate configs
+    :param int concurrency: how many projects may run at once
+    :return: list: the outcome of each project, in manifest order
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    return await asyncio.gather(*(runProject(config, semaphore) for config in configs))
+
+
+def reportFleet(outcomes, duration):
+    """
+    Logs one table with the outcome of every project
+    :param list outcomes: what runFleet returned
+    :param float duration: seconds the whole fleet took
+    :return: void
+    """
+    rowFormat = "{:<40} {:>8} {:>10}"
+    rows = [rowFormat.format('Project', 'Result', 'Seconds')]
+    for outcome in outcomes:
+        rows.append(rowFormat.format(outcome['project'], 'success' if outcome['result'] else 'FAILED',
+                                     '{:.2f}'.format(outcome['duration'])))
+    failed = [outcome['project'] for outcome in outcomes if not outcome['result']]
+    logging.info("Fleet auto update results:\n{}".format('\n'.join(rows)))
+    summary = "{} of {} projects updated successfully in {:.2f} seconds.".format(len(outcomes) - len(failed),
+                                                                                  len(outcomes), duration)
+    if failed:
+        logging.warning("{}{} Failed: {}{}".format(CWARN, summary, ', '.join(failed), CRESET))
+    else:
+        logging.info("{}{}{}".format(CBOLD, summary, CRESET))
+
+
+def fleet_autoupdate(manifestPath=None, force=False):
+    """
+    Triggers the auto-update source operation in every project listed in a manifest, several projects at a time. The
+    number of projects running at once is capped by PSH_SOP_FLEET_CONCURRENCY, and the requests all of them make to
+    the API by PSH_SOP_API_RATE
+    :param string manifestPath: path to the manifest, defaults to PSH_SOP_FLEET_MANIFEST
+    :param bool force: run every project even if it's already up to date
+    :return: bool: whether every project was updated successfully
+    """
+    manifestPath = manifestPath or os.getenv(ENVVAR_FLEET_MANIFEST)
+    if not manifestPath:
+        return outputError("Fleet auto update", "No manifest given. Pass its path or set {}".format(
+            ENVVAR_FLEET_MANIFEST))
+
+    configs = loadManifest(manifestPath)
+    if not configs:
+        return False
+    for config in configs:
+        config['force'] = force
+
+    concurrency = getEnvNumber(ENVVAR_FLEET_CONCURRENCY, DEFAULT_FLEET_CONCURRENCY)
+    psh_api.configureRateLimit(getEnvNumber(psh_api.ENVVAR_API_RATE, DEFAULT_FLEET_API_RATE, float))
+    logging.info("Triggering auto updates for {} projects, {} at a time...".format(len(configs), concurrency))
+    start = time.perf_counter()
+    outcomes = asyncio.run(runFleet(configs, concurrency))
+    reportFleet(outcomes, time.perf_counter() - start)
+
+    return all(outcome['result'] for outcome in outcomes)
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+import base64
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+from urllib.parse import quote, urlencode, urlsplit
+
+import psh_trace
+
+# set to 'native' to talk to the Platform.sh API directly instead of through the platform cli
+ENVVAR_API_CLIENT = 'PSH_SOP_API_CLIENT'
+ENVVAR_API_URL = 'PSH_SOP_API_URL'
+ENVVAR_AUTH_URL = 'PSH_SOP_AUTH_URL'
+ENVVAR_PROJECT = 'PSH_SOP_PROJECT'
+# set to 1 to have the cli start activities without --wait and track them the same way the native client does
+ENVVAR_POLL_ACTIVITIES = 'PSH_SOP_POLL_ACTIVITIES'
+# most requests per second we send to the API, across every thread. 0 means no limit
+ENVVAR_API_RATE = 'PSH_SOP_API_RATE'
+DEFAULT_API_URL = 'https://api.platform.sh'
+DEFAULT_AUTH_URL = 'https://auth.api.platform.sh'
+# the client id the platform cli uses when exchanging an API token
+AUTH_CLIENT_ID = 'platform-api-user'
+REQUEST_TIMEOUT = 60
+# refresh the access token a little before it actually expires
+TOKEN_EXPIRY_MARGIN = 60
+# activities are polled quickly at first, then less and less often the longer they run without logging anything
+ACTIVITY_POLL_MIN_INTERVAL = 0.5
+ACTIVITY_POLL_MAX_INTERVAL = 15
+ACTIVITY_POLL_BACKOFF = 1.5
+# activity states that mean the activity has finished
+ACTIVITY_DONE_STATES = ('complete', 'cancelled')
+
+clientsLock = threading.Lock()
+clients = {}
+rateLimiter = None
+
+
+class PshApiError(Exception):
+    """
+    Raised when an API request fails
+    """
+    def __init__(self, message, status=None):
+        super(PshApiError, self).__init__(message)
+        self.status = status
+
+
+class ActivityDeadlineError(PshApiError):
+    """
+    Raised when activities haven't finished by their deadline. They have already been cancelled
+    """
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections around so every request doesn't pay for a new TCP/TLS handshake.
+    http.client connections can't be shared between threads, so each request checks one out and returns it afterwards
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, scheme, netloc):
+        # http.client (and ssl) take longer to import than everything else we use, and only the native client needs it
+        import http.client
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if 'https' == scheme:
+            return http.client.HTTPSConnection(netloc, timeout=REQUEST_TIMEOUT)
+        return http.client.HTTPConnection(netloc, timeout=REQUEST_TIMEOUT)
+
+    def release(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+
+connectionPool = ConnectionPool()
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by every thread, so everything running at the same time stays under one request rate
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = max(rate, 1)
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """
+        Waits until we're allowed to send another request
+        :return: void
+        """
+        if 0 >= self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # taking the token even if it isn't there yet reserves our place in line
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if 0 > self.tokens else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def configureRateLimit(rate):
+    """
+    Replaces the rate limit set by PSH_SOP_API_RATE
+    :param float rate: requests per second, 0 for no limit
+    :return: void
+    """
+    global rateLimiter
+    rateLimiter = RateLimiter(rate)
+
+
+def getRateLimiter():
+    """
+    :return: RateLimiter: the limiter every request to the API goes through
+    """
+    with clientsLock:
+        if rateLimiter is None:
+            from psh_utility import getEnvNumber
+            configureRateLimit(getEnvNumber(ENVVAR_API_RATE, 0, float))
+        return rateLimiter
+
+
+def nativeClientEnabled():
+    """
+    The native client is opt-in: set PSH_SOP_API_CLIENT to 'native'
+    :return: bool
+    """
+    return 'native' == os.getenv(ENVVAR_API_CLIENT, 'cli').strip().lower()
+
+
+def getProjectID():
+    """
+    Gets the project we're working on: PSH_SOP_PROJECT if set, otherwise the project we're running in
+    :return: string
+    """
+    return os.getenv(ENVVAR_PROJECT) or os.getenv('PLATFORM_PROJECT', '')
+
+
+def pollingEnabled():
+    """
+    Whether the cli should start activities without waiting on them. The native client always does
+    :return: bool
+    """
+    return '1' == os.getenv(ENVVAR_POLL_ACTIVITIES, '0').strip()
+
+
+def getActivityClient(projectID=None):
+    """
+    Gets the client used to start and track activities: the native client if it's enabled, a cli backed client if
+    activity polling is enabled, otherwise None and the cli waits on activities itself
+    :param string projectID: project ID, defaults to getProjectID()
+    :return: PshApiClient|None
+    """
+    apiClient = getClient(projectID)
+    if apiClient or not pollingEnabled():
+        return apiClient
+
+    return CliApiClient(projectID or getProjectID(), None)
+
+
+def getClient(projectID=None):
+    """
+    Gets the shared API client for a project, if the native client is enabled
+    :param string projectID: project ID, defaults to getProjectID()
+    :return: PshApiClient|None
+    """
+    if not nativeClientEnabled():
+        return None
+
+    projectID = projectID or getProjectID()
+    with clientsLock:
+        if projectID not in clients:
+            clients[projectID] = PshApiClient(projectID, os.getenv('PLATFORMSH_CLI_TOKEN', ''))
+        return clients[projectID]
+
+
+class PshApiClient(object):
+    """
+    Minimal Platform.sh API client covering what the auto-update trigger needs. One access token exchange is shared by
+    every request until it expires
+    """
+    def __init__(self, projectID, apiToken, apiUrl=None, authUrl=None):
+        self.projectID = projectID
+        self.apiToken = apiToken
+        self.apiUrl = (apiUrl or os.getenv(ENVVAR_API_URL) or DEFAULT_API_URL).rstrip('/')
+        self.authUrl = (authUrl or os.getenv(ENVVAR_AUTH_URL) or DEFAULT_AUTH_URL).rstrip('/')
+        self.tokenLock = threading.Lock()
+        self.accessToken = None
+        self.accessTokenExpires = 0
+
+    def send(self, method, url, body=None, headers=None):
+        """
+        Sends a request over a pooled connection
+        :param string method: HTTP method
+        :param string url: full url
+        :param bytes body: request body
+        :param dict headers: request headers
+        :return: tuple: status code and decoded json (or None) response
+        """
+        import http.client
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        getRateLimiter().acquire()
+        with psh_trace.span('{} {}'.format(method, parts.path), 'request') as requestSpan:
+            # a pooled connection may have been closed by the server since we last used it, so retry once on a fresh one
+            for attempt in range(2):
+                connection = connectionPool.acquire(parts.scheme, parts.netloc)
+                try:
+                    connection.request(method, path, body=body, headers=headers or {})
+                    response = connection.getresponse()
+                    payload = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    connection.close()
+                    if attempt:
+                        raise PshApiError('{} {} failed: {}'.format(method, parts.path, e))
+                    continue
+                if response.will_close:
+                    connection.close()
+                else:
+                    connectionPool.release(parts.scheme, parts.netloc, connection)
+                break
+            requestSpan['args']['status'] = response.status
+
+        try:
+            decoded = json.loads(payload.decode('utf-8')) if payload else None
+        except ValueError:
+            decoded = None
+
+        return response.status, decoded
+
+    def getAccessToken(self, refresh=False):
+        """
+        Exchanges the API token for an access token, reusing it until it's about to expire
+        :param bool refresh: force a new exchange
+        :return: string
+        """
+        with self.tokenLock:
+            if refresh or not self.accessToken or time.time() >= self.accessTokenExpires:
+                if not self.apiToken:
+                    raise PshApiError('No API token available')
+                credentials = base64.b64encode('{}:'.format(AUTH_CLIENT_ID).encode('utf-8')).decode('ascii')
+                body = urlencode({'grant_type': 'api_token', 'api_token': self.apiToken}).encode('utf-8')
+                status, response = self.send('POST', self.authUrl + '/oauth2/token', body,
+                                             {'Authorization': 'Basic ' + credentials,
+                                              'Content-Type': 'application/x-www-form-urlencoded'})
+                if 200 != status or not response or 'access_token' not in response:
+                    raise PshApiError('Unable to exchange the API token for an access token', status)
+                self.accessToken = response['access_token']
+                self.accessTokenExpires = time.time() + int(response.get('expires_in', 900)) - TOKEN_EXPIRY_MARGIN
+
+            return self.accessToken
+
+    def request(self, method, path, data=None):
+        """
+        Sends an authenticated request to the API
+        :param string method: HTTP method
+        :param string path: path relative to the API url
+        :param dict data: json body
+        :return: decoded json response
+        """
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        for attempt in range(2):
+            headers = {'Authorization': 'Bearer ' + self.getAccessToken(refresh=bool(attempt)),
+                       'Accept': 'application/json'}
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            status, response = self.send(method, self.apiUrl + path, body, headers)
+            # our access token may have been revoked early, so get a new one and try again
+            if 401 != status:
+                break
+
+        if status >= 400:
+            message = response.get('message', response.get('title', '')) if isinstance(response, dict) else ''
+            raise PshApiError('{} {} returned {} {}'.format(method, path, status, message).strip(), status)
+
+        return response
+
+    def projectPath(self, *parts):
+        """
+        Builds the API path for something inside our project
+        :param string parts: path parts, escaped for us
+        :return: string
+        """
+        return '/projects/' + '/'.join(quote(part, safe='') for part in (self.projectID,) + parts)
+
+    def verifyToken(self):
+        """
+        Checks that our API token can be exchanged for an access token
+        :return: bool
+        """
+        try:
+            self.getAccessToken()
+        except PshApiError as e:
+            logging.debug(str(e))
+            return False
+        return True
+
+    def getEnvironments(self):
+        return self.request('GET', self.projectPath('environments')) or []
+
+    def getEnvironment(self, environment):
+        """
+        :param string environment: environment name
+        :return: dict|None: the environment, or None if it doesn't exist
+        """
+        try:
+            return self.request('GET', self.projectPath('environments', environment))
+        except PshApiError as e:
+            if 404 == e.status:
+                return None
+            raise
+
+    def getIntegrations(self):
+        return self.request('GET', self.projectPath('integrations')) or []
+
+    def getIntegration(self, integrationID):
+        return self.request('GET', self.projectPath('integrations', integrationID))
+
+    def updateIntegration(self, integrationID, data):
+        return self.request('PATCH', self.projectPath('integrations', integrationID), data)
+
+    def getActivity(self, activityID):
+        return self.request('GET', self.projectPath('activities', activityID))
+
+    def cancelActivity(self, activityID):
+        return self.request('POST', self.projectPath('activities', activityID, 'cancel'))
+
+    def runEnvironmentAction(self, environment, action, data=None):
+        """
+        Triggers an action on an environment (activate, branch, synchronize, source-operation, etc)
+        :param string environment: environment name
+        :param string action: name of the action
+        :param dict data: action parameters
+        :return: list: the activities the action started
+        """
+        response = self.request('POST', self.projectPath('environments', environment, action), data or {})
+        return ((response or {}).get('_embedded') or {}).get('activities', [])
+
+    def waitForActivities(self, activities, label=None, deadline=None):
+        """
+        Waits for activities to finish, logging their output as it arrives. Polls quickly at first and backs off while
+        nothing is happening, so short activities finish promptly and long ones don't hammer the API
+        :param list activities: activities returned by runEnvironmentAction
+        :param string label: prefix for the activity log lines
+        :param float deadline: time.time() by which the activities must finish. They're cancelled if they don't
+        :return: bool: whether every activity succeeded
+        """
+        pending = {activity['id']: activity for activity in activities}
+        logOffsets = {}
+        finished = []
+        interval = ACTIVITY_POLL_MIN_INTERVAL
+        while True:
+            progressed = False
+            for activityID, activity in list(pending.items()):
+                if self.logActivity(activity, logOffsets, label):
+                    progressed = True
+                if activity.get('state') in ACTIVITY_DONE_STATES:
+                    finished.append(pending.pop(activityID))
+            if not pending:
+                break
+
+            if deadline is not None and time.time() >= deadline:
+                for activityID in pending:
+                    try:
+                        self.cancelActivity(activityID)
+                    except PshApiError as e:
+                        logging.warning("Unable to cancel activity {}: {}".format(activityID, e))
+                raise ActivityDeadlineError('Activities {} did not finish in time and were cancelled'.format(
+                    ', '.join(pending)))
+
+            time.sleep(interval if deadline is None else max(0, min(interval, deadline - time.time())))
+            interval = ACTIVITY_POLL_MIN_INTERVAL if progressed else min(interval * ACTIVITY_POLL_BACKOFF,
+                                                                         ACTIVITY_POLL_MAX_INTERVAL)
+            for activityID in pending:
+                pending[activityID] = self.getActivity(activityID)
+
+        return all('success' == activity.get('result') for activity in finished)
+
+    def logActivity(self, activity, logOffsets, label=None):
+        """
+        Logs whatever complete lines have been added to an activity's log since we last looked
+        :param dict activity: the activity
+        :param dict logOffsets: how much of each activity's log we've already logged, updated for us
+        :param string label: prefix for the log lines
+        :return: bool: whether there was anything new
+        """
+        activityLog = activity.get('log') or ''
+        offset = logOffsets.get(activity['id'], 0)
+        # hold on to a partial last line until it's complete, unless the activity is done and it never will be
+        end = len(activityLog) if activity.get('state') in ACTIVITY_DONE_STATES else activityLog.rfind('\n') + 1
+        if end <= offset:
+            return False
+
+        for line in activityLog[offset:end].splitlines():
+            logging.info("[{}] {}".format(label, line) if label else line)
+        logOffsets[activity['id']] = end
+        return True
+
+
+class CliApiClient(PshApiClient):
+    """
+    Sends the same requests through `platform project:curl`, so the cli can start activities and track them without
+    blocking on --wait. The cli takes care of authentication
+    """
+    def request(self, method, path, data=None):
+        from psh_utility import runCommand
+        command = "platform project:curl --fail -X {} {}".format(method, shlex.quote(path))
+        if self.projectID:
+            command += " -p {}".format(shlex.quote(self.projectID))
+        if data is not None:
+            command += " -H 'Content-Type: application/json' -d {}".format(shlex.quote(json.dumps(data)))
+        getRateLimiter().acquire()
+        curlRun = runCommand(command + " 2>/dev/null", label='{} {}'.format(method, path))
+        if not curlRun['result']:
+            raise PshApiError('{} {} failed {}'.format(method, path, curlRun['message']).strip())
+
+        try:
+            return json.loads(curlRun['message']) if curlRun['message'].strip() else None
+        except ValueError:
+            raise PshApiError('{} {} returned something other than json'.format(method, path))
+
+    def projectPath(self, *parts):
+        # project:curl paths are relative to the project
+        return '/' + '/'.join(quote(part, safe='') for part in parts)
+
+    def verifyToken(self):
+        from psh_utility import runCommand
+        return runCommand("platform auth:info > /dev/null 2>&1")['result']
+
+
+def callApi(func, *args):
+    """
+    Calls an API client method and wraps the outcome the same way runCommand does, so callers can handle the native
+    client and the cli the same way
+    :param function func: client method to call
+    :param args: arguments for the method
+    :return: dict {result: boolean, message: return value|error message }
+    """
+    try:
+        return {'result': True, 'message': func(*args)}
+    except PshApiError as e:
+        return {'result': False, 'message': str(e)}
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import glob
+import hashlib
+import logging
+import os
+import py_compile
+import sys
+import tempfile
+import zipfile
+
+from psh_utility import getCacheDir, runCommand, SOURCE_OP_TOOLS_VERSION
+
+BUNDLE_SUBDIR = 'bundle'
+# names the current bundle and its checksum, in a format setup.sh can read without python: "<file name> <sha256>"
+BUNDLE_POINTER = 'current'
+# the script that becomes the bundle's __main__
+ENTRY_POINT = 'sourceOp'
+
+
+def getChecksum(path):
+    """
+    :param string path: file to checksum
+    :return: string: hex sha256 of the file
+    """
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as checksumFile:
+        for chunk in iter(lambda: checksumFile.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def addModule(bundle, sourcePath, moduleName, buildDir):
+    """
+    Adds a module's source and precompiled bytecode to the bundle. The bytecode is hash based and never checked
+    against the source, so it's used as is. A python with a different bytecode format falls back to the source
+    :param zipfile.ZipFile bundle: the bundle being built
+    :param string sourcePath: path to the module's source
+    :param string moduleName: name of the module inside the bundle
+    :param string buildDir: scratch directory for the bytecode
+    :return: void
+    """
+    pycPath = py_compile.compile(sourcePath, cfile=os.path.join(buildDir, moduleName + '.pyc'), doraise=True,
+                                 dfile=moduleName + '.py',
+                                 invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    bundle.write(sourcePath, moduleName + '.py')
+    bundle.write(pycPath, moduleName + '.pyc')
+
+
+def buildBundle(bundleDir=None):
+    """
+    Builds the toolkit into a single versioned zipapp with precompiled bytecode, records its checksum, and removes
+    older bundles
+    :param string bundleDir: where to store the bundle, defaults to our cache location
+    :return: string|bool: path to the bundle, or False if it couldn't be built
+    """
+    sourceDir = os.path.dirname(os.path.abspath(__file__))
+    bundleDir = bundleDir or getCacheDir(BUNDLE_SUBDIR)
+    os.makedirs(bundleDir, exist_ok=True)
+    commitRun = runCommand('git rev-parse --short HEAD', sourceDir)
+    revision = commitRun['message'].strip() if commitRun['result'] else 'local'
+    bundleName = 'sourceOp-{}-{}-{}.pyz'.format(SOURCE_OP_TOOLS_VERSION, revision, sys.implementation.cache_tag)
+    bundlePath = os.path.join(bundleDir, bundleName)
+
+    try:
+        with tempfile.TemporaryDirectory(dir=bundleDir) as buildDir:
+            tmpPath = os.path.join(buildDir, bundleName)
+            with zipfile.ZipFile(tmpPath, 'w', zipfile.ZIP_DEFLATED) as bundle:
+                for sourcePath in sorted(glob.glob(os.path.join(sourceDir, '*.py'))):
+                    addModule(bundle, sourcePath, os.path.splitext(os.path.basename(sourcePath))[0], buildDir)
+                addModule(bundle, os.path.join(sourceDir, ENTRY_POINT), '__main__', buildDir)
+            checksum = getChecksum(tmpPath)
+            os.replace(tmpPath, bundlePath)
+    except (OSError, py_compile.PyCompileError) as e:
+        logging.warning("Unable to build the bundle: {}".format(e))
+        return False
+
+    pointerPath = os.path.join(bundleDir, BUNDLE_POINTER)
+    with open(pointerPath + '.tmp', 'w') as pointerFile:
+        pointerFile.write('{} {}\n'.format(bundleName, checksum))
+    os.replace(pointerPath + '.tmp', pointerPath)
+
+    for oldBundle in glob.glob(os.path.join(bundleDir, 'sourceOp-*.pyz')):
+        if oldBundle != bundlePath:
+            os.remove(oldBundle)
+
+    logging.info("Built {} (sha256 {})".format(bundlePath, checksum))
+    return bundlePath
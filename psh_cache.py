@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+from psh_trace import traced
+from psh_utility import getCacheDir, getEnvNumber, readJsonFile, writeJsonFile
+
+ENVVAR_CACHE = 'PSH_SOP_CACHE'
+ENVVAR_CACHE_MAX_MB = 'PSH_SOP_CACHE_MAX_MB'
+DEFAULT_CACHE_MAX_MB = 1024
+CACHE_SUBDIR = 'package-cache'
+USAGE_FILE = 'usage.json'
+# environmental variables that point each package manager at its cache. The value is the path inside the ecosystem's
+# cache directory ('' for the directory itself)
+CACHE_ENV = {
+    'composer': {'COMPOSER_CACHE_DIR': ''},
+    'npm': {'npm_config_cache': ''},
+    'yarn': {'YARN_CACHE_FOLDER': ''},
+    'pipenv': {'PIP_CACHE_DIR': 'pip', 'PIPENV_CACHE_DIR': 'pipenv'},
+    'poetry': {'POETRY_CACHE_DIR': ''},
+    'bundler': {'BUNDLE_USER_CACHE': ''},
+    'go': {'GOMODCACHE': ''},
+}
+
+usageLock = threading.Lock()
+usedThisRun = {}
+
+
+def cacheEnabled():
+    """
+    The package cache can be turned off by setting PSH_SOP_CACHE to 0
+    :return: bool
+    """
+    return '0' != os.getenv(ENVVAR_CACHE, '1')
+
+
+def getCacheEnv(ecosystem):
+    """
+    Gets the environmental variables that point an ecosystem's package manager at our persistent cache, and records
+    that the ecosystem's cache was used for eviction purposes
+    :param string ecosystem: ecosystem name from the updaters table
+    :return: dict: environmental variables to add to the updater's environment
+    """
+    if not cacheEnabled() or ecosystem not in CACHE_ENV:
+        return {}
+
+    ecosystemDir = getCacheDir(CACHE_SUBDIR, ecosystem)
+    cacheEnv = {}
+    for envVar, subPath in CACHE_ENV[ecosystem].items():
+        cacheEnv[envVar] = os.path.join(ecosystemDir, subPath) if subPath else ecosystemDir
+
+    if 'go' == ecosystem:
+        # the go module cache is read-only by default, which would stop us from ever evicting it
+        cacheEnv['GOFLAGS'] = ' '.join(filter(None, [os.getenv('GOFLAGS', ''), '-modcacherw']))
+
+    with usageLock:
+        usedThisRun[ecosystem] = time.time()
+
+    return cacheEnv
+
+
+def getDirectorySize(path):
+    """
+    Adds up the disk space used by everything inside a directory, without following symlinks
+    :param string path: directory to measure
+    :return: int: size in bytes
+    """
+    total = 0
+    toVisit = [path]
+    while toVisit:
+        try:
+            entries = list(os.scandir(toVisit.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    toVisit.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+            except OSError:
+                continue
+
+    return total
+
+
+def removeDirectory(path):
+    """
+    Removes a cache directory, even if the package manager left read-only files/directories behind
+    :param string path: directory to remove
+    :return: void
+    """
+    def makeWritable(func, failedPath, excInfo):
+        os.chmod(os.path.dirname(failedPath), stat.S_IRWXU)
+        if os.path.lexists(failedPath) and not os.path.islink(failedPath):
+            os.chmod(failedPath, stat.S_IRWXU)
+        func(failedPath)
+
+    shutil.rmtree(path, onerror=makeWritable)
+
+
+@traced('package cache budget')
+def enforceCacheBudget():
+    """
+    Keeps the package cache under PSH_SOP_CACHE_MAX_MB by evicting the least recently used ecosystem caches first.
+    Needs to run when no updater is using the cache
+    :return: void
+    """
+    if not cacheEnabled():
+        return
+
+    cacheRoot = getCacheDir(CACHE_SUBDIR)
+    usagePath = os.path.join(cacheRoot, USAGE_FILE)
+    usage = readJsonFile(usagePath, {})
+    with usageLock:
+        usage.update(usedThisRun)
+
+    budget = int(getEnvNumber(ENVVAR_CACHE_MAX_MB, DEFAULT_CACHE_MAX_MB, float) * 1024 * 1024)
+
+    caches = []
+    for entry in os.scandir(cacheRoot):
+        if entry.is_dir(follow_symlinks=False):
+            # a cache we have no record of counts as last used when it was last modified
+            lastUsed = usage.get(entry.name, entry.stat(follow_symlinks=False).st_mtime)
+            caches.append((lastUsed, entry.name, getDirectorySize(entry.path)))
+
+    totalSize = sum(size for lastUsed, name, size in caches)
+    logging.info("Package cache is using {:.1f}MB of its {:.1f}MB budget.".format(totalSize / 1048576.0,
+                                                                                 budget / 1048576.0))
+    for lastUsed, name, size in sorted(caches):
+        if totalSize <= budget:
+            break
+        if 0 == size:
+            continue
+        logging.info("Evicting the {} package cache ({:.1f}MB)...".format(name, size / 1048576.0))
+        try:
+            removeDirectory(os.path.join(cacheRoot, name))
+        except OSError as e:
+            logging.warning("Unable to evict the {} package cache: {}".format(name, e))
+            continue
+        usage.pop(name, None)
+        totalSize -= size
+
+    writeJsonFile(usagePath, usage)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import logging
+import os
+import time
+from urllib.parse import quote
+
+from psh_utility import getCacheDir, readJsonFile, writeJsonFile
+
+CHECKPOINT_SUBDIR = 'checkpoints'
+LAST_RUN_SUBDIR = 'last-runs'
+# bump whenever the structure of a checkpoint changes so we never resume from one written by an older version
+CHECKPOINT_VERSION = 1
+
+
+def getStatePath(subdir, projectID, updateBranchName):
+    """
+    :param string subdir: kind of state
+    :param string projectID: project the state belongs to
+    :param string updateBranchName: update branch the state belongs to
+    :return: string: full path to the state file
+    """
+    fileName = '{}-{}.json'.format(projectID or 'default', quote(updateBranchName, safe=''))
+    return os.path.join(getCacheDir(subdir), fileName)
+
+
+def readLastRun(projectID, updateBranchName):
+    """
+    :param string projectID: project the run was for
+    :param string updateBranchName: update branch the run was for
+    :return: dict: what recordLastRun recorded, empty if there's nothing recorded
+    """
+    lastRun = readJsonFile(getStatePath(LAST_RUN_SUBDIR, projectID, updateBranchName), {})
+    return lastRun if isinstance(lastRun, dict) else {}
+
+
+def recordLastRun(projectID, updateBranchName, **details):
+    """
+    Records the outcome of a trigger run (production and update branch heads, whether the source operation found
+    anything to update, etc), replacing whatever was recorded for the previous one
+    :param string projectID: project the run was for
+    :param string updateBranchName: update branch the run was for
+    :param details: what to record
+    :return: bool
+    """
+    details['finished'] = time.time()
+    return writeJsonFile(getStatePath(LAST_RUN_SUBDIR, projectID, updateBranchName), details)
+
+
+class TriggerCheckpoint(object):
+    """
+    The progress of a trigger run for one update branch, written to disk after every step so a run that fails or gets
+    killed part way through can be picked up where it left off
+    """
+    def __init__(self, projectID, updateBranchName):
+        self.path = getStatePath(CHECKPOINT_SUBDIR, projectID, updateBranchName)
+        state = readJsonFile(self.path, {})
+        if not isinstance(state, dict) or CHECKPOINT_VERSION != state.get('version'):
+            state = {}
+        self.state = state
+
+    @property
+    def steps(self):
+        """
+        :return: list: the steps completed so far, in the order they were completed
+        """
+        return self.state.get('steps', [])
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def isComplete(self, step):
+        return step in self.steps
+
+    def update(self, **values):
+        """
+        Records values and writes the checkpoint
+        :param values: what to record
+        :return: bool
+        """
+        self.state.update(values)
+        self.state.setdefault('started', time.time())
+        self.state['version'] = CHECKPOINT_VERSION
+        self.state['updated'] = time.time()
+        return writeJsonFile(self.path, self.state)
+
+    def complete(self, step, **values):
+        """
+        Marks a step as completed and writes the checkpoint
+        :param string step: name of the step
+        :param values: anything else to record along with it
+        :return: bool
+        """
+        values['steps'] = [completed for completed in self.steps if completed != step] + [step]
+        return self.update(**values)
+
+    def clear(self):
+        """
+        Forgets the checkpoint once the run it belongs to has finished
+        :return: void
+        """
+        self.state = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.debug("Unable to remove checkpoint {}: {}".format(self.path, e))
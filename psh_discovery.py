@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import fnmatch
+import logging
+import os
+
+from psh_trace import traced
+from psh_utility import getCacheDir, readJsonFile, writeJsonFile
+
+# Directories that never contain an app root but can contain hundreds of thousands of directories. Entries without a
+# slash are matched against the directory name, entries with a slash against the path relative to the project root
+DEFAULT_IGNORE_DIRS = ['.git', '.hg', '.svn', 'node_modules', 'bower_components', 'vendor', '.venv', 'venv',
+                       '__pycache__', '.tox', '.bundle', '.cache', 'pkg/mod', '*/pkg/mod']
+ENVVAR_IGNORE_DIRS = 'PSH_SOP_DISCOVERY_IGNORE'
+ENVVAR_USE_INDEX = 'PSH_SOP_DISCOVERY_INDEX'
+INDEX_FILE = 'discovery-index.json'
+# bump whenever the structure of the index changes so we never try to use an index written by an older version
+INDEX_VERSION = 1
+
+
+def getIgnoreDirs():
+    """
+    Builds the list of directories we skip while looking for apps. The environmental variable PSH_SOP_DISCOVERY_IGNORE
+    can contain a comma separated list of additional names/paths to skip. Prefixing an entry with ! removes it from the
+    defaults (ie `!vendor` if you really do keep an app inside a vendor directory)
+    :return: list: directory names/paths to ignore
+    """
+    ignoreDirs = list(DEFAULT_IGNORE_DIRS)
+    for entry in os.getenv(ENVVAR_IGNORE_DIRS, '').split(','):
+        entry = entry.strip().strip('/')
+        if not entry:
+            continue
+        if entry.startswith('!'):
+            if entry[1:] in ignoreDirs:
+                ignoreDirs.remove(entry[1:])
+        elif entry not in ignoreDirs:
+            ignoreDirs.append(entry)
+
+    return ignoreDirs
+
+
+def isIgnored(name, relPath, ignoreDirs):
+    """
+    Checks a directory against the ignore list
+    :param string name: directory name
+    :param string relPath: path of the directory relative to the project root, using / as the separator
+    :param list ignoreDirs: names/paths to ignore
+    :return: bool
+    """
+    for pattern in ignoreDirs:
+        if '/' in pattern:
+            if fnmatch.fnmatchcase(relPath, pattern):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+
+    return False
+
+
+def scanDirectory(fullPath, relPath, manifests, appFile, ignoreDirs):
+    """
+    Reads a single directory and records what we need to know about it
+    :param string fullPath: full path to the directory
+    :param string relPath: path relative to the project root ('' for the root itself)
+    :param set manifests: dependency management file names we're looking for
+    :param string appFile: file name that marks the root of an app
+    :param list ignoreDirs: names/paths to skip
+    :return: dict: {appRoot: bool, matches: [manifest file names], subdirs: [directory names to descend into]}
+    """
+    matches = []
+    subdirs = []
+    appRoot = False
+    with os.scandir(fullPath) as entries:
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                continue
+
+            if not isDir:
+                if entry.name == appFile:
+                    appRoot = True
+                elif entry.name in manifests:
+                    matches.append(entry.name)
+            elif not entry.is_symlink():
+                # os.walk doesn't follow symlinked directories by default, so neither do we
+                subRelPath = '/'.join((relPath, entry.name)) if relPath else entry.name
+                if not isIgnored(entry.name, subRelPath, ignoreDirs):
+                    subdirs.append(entry.name)
+
+    return {'appRoot': appRoot, 'matches': sorted(matches), 'subdirs': sorted(subdirs)}
+
+
+@traced('dependency discovery')
+def findDependencyFiles(projectPath, manifests, appFile, ignoreDirs=None, useIndex=None):
+    """
+    Locates the dependency management files that live alongside an app file (.platform.app.yaml). Skips directories
+    that can't contain an app (.git, node_modules, vendor, etc) and stops descending as soon as it finds an app root.
+    A directory's mtime only changes when an entry is added, removed or renamed inside it, so we keep an index of what
+    we found keyed on each directory's mtime and only re-read the directories that have changed since the last run
+    :param string projectPath: full path to the project
+    :param list manifests: dependency management file names we're looking for
+    :param string appFile: file name that marks the root of an app
+    :param list ignoreDirs: names/paths to skip. Defaults to getIgnoreDirs()
+    :param bool useIndex: whether to use the persisted index. Defaults to the PSH_SOP_DISCOVERY_INDEX env var (on)
+    :return: list: paths to dependency management files, relative to projectPath
+    """
+    if ignoreDirs is None:
+        ignoreDirs = getIgnoreDirs()
+    if useIndex is None:
+        useIndex = '0' != os.getenv(ENVVAR_USE_INDEX, '1')
+
+    manifests = set(manifests)
+    # the index is only valid for the exact same search
+    indexKey = {'version': INDEX_VERSION, 'root': os.path.abspath(projectPath), 'appFile': appFile,
+                'manifests': sorted(manifests), 'ignore': sorted(ignoreDirs)}
+    indexPath = os.path.join(getCacheDir(), INDEX_FILE) if useIndex else None
+    cachedDirs = {}
+    if indexPath:
+        index = readJsonFile(indexPath, {})
+        if isinstance(index, dict) and index.get('key') == indexKey:
+            cachedDirs = index.get('dirs', {})
+
+    updateFiles = []
+    scannedDirs = {}
+    rescanned = 0
+    toVisit = ['']
+    while toVisit:
+        relPath = toVisit.pop()
+        fullPath = os.path.join(projectPath, *relPath.split('/')) if relPath else projectPath
+        try:
+            mtime = os.stat(fullPath).st_mtime_ns
+        except OSError:
+            continue
+
+        dirInfo = cachedDirs.get(relPath)
+        if dirInfo is None or dirInfo.get('mtime') != mtime:
+            try:
+                dirInfo = scanDirectory(fullPath, relPath, manifests, appFile, ignoreDirs)
+            except OSError as e:
+                logging.debug("Unable to read directory {}: {}".format(fullPath, e))
+                continue
+            dirInfo['mtime'] = mtime
+            rescanned += 1
+
+        scannedDirs[relPath] = dirInfo
+        if dirInfo['appRoot']:
+            # an app can't contain another app, so there's no need to go any deeper
+            dirpath = os.path.join(*relPath.split('/')) if relPath else ''
+            updateFiles += [os.path.join(dirpath, file) for file in dirInfo['matches']]
+            continue
+
+        # reversed so we pop (and therefore visit) subdirectories in alphabetical order
+        toVisit += ['/'.join((relPath, subdir)) if relPath else subdir for subdir in reversed(dirInfo['subdirs'])]
+
+    logging.info("Searched {} directories for dependency files ({} changed since the last search).".format(
+        len(scannedDirs), rescanned))
+
+    if indexPath and (rescanned or len(scannedDirs) != len(cachedDirs)):
+        writeJsonFile(indexPath, {'key': indexKey, 'dirs': scannedDirs})
+
+    return updateFiles
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import logging
+import shlex
+
+from psh_logging import outputError
+from psh_trace import traced
+from psh_utility import runCommand
+
+
+def parsePorcelainStatus(statusOutput):
+    """
+    Parses the output of `git status --porcelain -z` into the set of paths that have changed. With -z, paths are never
+    quoted and renames/copies are followed by an extra field containing the original path
+    :param string statusOutput: raw output from git status
+    :return: set: changed paths, relative to the repository root
+    """
+    paths = set()
+    entries = statusOutput.split('\0')
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        if len(entry) < 4:
+            continue
+        statusCode, path = entry[:2], entry[3:]
+        paths.add(path)
+        if 'R' in statusCode or 'C' in statusCode:
+            # skip over the original path of the rename/copy
+            i += 1
+
+    return paths
+
+
+@traced('git status')
+def getStatusSnapshot(repoPath):
+    """
+    Takes a single snapshot of everything that has changed in the working tree
+    :param string repoPath: path to the repository (or a subdirectory of it)
+    :return: set|None: changed paths relative to repoPath, or None if we couldn't get the status
+    """
+    # porcelain paths are always relative to the repository root, so we also need to know where repoPath sits inside
+    # the repository. Both in one shell so it's still one subprocess
+    command = 'git rev-parse --show-prefix && git status --porcelain -z --untracked-files=all'
+    procStatus = runCommand(command, repoPath)
+    if not procStatus['result']:
+        outputError('git status', procStatus['message'])
+        return None
+
+    prefix, _, statusOutput = procStatus['message'].partition('\n')
+    prefix = prefix.strip()
+    paths = set()
+    for path in parsePorcelainStatus(statusOutput):
+        if path.startswith(prefix):
+            paths.add(path[len(prefix):])
+
+    return paths
+
+
+def filterChangedPaths(snapshot, pathspecs):
+    """
+    Diffs a status snapshot against a list of paths we care about
+    :param set snapshot: changed paths from getStatusSnapshot
+    :param list pathspecs: exact paths, relative to the same location as the snapshot
+    :return: list: the pathspecs that have changed, in the order given
+    """
+    return [path for path in pathspecs if path in snapshot]
+
+
+@traced('git add')
+def stagePaths(repoPath, paths):
+    """
+    Stages every given path with a single `git add`
+    :param string repoPath: path to the repository
+    :param list paths: paths relative to repoPath
+    :return: bool
+    """
+    if not paths:
+        return True
+
+    command = 'git add -- {}'.format(' '.join(shlex.quote(path) for path in paths))
+    procAdd = runCommand(command, repoPath)
+    if not procAdd['result']:
+        return outputError('git add', procAdd['message'])
+
+    return True
+
+
+@traced('git commit')
+def commit(repoPath, message):
+    """
+    Commits whatever is staged
+    :param string repoPath: path to the repository
+    :param string message: commit message
+    :return: bool
+    """
+    procCommit = runCommand('git commit -m {}'.format(shlex.quote(message)), repoPath)
+    if not procCommit['result']:
+        return outputError('git commit', procCommit['message'])
+
+    logging.info("Changes successfully committed.")
+    return True
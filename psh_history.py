@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+import logging
+import math
+import os
+import sqlite3
+import statistics
+import time
+from contextlib import closing
+
+import psh_trace
+from psh_utility import getCacheDir, getEnvNumber, SOURCE_OP_TOOLS_VERSION
+
+ENVVAR_HISTORY = 'PSH_SOP_HISTORY'
+# how much slower than its baseline (0.5 == 50%) a phase has to be to count as a regression
+ENVVAR_REGRESSION_THRESHOLD = 'PSH_SOP_REGRESSION_THRESHOLD'
+DEFAULT_REGRESSION_THRESHOLD = 0.5
+# how many of the previous runs make up a phase's baseline
+ENVVAR_BASELINE_RUNS = 'PSH_SOP_BASELINE_RUNS'
+DEFAULT_BASELINE_RUNS = 20
+# phases this short are too noisy to call a regression, however much slower they got
+REGRESSION_MIN_SECONDS = 1.0
+# how many of the most recent runs `sourceOp stats` checks for regressions
+STATS_RECENT_RUNS = 10
+# runs we keep per command, the oldest are removed first
+HISTORY_MAX_RUNS = 1000
+HISTORY_FILE = 'history.sqlite'
+# the categories of span we record, commands and requests are too many to keep for every run
+RECORDED_CATEGORIES = ('phase', 'updater', 'project', 'shard')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    result INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    changed_lock_files INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER,
+    skipped INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_command ON runs (command, started);
+CREATE INDEX IF NOT EXISTS phases_run ON phases (run_id);
+"""
+
+# details of the current run that aren't in its trace (ie how many lock files changed), see setRunDetail()
+runDetails = {}
+
+
+def historyEnabled():
+    """
+    The history can be turned off by setting PSH_SOP_HISTORY to 0
+    :return: bool
+    """
+    return '0' != os.getenv(ENVVAR_HISTORY, '1').strip()
+
+
+def connect():
+    """
+    :return: sqlite3.Connection: the history database, created if needed
+    """
+    connection = sqlite3.connect(os.path.join(getCacheDir(), HISTORY_FILE), timeout=30)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.executescript(SCHEMA)
+    # histories recorded before updaters skipped by their probe were told apart don't have the column yet
+    if 'skipped' not in [column[1] for column in connection.execute('PRAGMA table_info(phases)')]:
+        connection.execute('ALTER TABLE phases ADD COLUMN skipped INTEGER')
+    return connection
+
+
+def setRunDetail(key, value):
+    """
+    Records a detail of the current run for recordRun()
+    :param string key: changedLockFiles
+    :param value: its value
+    :return: void
+    """
+    runDetails[key] = value
+
+
+def recordRun(command, result, started):
+    """
+    Adds the run that just finished to the history: its outcome, and how long each of its phases and updaters took
+    :param string command: the sourceOp command that ran (ie sop-autoupdate)
+    :param bool result: whether it succeeded
+    :param float started: time.time() when it started
+    :return: bool
+    """
+    if not historyEnabled():
+        return True
+
+    spans = psh_trace.getSpans()
+    # updaters' commands are labelled after the updater, which is how we find their exit code
+    exitCodes = {record['name']: record['args'].get('exitCode') for record in spans if 'command' == record['cat']}
+    try:
+        with closing(connect()) as connection, connection:
+            cursor = connection.execute(
+                'INSERT INTO runs (command, started, duration, result, version, changed_lock_files) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (command, started, time.time() - started, int(result is not False), SOURCE_OP_TOOLS_VERSION,
+                 runDetails.get('changedLockFiles')))
+            connection.executemany(
+                'INSERT INTO phases (run_id, name, category, duration, exit_code, skipped) VALUES (?, ?, ?, ?, ?, ?)',
+                [(cursor.lastrowid, record['name'], record['cat'], record['duration'],
+                  exitCodes.get(record['name']) if 'updater' == record['cat'] else None,
+                  int(bool(record['args'].get('skipped'))) if 'updater' == record['cat'] else None)
+                 for record in spans if record['cat'] in RECORDED_CATEGORIES])
+            connection.execute(
+                'DELETE FROM runs WHERE command = ? AND id NOT IN '
+                '(SELECT id FROM runs WHERE command = ? ORDER BY started DESC LIMIT ?)',
+                (command, command, HISTORY_MAX_RUNS))
+    except sqlite3.Error as e:
+        # the history is nice to have, never a reason to fail a run
+        logging.warning("Unable to record this run in the history: {}".format(e))
+        return False
+
+    return True
+
+
+def getUpdaterHistory(command, baselineRuns):
+    """
+    Looks up how long each updater took in the most recent runs, and when it last ran to completion. An updater that
+    was stopped (ie by a timeout) has a negative exit code, it didn't get to update anything. One that its probe
+    skipped only took as long as the probe, so that says nothing about how long an update takes, but it did find the
+    lock file up to date, so it counts as completed
+    :param string command: the sourceOp command whose runs to look at (ie sop-autoupdate)
+    :param int baselineRuns: how many of the most recent runs to take durations from
+    :return: dict: updater (its dependency file) => {durations: seconds of the runs it completed, newest first,
+        stoppedAfter: the longest it ran before being stopped, or 0, lastCompleted: time.time() of the last run it
+        completed or was skipped, or None}. Empty if the history is off or can't be read
+    """
+    if not historyEnabled():
+        return {}
+
+    updaters = {}
+    try:
+        with closing(connect()) as connection:
+            for name, duration, exitCode, skipped in connection.execute(
+                    'SELECT phases.name, phases.duration, phases.exit_code, phases.skipped FROM phases '
+                    'JOIN runs ON runs.id = phases.run_id WHERE phases.category = ? AND runs.id IN '
+                    '(SELECT id FROM runs WHERE command = ? ORDER BY started DESC LIMIT ?) ORDER BY runs.started DESC',
+                    ('updater', command, baselineRuns)):
+                updater = updaters.setdefault(name, {'durations': [], 'stoppedAfter': 0, 'lastCompleted': None})
+                if exitCode is not None and 0 > exitCode:
+                    updater['stoppedAfter'] = max(updater['stoppedAfter'], duration)
+                elif not skipped:
+                    updater['durations'].append(duration)
+            for name, started in connection.execute(
+                    'SELECT phases.name, MAX(runs.started) FROM phases JOIN runs ON runs.id = phases.run_id '
+                    'WHERE phases.category = ? AND runs.command = ? '
+                    'AND (phases.exit_code IS NULL OR phases.exit_code >= 0) GROUP BY phases.name',
+                    ('updater', command)):
+                updaters.setdefault(name, {'durations': [], 'stoppedAfter': 0, 'lastCompleted': None})[
+                    'lastCompleted'] = started
+    except sqlite3.Error as e:
+        logging.warning("Unable to read the history: {}".format(e))
+        return {}
+
+    return updaters
+
+
+def percentile(values, fraction):
+    """
+    :param list values: numbers
+    :param float fraction: 0.5 for the median, 0.9 for the 90th percentile, etc
+    :return: float: the nearest-rank percentile
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered), math.ceil(fraction * len(ordered))) - 1)]
+
+
+def findRegressions(runs, phaseDurations, baselineRuns, threshold):
+    """
+    Compares every phase of the most recent runs against its median over the runs before it
+    :param list runs: (id, started) of a command's runs, oldest first
+    :param dict phaseDurations: run id => {phase name: seconds}
+    :param int baselineRuns: how many previous runs make up the baseline
+    :param float threshold: how much slower than the baseline counts as a regression (0.5 == 50%)
+    :return: list: (run id, started, phase, seconds, baseline seconds)
+    """
+    regressions = []
+    for index in range(max(1, len(runs) - STATS_RECENT_RUNS), len(runs)):
+        runID, started = runs[index]
+        previous = [phaseDurations.get(previousID, {}) for previousID, _ in runs[max(0, index - baselineRuns):index]]
+        for phase, seconds in sorted(phaseDurations.get(runID, {}).items()):
+            history = [durations[phase] for durations in previous if phase in durations]
+            if not history:
+                continue
+            baseline = statistics.median(history)
+            if seconds > baseline * (1 + threshold) and seconds - baseline >= REGRESSION_MIN_SECONDS:
+                regressions.append((runID, started, phase, seconds, baseline))
+    return regressions
+
+
+def showStats(command=None):
+    """
+    Logs, per command, how often runs succeed, percentiles of how long they and their phases take, how the latest runs
+    compare to the ones before them, and which recent runs had a phase regress beyond PSH_SOP_REGRESSION_THRESHOLD
+    against its rolling baseline
+    :param string command: only show this command
+    :return: bool
+    """
+    threshold = getEnvNumber(ENVVAR_REGRESSION_THRESHOLD, DEFAULT_REGRESSION_THRESHOLD, float)
+    baselineRuns = max(1, getEnvNumber(ENVVAR_BASELINE_RUNS, DEFAULT_BASELINE_RUNS))
+    try:
+        with closing(connect()) as connection:
+            commands = [row[0] for row in connection.execute('SELECT DISTINCT command FROM runs ORDER BY command')
+                        if command in (None, row[0])]
+            if not commands:
+                logging.info("No runs recorded yet.")
+                return True
+
+            for commandName in commands:
+                runs = connection.execute('SELECT id, started, duration, result, version, changed_lock_files '
+                                          'FROM runs WHERE command = ? ORDER BY started', (commandName,)).fetchall()
+                phaseDurations = {}
+                for runID, name, duration in connection.execute(
+                        'SELECT phases.run_id, phases.name, SUM(phases.duration) FROM phases '
+                        'JOIN runs ON runs.id = phases.run_id WHERE runs.command = ? '
+                        'GROUP BY phases.run_id, phases.name', (commandName,)):
+                    phaseDurations.setdefault(runID, {})[name] = duration
+                reportCommand(commandName, runs, phaseDurations, baselineRuns, threshold)
+    except sqlite3.Error as e:
+        logging.warning("Unable to read the history: {}".format(e))
+        return False
+
+    return True
+
+
+def reportCommand(command, runs, phaseDurations, baselineRuns, threshold):
+    """
+    Logs the stats of one command, see showStats()
+    :param string command: the command
+    :param list runs: its rows from the runs table, oldest first
+    :param dict phaseDurations: run id => {phase name: seconds}
+    :param int baselineRuns: how many previous runs make up the baseline
+    :param float threshold: how much slower than the baseline counts as a regression
+    :return: void
+    """
+    durations = [run[2] for run in runs]
+    succeeded = len([run for run in runs if run[3]])
+    rowFormat = "{:<60} {:>6} {:>8} {:>8} {:>8} {:>8}"
+    rows = [rowFormat.format('Phase', 'Runs', 'p50', 'p90', 'p99', 'Trend'),
+            rowFormat.format('(whole run)', len(runs), *formatStats(durations, baselineRuns))]
+    phases = sorted(set(phase for durationsByPhase in phaseDurations.values() for phase in durationsByPhase))
+    for phase in phases:
+        phaseHistory = [phaseDurations[run[0]][phase] for run in runs if phase in phaseDurations.get(run[0], {})]
+        rows.append(rowFormat.format(phase[:60], len(phaseHistory), *formatStats(phaseHistory, baselineRuns)))
+
+    changedLockFiles = [run[5] for run in runs[-baselineRuns:] if run[5] is not None]
+    logging.info("{}: {} run(s), {:.0%} succeeded, latest v{}{}\n{}".format(
+        command, len(runs), succeeded / len(runs), runs[-1][4],
+        ', {:.1f} lock file(s) changed per run recently'.format(statistics.mean(changedLockFiles))
+        if changedLockFiles else '', '\n'.join(rows)))
+
+    for runID, started, phase, seconds, baseline in findRegressions([(run[0], run[1]) for run in runs],
+                                                                    phaseDurations, baselineRuns, threshold):
+        logging.warning("Run {} ({}) regressed: {} took {:.1f}s against a baseline of {:.1f}s (+{:.0%})".format(
+            runID, time.strftime('%Y-%m-%d %H:%M', time.localtime(started)), phase, seconds, baseline,
+            seconds / baseline - 1 if baseline else 0))
+
+
+def formatStats(durations, baselineRuns):
+    """
+    :param list durations: seconds, oldest first
+    :param int baselineRuns: how many runs make up the window the trend compares
+    :return: list: p50, p90, p99 and the trend (median of the latest runs against the ones before them)
+    """
+    stats = ['{:.2f}'.format(percentile(durations, fraction)) for fraction in (0.5, 0.9, 0.99)]
+    recent = durations[-baselineRuns:]
+    earlier = durations[-2 * baselineRuns:-baselineRuns]
+    if recent and earlier and statistics.median(earlier):
+        stats.append('{:+.0%}'.format(statistics.median(recent) / statistics.median(earlier) - 1))
+    else:
+        stats.append('')
+    return stats
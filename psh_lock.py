@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+import fcntl
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from psh_trace import span
+from psh_utility import getCacheDir, getEnvNumber, readJsonFile, writeJsonFile
+
+# seconds to wait for a run already in progress to finish before handing our run over to it. 0 means don't wait
+ENVVAR_LOCK_WAIT = 'PSH_SOP_LOCK_WAIT'
+# seconds after which a lock is considered abandoned even if the process holding it still seems to be alive
+ENVVAR_LOCK_STALE = 'PSH_SOP_LOCK_STALE'
+DEFAULT_LOCK_STALE = 21600
+LOCK_SUBDIR = 'locks'
+LOCK_POLL_INTERVAL = 1
+
+
+def getLockPath(name, extension):
+    """
+    :param string name: name of the lock
+    :param string extension: lock, pending or guard
+    :return: string: full path to one of the lock's files
+    """
+    return os.path.join(getCacheDir(LOCK_SUBDIR), '{}.{}'.format(quote(name, safe=''), extension))
+
+
+@contextmanager
+def lockGuard(name):
+    """
+    Serializes everything that reads or changes a lock's files, across processes
+    :param string name: name of the lock
+    :return: void
+    """
+    with open(getLockPath(name, 'guard'), 'a') as guardFile:
+        fcntl.flock(guardFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(guardFile, fcntl.LOCK_UN)
+
+
+def isStale(holder):
+    """
+    A lock is stale if the process holding it is gone (or it doesn't say which one it is), or it has been held for
+    longer than PSH_SOP_LOCK_STALE
+    :param dict holder: what the lock's owner recorded
+    :return: bool
+    """
+    if time.time() - holder.get('acquired', 0) > getEnvNumber(ENVVAR_LOCK_STALE, DEFAULT_LOCK_STALE, float):
+        return True
+    pid = holder.get('pid')
+    # every owner records its pid, so without a usable one the lock was never properly taken. os.kill(0, 0) would
+    # signal our own process group and always succeed
+    if not isinstance(pid, int) or isinstance(pid, bool) or 0 >= pid:
+        return True
+    # we can only check on processes running on the same host
+    if socket.gethostname() != holder.get('host'):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # it exists, it just isn't ours
+        pass
+    return False
+
+
+def acquireLock(name):
+    """
+    Tries to take a lock, breaking it if it was abandoned
+    :param string name: name of the lock
+    :return: tuple: (token, None) if we got the lock, (None, holder details) if somebody else has it
+    """
+    lockPath = getLockPath(name, 'lock')
+    with lockGuard(name):
+        holder = readJsonFile(lockPath)
+        if isinstance(holder, dict):
+            if not isStale(holder):
+                return None, holder
+            logging.warning("Breaking the stale {} lock held by pid {} on {} since {}".format(
+                name, holder.get('pid'), holder.get('host'), time.ctime(holder.get('acquired', 0))))
+
+        token = uuid.uuid4().hex
+        writeJsonFile(lockPath, {'token': token, 'pid': os.getpid(), 'host': socket.gethostname(),
+                                 'acquired': time.time()})
+        return token, None
+
+
+def releaseLock(name, token):
+    """
+    Releases a lock, as long as it's still ours
+    :param string name: name of the lock
+    :param string token: what acquireLock returned
+    :return: void
+    """
+    lockPath = getLockPath(name, 'lock')
+    with lockGuard(name):
+        holder = readJsonFile(lockPath)
+        if isinstance(holder, dict) and token == holder.get('token'):
+            os.remove(lockPath)
+
+
+def requestFollowUp(name):
+    """
+    Asks whoever holds the lock to run once more when they're done
+    :param string name: name of the lock
+    :return: int: how many runs are now waiting on that follow-up
+    """
+    pendingPath = getLockPath(name, 'pending')
+    with lockGuard(name):
+        pending = readJsonFile(pendingPath, {})
+        requests = (pending.get('requests', 0) if isinstance(pending, dict) else 0) + 1
+        writeJsonFile(pendingPath, {'requests': requests, 'requested': time.time()})
+        return requests
+
+
+def takeFollowUp(name):
+    """
+    Clears the follow-up requests made so far
+    :param string name: name of the lock
+    :return: int: how many requests there were
+    """
+    pendingPath = getLockPath(name, 'pending')
+    with lockGuard(name):
+        pending = readJsonFile(pendingPath)
+        if not isinstance(pending, dict):
+            return 0
+        os.remove(pendingPath)
+        return pending.get('requests', 0)
+
+
+def runSingleFlight(name, func):
+    """
+    Makes sure only one run of func happens at a time for a given name. If one is already running, our run is handed
+    over to it: it runs once more when it's done, no matter how many runs were handed over in the meantime
+    :param string name: name of the lock, ie the project and update branch
+    :param function func: what to run
+    :return: the return value of func's last run, or True if our run was handed over to a run already in progress
+    """
+    lockWait = getEnvNumber(ENVVAR_LOCK_WAIT, 0, float)
+    with span('lock wait'):
+        token, holder = acquireLock(name)
+        if holder and 0 < lockWait:
+            logging.info("Waiting up to {} seconds for the run started by pid {} on {} at {} to finish...".format(
+                lockWait, holder.get('pid'), holder.get('host'), time.ctime(holder.get('acquired', 0))))
+            deadline = time.time() + lockWait
+            waitStart = time.time()
+            while holder and time.time() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                token, holder = acquireLock(name)
+            if token:
+                logging.info("The previous run finished after {:.0f} seconds.".format(time.time() - waitStart))
+
+    if holder:
+        requests = requestFollowUp(name)
+        # the run in progress may have finished between us failing to get the lock and asking it for a follow-up, in
+        # which case nobody would see the request but us
+        token, holder = acquireLock(name)
+        if holder:
+            logging.info("A run started by pid {} on {} at {} is still in progress. It will run once more when it's "
+                         "finished ({} run(s) handed over to it so far).".format(
+                             holder.get('pid'), holder.get('host'), time.ctime(holder.get('acquired', 0)), requests))
+            return True
+
+    while True:
+        try:
+            # anything requested before we start is covered by this run
+            takeFollowUp(name)
+            result = func()
+        finally:
+            releaseLock(name, token)
+
+        requests = takeFollowUp(name)
+        if not requests:
+            return result
+
+        token, holder = acquireLock(name)
+        if holder:
+            # somebody else got in first. Put the requests back so they're handled by that run
+            requestFollowUp(name)
+            return result
+        logging.info("{} run(s) were requested while we were busy. Running once more for all of them.".format(
+            requests))
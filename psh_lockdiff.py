@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+import io
+import json
+import logging
+import os
+import re
+import subprocess
+
+from psh_trace import span, traced
+from psh_utility import getCacheDir, writeJsonFile
+
+# where the report of every package that changed is written. Defaults to lockfile-changes.json in our cache location
+ENVVAR_CHANGE_REPORT = 'PSH_SOP_CHANGE_REPORT'
+CHANGE_REPORT_FILE = 'lockfile-changes.json'
+# how many package changes per lock file we list in the commit message. The report always has all of them
+COMMIT_MESSAGE_CHANGES = 50
+# lock files can be tens of MB, so we never hold more than a chunk of one in memory
+READ_CHUNK_SIZE = 64 * 1024
+
+# a json string, a structural character, or a bare scalar (number, true, false, null), after optional whitespace
+JSON_TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([{}\[\]:,])|([^\s{}\[\]:,"]+))')
+YARN_VERSION = re.compile(r'^\s+version:?\s+"?([^"\s]+)"?\s*$')
+GEMFILE_SPEC = re.compile(r'^    (\S+) \(([^)]+)\)\s*$')
+TOML_STRING = re.compile(r'^(name|version)\s*=\s*"([^"]*)"')
+
+
+def iterJsonScalars(stream):
+    """
+    Reads a json document a chunk at a time, yielding every scalar value along with the path of keys (or array
+    indexes) leading to it. Memory use depends on how deeply the document is nested, not on how big it is
+    :param stream: text stream to read from
+    :return: generator: (path tuple, value)
+    """
+    # one frame per open object or array: [is an object, current key or index, expecting a key]
+    stack = []
+    buffer = ''
+    position = 0
+    finished = False
+    while True:
+        match = JSON_TOKEN.match(buffer, position)
+        # a token touching the end of what we've read so far may continue in the next chunk
+        if not finished and (match is None or match.end() == len(buffer)):
+            chunk = stream.read(READ_CHUNK_SIZE)
+            finished = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if match is None:
+            if buffer[position:].strip():
+                raise ValueError('Invalid json near: {}'.format(buffer[position:position + 40]))
+            return
+        position = match.end()
+        string, structural, bare = match.groups()
+
+        if structural in ('{', '['):
+            stack.append(['{' == structural, None if '{' == structural else 0, '{' == structural])
+        elif structural in ('}', ']'):
+            stack.pop()
+        elif ':' == structural:
+            stack[-1][2] = False
+        elif ',' == structural:
+            if stack[-1][0]:
+                stack[-1][2] = True
+            else:
+                stack[-1][1] += 1
+        else:
+            value = json.loads('"{}"'.format(string)) if string is not None and '\\' in string else string
+            if string is None:
+                value = json.loads(bare)
+            if stack and stack[-1][0] and stack[-1][2]:
+                stack[-1][1] = value
+            else:
+                yield tuple(frame[1] for frame in stack), value
+
+
+def parseComposerLock(stream):
+    """
+    composer.lock: `packages` and `packages-dev` are lists of objects with a name and a version
+    :param stream: text stream of the lock file
+    :return: dict: package name => version
+    """
+    versions = {}
+    pending = {}
+    for path, value in iterJsonScalars(stream):
+        if 3 == len(path) and path[0] in ('packages', 'packages-dev') and path[2] in ('name', 'version'):
+            package = pending.setdefault(path[:2], {})
+            package[path[2]] = value
+            if 'name' in package and 'version' in package:
+                versions[package['name']] = package['version']
+                del pending[path[:2]]
+    return versions
+
+
+def parseNpmLock(stream):
+    """
+    package-lock.json: version 2 and 3 list every installed package under `packages`, keyed on its path inside
+    node_modules. Version 1 nests `dependencies` instead. Nested packages are named after their path (ie
+    `a/node_modules/b`) since several versions of the same package can be installed
+    :param stream: text stream of the lock file
+    :return: dict: package name => version
+    """
+    packages = {}
+    dependencies = {}
+    for path, value in iterJsonScalars(stream):
+        if 3 > len(path) or 'version' != path[-1]:
+            continue
+        if 3 == len(path) and 'packages' == path[0] and path[1]:
+            packages[path[1][len('node_modules/'):] if path[1].startswith('node_modules/') else path[1]] = value
+        elif 1 == len(path) % 2 and all('dependencies' == key for key in path[0:-1:2]):
+            dependencies['/node_modules/'.join(path[1:-1:2])] = value
+    # version 2 has both, for backwards compatibility
+    return packages or dependencies
+
+
+def parsePipfileLock(stream):
+    """
+    Pipfile.lock: `default` and `develop` are objects keyed on package name
+    :param stream: text stream of the lock file
+    :return: dict: package name => version
+    """
+    versions = {}
+    for path, value in iterJsonScalars(stream):
+        if 3 == len(path) and path[0] in ('default', 'develop') and 'version' == path[2]:
+            versions[path[1]] = value.lstrip('=')
+    return versions
+
+
+def parseYarnLock(stream):
+    """
+    yarn.lock (classic and berry): an unindented line lists the ranges that resolve to a package, the indented version
+    line below it says what they resolved to
+    :param stream: text stream of the lock file
+    :return: dict: package name => version
+    """
+    versions = {}
+    names = []
+    for line in stream:
+        if line[:1] not in ('', ' ', '#', '\n') and line.rstrip().endswith(':'):
+            names = []
+            for entry in line.rstrip().rstrip(':').split(','):
+                # name@range, @scope/name@range or name@npm:range
+                name = entry.strip().strip('"').rsplit('@', 1)[0]
+                if name and name not in names and '__metadata' != name:
+                    names.append(name)
+            continue
+        match = YARN_VERSION.match(line) if names else None
+        if match:
+            for name in names:
+                versions[name] = match.group(1)
+            names = []
+    return versions
+
+
+def parsePoetryLock(stream):
+    """
+    poetry.lock: one [[package]] table per package, which starts with its name and version
+    :param stream: text stream of the lock file
+    :return: dict: package name => version
+    """
+    versions = {}
+    package = None
+    for line in stream:
+        if line.startswith('['):
+            package = {} if '[[package]]' == line.strip() else None
+            continue
+        match = TOML_STRING.match(line) if package is not None else None
+        if match:
+            package[match.group(1)] = match.group(2)
+            if 'name' in package and 'version' in package:
+                versions[package['name']] = package['version']
+                package = None
+    return versions
+
+
+def parseGemfileLock(stream):
+    """
+    Gemfile.lock: the specs of every source (GEM, GIT, PATH) list one gem per line indented by four spaces. Deeper
+    lines are their dependencies
+    :param stream: text stream of the lock file
+    :return: dict: gem name => version
+    """
+    versions = {}
+    for line in stream:
+        match = GEMFILE_SPEC.match(line)
+        if match:
+            versions[match.group(1)] = match.group(2)
+    return versions
+
+
+def parseGoSum(stream):
+    """
+    go.sum: one line per module version (plus one for its go.mod). Several versions of a module can be listed
+    :param stream: text stream of the lock file
+    :return: dict: module => versions, comma separated
+    """
+    modules = {}
+    for line in stream:
+        parts = line.split()
+        if 3 == len(parts) and not parts[1].endswith('/go.mod'):
+            modules.setdefault(parts[0], set()).add(parts[1])
+    return {module: ', '.join(sorted(moduleVersions)) for module, moduleVersions in modules.items()}
+
+
+LOCK_PARSERS = {
+    'composer.lock': parseComposerLock,
+    'package-lock.json': parseNpmLock,
+    'Pipfile.lock': parsePipfileLock,
+    'yarn.lock': parseYarnLock,
+    'poetry.lock': parsePoetryLock,
+    'Gemfile.lock': parseGemfileLock,
+    'go.sum': parseGoSum,
+}
+
+
+def readCommittedVersions(repoPath, lockFile, parser):
+    """
+    Parses the committed version of a lock file straight from `git show`, without holding the whole file in memory
+    :param string repoPath: path to the repository
+    :param string lockFile: path to the lock file, relative to repoPath
+    :param function parser: one of LOCK_PARSERS
+    :return: dict: package name => version. Empty if the lock file is new
+    """
+    command = ['git', 'show', 'HEAD:./{}'.format(lockFile)]
+    with span(' '.join(command), 'command', command=command, cwd=repoPath) as commandSpan:
+        with subprocess.Popen(command, cwd=repoPath, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as gitShow:
+            try:
+                versions = parser(io.TextIOWrapper(gitShow.stdout, encoding='utf-8', errors='replace'))
+            finally:
+                # should the parser stop early, git gets a broken pipe instead of blocking on a full one
+                gitShow.stdout.close()
+        commandSpan['args']['exitCode'] = gitShow.returncode
+
+    return versions if 0 == gitShow.returncode else {}
+
+
+def diffVersions(oldVersions, newVersions):
+    """
+    :param dict oldVersions: package name => version before the update
+    :param dict newVersions: package name => version after the update
+    :return: dict: {added: {name: version}, removed: {name: version}, updated: {name: [old version, new version]}}
+    """
+    return {
+        'added': {name: version for name, version in sorted(newVersions.items()) if name not in oldVersions},
+        'removed': {name: version for name, version in sorted(oldVersions.items()) if name not in newVersions},
+        'updated': {name: [oldVersions[name], version] for name, version in sorted(newVersions.items())
+                    if name in oldVersions and oldVersions[name] != version},
+    }
+
+
+def diffLockFile(repoPath, lockFile):
+    """
+    Lists the packages that changed in a lock file since the last commit
+    :param string repoPath: path to the repository
+    :param string lockFile: path to the lock file, relative to repoPath
+    :return: dict|None: see diffVersions, or None if we can't parse this kind of lock file (or failed to)
+    """
+    parser = LOCK_PARSERS.get(os.path.basename(lockFile))
+    if parser is None:
+        return None
+
+    try:
+        oldVersions = readCommittedVersions(repoPath, lockFile, parser)
+        with open(os.path.join(repoPath, lockFile), encoding='utf-8', errors='replace') as lockStream:
+            newVersions = parser(lockStream)
+    except (OSError, ValueError, IndexError, TypeError, AttributeError) as e:
+        # a lock file we can't make sense of only costs us the details, never the commit
+        logging.warning("Unable to work out what changed in {}: {}".format(lockFile, e))
+        return None
+
+    return diffVersions(oldVersions, newVersions)
+
+
+def describeChanges(changes, limit=COMMIT_MESSAGE_CHANGES):
+    """
+    Formats the changes to a lock file for the commit message
+    :param dict changes: from diffLockFile
+    :param int limit: how many changes to list
+    :return: list: one line per change
+    """
+    lines = ['  {} {} -> {}'.format(name, old, new) for name, (old, new) in changes['updated'].items()]
+    lines += ['  {} {} (added)'.format(name, version) for name, version in changes['added'].items()]
+    lines += ['  {} {} (removed)'.format(name, version) for name, version in changes['removed'].items()]
+    if limit < len(lines):
+        lines = lines[:limit] + ['  ...and {} more'.format(len(lines) - limit)]
+    return lines
+
+
+@traced('lock file diff')
+def buildChangeReport(repoPath, lockFiles):
+    """
+    Diffs every updated lock file and writes the json report to PSH_SOP_CHANGE_REPORT (defaults to
+    lockfile-changes.json in our cache location)
+    :param string repoPath: path to the repository
+    :param list lockFiles: updated lock files, relative to repoPath
+    :return: dict: lock file => changes (None for lock files we can't diff)
+    """
+    report = {lockFile: diffLockFile(repoPath, lockFile) for lockFile in lockFiles}
+    reportPath = os.getenv(ENVVAR_CHANGE_REPORT) or os.path.join(getCacheDir(), CHANGE_REPORT_FILE)
+    if writeJsonFile(reportPath, report):
+        logging.info("Lock file changes written to {}".format(reportPath))
+    return report
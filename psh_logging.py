@@ -1,5 +1,14 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import re
 import sys
+import threading
+import time
 from logging import critical, error, info, warning, debug
 
 CWORKING = '\033[34;1m'
@@ -13,9 +22,116 @@ CBOLD = '\033[1;96m'
 CINFO = '\033[1;33m'
 # color we use for warnings
 CWARN = '\033[1;31m'
-logging.basicConfig(format='%(message)s', level=logging.DEBUG, stream=sys.stdout)
-logging.addLevelName(logging.WARNING, "%s%s%s" % (CWARN, logging.getLevelName(logging.WARNING), CRESET))
-logging.addLevelName(logging.ERROR, "%s%s%s" % (CWARN, logging.getLevelName(logging.ERROR), CRESET))
+# any ANSI escape sequence, so they can be stripped when the output isn't a terminal
+ANSI_ESCAPE = re.compile(r'\033\[[0-9;?]*[A-Za-z]')
+
+ENVVAR_LOG_LEVEL = 'PSH_SOP_LOG_LEVEL'
+# text or json (one json object per line)
+ENVVAR_LOG_FORMAT = 'PSH_SOP_LOG_FORMAT'
+# auto (only when writing to a terminal), always or never
+ENVVAR_LOG_COLOR = 'PSH_SOP_LOG_COLOR'
+# set to 0 to write log lines from the thread that logs them instead of a background writer
+ENVVAR_LOG_BACKGROUND = 'PSH_SOP_LOG_BACKGROUND'
+DEFAULT_LOG_LEVEL = 'INFO'
+
+# what configureLogging set up, so it can be replaced or stopped
+logHandlers = []
+logListener = None
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Plain messages, the way we've always logged them, without the colors when they'd end up as escape codes in a file
+    """
+    def __init__(self, color=True):
+        super().__init__('%(message)s')
+        self.color = color
+
+    def format(self, record):
+        message = super().format(record)
+        return message if self.color else ANSI_ESCAPE.sub('', message)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line, with the phase, command and duration the line belongs to when there is one
+    """
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.{:03d}Z'.format(
+                int(record.msecs)),
+            'level': record.levelname,
+            'message': ANSI_ESCAPE.sub('', record.getMessage()),
+        }
+        for field in ('phase', 'command', 'duration'):
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configureLogging(level=None, logFormat=None, color=None, background=None, stream=None):
+    """
+    Sets up where and how we log. Anything not given comes from the PSH_SOP_LOG_* environmental variables. By default
+    lines are written by a background thread, so a slow pipe never holds up the work being logged
+    :param string|int level: DEBUG, INFO, WARNING or ERROR
+    :param string logFormat: text or json
+    :param string color: auto, always or never
+    :param bool background: write from a background thread
+    :param stream: where to write, defaults to stdout
+    :return: void
+    """
+    global logListener
+    stopLogging()
+
+    stream = stream or sys.stdout
+    level = level or os.getenv(ENVVAR_LOG_LEVEL, DEFAULT_LOG_LEVEL).strip().upper()
+    if isinstance(level, str) and not isinstance(logging.getLevelName(level), int):
+        level = DEFAULT_LOG_LEVEL
+    logFormat = (logFormat or os.getenv(ENVVAR_LOG_FORMAT, 'text')).strip().lower()
+    color = (color or os.getenv(ENVVAR_LOG_COLOR, 'auto')).strip().lower()
+    if background is None:
+        background = '0' != os.getenv(ENVVAR_LOG_BACKGROUND, '1').strip()
+
+    if 'json' == logFormat:
+        formatter = JsonFormatter()
+    else:
+        isTerminal = hasattr(stream, 'isatty') and stream.isatty()
+        formatter = TextFormatter('always' == color or ('auto' == color and isTerminal))
+    streamHandler = logging.StreamHandler(stream)
+    streamHandler.setFormatter(formatter)
+
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(level)
+    if background:
+        logQueue = queue.SimpleQueue()
+        logListener = logging.handlers.QueueListener(logQueue, streamHandler)
+        logListener.start()
+        handler = logging.handlers.QueueHandler(logQueue)
+    else:
+        handler = streamHandler
+    rootLogger.addHandler(handler)
+    logHandlers.append(handler)
+
+
+def stopLogging():
+    """
+    Writes whatever the background writer still has queued and removes what configureLogging set up
+    :return: void
+    """
+    global logListener
+    if logListener:
+        logListener.stop()
+        logListener = None
+    for handler in logHandlers:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    del logHandlers[:]
+
+
+# nothing queued may be lost when we exit
+atexit.register(stopLogging)
 
 
 def outputError(cmd, output):
@@ -25,3 +141,84 @@ def outputError(cmd, output):
     # @todo exit seems... dirty?
     # sys.exit("See previous error above")
     return False
+
+
+# prefixed to every line logged in the current context, so the output of runs happening side by side (ie one per
+# project) can be told apart
+logPrefix = contextvars.ContextVar('logPrefix', default='')
+
+
+class ContextLogPrefix(logging.Filter):
+    """
+    Adds the current context's logPrefix to every record
+    """
+    def filter(self, record):
+        prefix = logPrefix.get()
+        # records replayed by replayLogs come through here a second time
+        if prefix and not getattr(record, 'logPrefixed', False):
+            record.msg = '{}{}'.format(prefix, record.getMessage())
+            record.args = None
+            record.logPrefixed = True
+        return True
+
+
+logging.getLogger().addFilter(ContextLogPrefix())
+
+# the phase of the run (ie dependency updates) the current context is in, see psh_trace.span()
+logPhase = contextvars.ContextVar('logPhase', default=None)
+
+
+class ContextLogPhase(logging.Filter):
+    """
+    Adds the current context's logPhase to every record, while we're still in the thread that logged it
+    """
+    def filter(self, record):
+        if getattr(record, 'phase', None) is None:
+            record.phase = logPhase.get()
+        return True
+
+
+logging.getLogger().addFilter(ContextLogPhase())
+
+logBuffer = threading.local()
+
+
+class ThreadLogBuffer(logging.Filter):
+    """
+    Holds back the records logged by a thread while runWithBufferedLogs is collecting them
+    """
+    def filter(self, record):
+        records = getattr(logBuffer, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+logging.getLogger().addFilter(ThreadLogBuffer())
+
+
+def runWithBufferedLogs(func, *args):
+    """
+    Runs a function while holding back everything it logs, so work done concurrently can still be reported in order
+    with replayLogs()
+    :param function func: function to run
+    :param args: arguments for the function
+    :return: tuple: the function's return value and the list of log records it produced
+    """
+    logBuffer.records = []
+    try:
+        result = func(*args)
+        return result, logBuffer.records
+    finally:
+        logBuffer.records = None
+
+
+def replayLogs(records):
+    """
+    Logs records previously held back by runWithBufferedLogs
+    :param list records: log records
+    :return: void
+    """
+    for record in records:
+        logging.getLogger().handle(record)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from psh_utility import getCacheDir, getEnvNumber, readJsonFile, writeJsonFile
+
+ENVVAR_METADATA_TTL = 'PSH_SOP_METADATA_TTL'
+# set to 1 to ignore (and replace) whatever is cached
+ENVVAR_METADATA_REFRESH = 'PSH_SOP_METADATA_REFRESH'
+DEFAULT_METADATA_TTL = 3600
+METADATA_SUBDIR = 'metadata'
+
+metadataLock = threading.Lock()
+
+
+def getMetadataPath(projectID):
+    """
+    :param string projectID: project the metadata belongs to
+    :return: string: full path to the project's metadata cache file
+    """
+    return os.path.join(getCacheDir(METADATA_SUBDIR), '{}.json'.format(projectID or 'default'))
+
+
+def getTokenKey(name):
+    """
+    Builds a cache key that is only valid for the current API token, so a new token is never mistaken for the old one
+    :param string name: what we're caching
+    :return: string
+    """
+    tokenHash = hashlib.sha256(os.getenv('PLATFORMSH_CLI_TOKEN', '').encode('utf-8')).hexdigest()[:16]
+    return '{}-{}'.format(name, tokenHash)
+
+
+def getCachedMetadata(projectID, key, loader):
+    """
+    Gets a piece of project metadata that rarely changes (production branch name, git integration ID, token
+    validity), only calling the loader if we don't have a value younger than PSH_SOP_METADATA_TTL seconds. Falsy
+    values are never cached, since that's how our lookups report failures
+    :param string projectID: project the metadata belongs to
+    :param string key: name of the metadata
+    :param function loader: retrieves the current value
+    :return: the cached or freshly loaded value
+    """
+    path = getMetadataPath(projectID)
+    ttl = getEnvNumber(ENVVAR_METADATA_TTL, DEFAULT_METADATA_TTL, float)
+    if '1' != os.getenv(ENVVAR_METADATA_REFRESH, '0') and 0 < ttl:
+        with metadataLock:
+            cached = readJsonFile(path, {}).get(key)
+        if cached and time.time() - cached.get('stored', 0) < ttl:
+            logging.debug("Using cached {} for project {}".format(key, projectID))
+            return cached['value']
+
+    value = loader()
+    if value:
+        with metadataLock:
+            metadata = readJsonFile(path, {})
+            metadata[key] = {'value': value, 'stored': time.time()}
+            writeJsonFile(path, metadata)
+
+    return value
+
+
+def invalidateMetadata(projectID=None, key=None):
+    """
+    Forgets cached metadata
+    :param string projectID: project to forget metadata for. Forgets every project if None
+    :param string key: only forget this piece of metadata
+    :return: void
+    """
+    with metadataLock:
+        if projectID is None:
+            shutil.rmtree(getCacheDir(METADATA_SUBDIR), ignore_errors=True)
+            return
+
+        path = getMetadataPath(projectID)
+        if key is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+
+        metadata = readJsonFile(path, {})
+        if metadata.pop(key, None) is not None:
+            writeJsonFile(path, metadata)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+import fnmatch
+import glob
+import json
+import logging
+import os
+import re
+import shlex
+
+from psh_trace import traced
+
+GO_WORK_FILE = 'go.work'
+# `use ./dir` or a `use (...)` block with one directory per line
+GO_WORK_USE = re.compile(r'^\s*use\s*(?:\(([^)]*)\)|("[^"]*"|\S+))', re.MULTILINE)
+# a directory in a use block, quoted if it has spaces in it
+GO_WORK_DIRECTORY = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def readJson(path):
+    """
+    :param string path: full path to a json manifest
+    :return: dict: its contents, empty if it's missing or isn't a json object
+    """
+    try:
+        with open(path) as manifest:
+            contents = json.load(manifest)
+    except (OSError, ValueError):
+        return {}
+    return contents if isinstance(contents, dict) else {}
+
+
+def toRelative(path):
+    """
+    :param string path: path relative to the project, in the os format
+    :return: string: the same path with / as the separator and '' for the project root
+    """
+    path = os.path.normpath(path).replace(os.sep, '/')
+    return '' if '.' == path else path
+
+
+def joinRelative(*parts):
+    return toRelative(os.path.join(*[part for part in parts if part]) if any(parts) else '.')
+
+
+def getAncestors(relPath):
+    """
+    :param string relPath: directory relative to the project root
+    :return: list: every directory above it up to and including the project root, closest first
+    """
+    ancestors = []
+    while relPath:
+        relPath = relPath.rpartition('/')[0]
+        ancestors.append(relPath)
+    return ancestors
+
+
+def matchesWorkspace(relPath, pattern):
+    """
+    Checks a directory against a workspace pattern (ie `packages/*`). Unlike fnmatch, * doesn't cross directories
+    :param string relPath: directory relative to the workspace root
+    :param string pattern: workspace pattern relative to the workspace root
+    :return: bool
+    """
+    pattern = toRelative(pattern.strip())
+    if '**' in pattern:
+        return fnmatch.fnmatchcase(relPath, pattern)
+    pathParts = relPath.split('/')
+    patternParts = pattern.split('/')
+    return len(pathParts) == len(patternParts) and all(fnmatch.fnmatchcase(part, patternPart) for part, patternPart
+                                                       in zip(pathParts, patternParts))
+
+
+def getNpmWorkspaces(manifest):
+    """
+    :param dict manifest: a package.json
+    :return: list: its workspace patterns, either listed directly or under `packages`
+    """
+    workspaces = manifest.get('workspaces', [])
+    if isinstance(workspaces, dict):
+        workspaces = workspaces.get('packages', [])
+    return [pattern for pattern in workspaces if isinstance(pattern, str)] if isinstance(workspaces, list) else []
+
+
+def isNpmWorkspaceMember(relPath, patterns):
+    included = any(matchesWorkspace(relPath, pattern) for pattern in patterns if not pattern.startswith('!'))
+    return included and not any(matchesWorkspace(relPath, pattern[1:]) for pattern in patterns
+                                if pattern.startswith('!'))
+
+
+def findNpmWorkspaceMembers(appPath, rootPath):
+    """
+    Lists the members of an npm/yarn workspace from the `workspaces` of its root package.json. Members usually don't
+    have a lock file of their own, so discovery never finds them
+    :param string appPath: full path to the project
+    :param string rootPath: directory of the workspace root, relative to the project
+    :return: list: member directories with a package.json, relative to the workspace root
+    """
+    patterns = getNpmWorkspaces(readJson(os.path.join(appPath, rootPath, 'package.json')))
+    rootFull = os.path.join(appPath, rootPath)
+    members = []
+    for pattern in patterns:
+        if pattern.startswith('!'):
+            continue
+        for manifest in sorted(glob.glob(os.path.join(rootFull, pattern.strip(), 'package.json'), recursive=True)):
+            member = toRelative(os.path.relpath(os.path.dirname(manifest), rootFull))
+            if (member and member not in members and 'node_modules' not in member.split('/')
+                    and isNpmWorkspaceMember(member, patterns)):
+                members.append(member)
+    return members
+
+
+def getGoWorkModules(goWorkPath):
+    """
+    :param string goWorkPath: full path to a go.work file
+    :return: list: the module directories it uses, relative to the directory of the go.work file
+    """
+    try:
+        with open(goWorkPath) as goWork:
+            contents = re.sub(r'//.*', '', goWork.read())
+    except OSError:
+        return []
+    modules = []
+    for block, single in GO_WORK_USE.findall(contents):
+        modules += [toRelative(quoted or bare) for quoted, bare in GO_WORK_DIRECTORY.findall(block or single)]
+    return modules
+
+
+def getComposerPathRepositories(appPath, relPath):
+    """
+    :param string appPath: full path to the project
+    :param string relPath: directory of a composer.json, relative to the project
+    :return: list: directories its path repositories point at, relative to the project
+    """
+    manifest = readJson(os.path.join(appPath, relPath, 'composer.json'))
+    repositories = manifest.get('repositories', [])
+    if isinstance(repositories, dict):
+        repositories = list(repositories.values())
+    directories = []
+    for repository in repositories if isinstance(repositories, list) else []:
+        if not isinstance(repository, dict) or 'path' != repository.get('type') or not repository.get('url'):
+            continue
+        for directory in glob.glob(os.path.join(appPath, relPath, repository['url'])):
+            directories.append(toRelative(os.path.relpath(directory, appPath)))
+    return directories
+
+
+def findWorkspaceRoot(appPath, relPath, dependencyFile, updaters):
+    """
+    Looks above a dependency file for a workspace it belongs to: an npm/yarn workspace whose root has its own lock file,
+    or a go.work that uses its module
+    :param string appPath: full path to the project
+    :param string relPath: directory of the dependency file, relative to the project
+    :param string dependencyFile: name of the dependency file
+    :param dict updaters: the updaters table
+    :return: tuple|None: (workspace root directory, updater to run there), None if it isn't part of a workspace
+    """
+    ecosystem = updaters[dependencyFile]['ecosystem']
+    for ancestor in getAncestors(relPath):
+        memberPath = relPath[len(ancestor):].lstrip('/')
+        if ecosystem in ('npm', 'yarn'):
+            patterns = getNpmWorkspaces(readJson(os.path.join(appPath, ancestor, 'package.json')))
+            if patterns and isNpmWorkspaceMember(memberPath, patterns):
+                # the workspace is resolved by whichever package manager its root is locked with
+                for rootFile in ('yarn.lock', 'package-lock.json'):
+                    if os.path.isfile(os.path.join(appPath, ancestor, rootFile)):
+                        return ancestor, rootFile
+                return None
+        elif 'go' == ecosystem and os.path.isfile(os.path.join(appPath, ancestor, GO_WORK_FILE)):
+            if memberPath in getGoWorkModules(os.path.join(appPath, ancestor, GO_WORK_FILE)):
+                return ancestor, GO_WORK_FILE
+            return None
+    return None
+
+
+@traced('update planning')
+def planUpdates(appPath, appfiles, updaters):
+    """
+    Turns the dependency files we found into the update commands to run. Members of an npm/yarn workspace or a go.work
+    are resolved once, from the workspace root, instead of once per member, and the root of an npm/yarn workspace
+    resolves every member its package.json lists. Apps that pull another app in through a composer path repository are
+    updated after it
+    :param string appPath: full path to the project
+    :param list appfiles: dependency files from discovery, relative to appPath
+    :param dict updaters: the updaters table
+    :return: list: waves of invocations, each wave only depending on the ones before it. An invocation is a dict
+        {file, path, updater, command, probe, locks, covers, after, modules}
+    """
+    invocations = {}
+    for fileFull in appfiles:
+        dependencyFilePath, dependencyFile = os.path.split(fileFull)
+        relPath = toRelative(dependencyFilePath) if dependencyFilePath else ''
+        updater = updaters[dependencyFile]
+        memberLocks = [joinRelative(relPath, lockFile) for lockFile in updater['lock'].split()]
+        workspace = findWorkspaceRoot(appPath, relPath, dependencyFile, updaters)
+        if workspace is not None:
+            modules = [relPath[len(workspace[0]):].lstrip('/')]
+        else:
+            modules = findNpmWorkspaceMembers(appPath, relPath) if updater['ecosystem'] in ('npm', 'yarn') else []
+            if not modules:
+                invocations[fileFull] = {'file': fileFull, 'path': relPath, 'updater': dependencyFile,
+                                         'command': updater['command'], 'probe': updater.get('probe'),
+                                         'locks': memberLocks, 'covers': [fileFull], 'after': [], 'modules': []}
+                continue
+            # the root of a workspace, which resolves its members along with itself
+            workspace = relPath, dependencyFile
+
+        rootPath, rootFile = workspace
+        key = joinRelative(rootPath, rootFile)
+        if key not in invocations:
+            if GO_WORK_FILE == rootFile:
+                # every module of a go workspace is still updated on its own, but one after another and in one go so
+                # they don't fight over go.work.sum
+                invocations[key] = {'file': key, 'path': rootPath, 'updater': dependencyFile, 'command': None,
+                                    'probe': None, 'locks': [joinRelative(rootPath, 'go.work.sum')], 'covers': [],
+                                    'after': [], 'modules': []}
+            else:
+                rootUpdater = updaters[rootFile]
+                invocations[key] = {'file': key, 'path': rootPath, 'updater': rootFile,
+                                    'command': rootUpdater.get('workspaceCommand', rootUpdater['command']),
+                                    'probe': rootUpdater.get('probe'),
+                                    'locks': [joinRelative(rootPath, lockFile) for lockFile in
+                                              rootUpdater['lock'].split()],
+                                    'covers': [], 'after': [], 'modules': []}
+        invocation = invocations[key]
+        invocation['covers'].append(fileFull)
+        invocation['modules'] += [module for module in modules if module not in invocation['modules']]
+        # members may keep their own manifest changes (ie package.json ranges bumped by the root resolution)
+        if GO_WORK_FILE != rootFile:
+            memberLocks += [joinRelative(rootPath, module, 'package.json') for module in modules]
+        invocation['locks'] += [lockFile for lockFile in memberLocks if lockFile not in invocation['locks']]
+
+    for invocation in invocations.values():
+        if GO_WORK_FILE == os.path.basename(invocation['file']):
+            moduleCommand = updaters[invocation['updater']]['command']
+            invocation['command'] = ' && '.join(['(cd {} && {})'.format(shlex.quote(module or '.'), moduleCommand)
+                                                 for module in invocation['modules']] + ['go work sync'])
+        elif 'composer.json' == invocation['updater']:
+            # an app that uses another through a path repository locks whatever that one resolves to, so it goes after
+            for directory in getComposerPathRepositories(appPath, invocation['path']):
+                dependency = joinRelative(directory, 'composer.json')
+                if dependency in invocations and dependency != invocation['file']:
+                    invocation['after'].append(dependency)
+
+    return orderInvocations(list(invocations.values()))
+
+
+def orderInvocations(invocations):
+    """
+    Groups invocations into waves so each one only runs once everything it comes after is done
+    :param list invocations: from planUpdates
+    :return: list: lists of invocations
+    """
+    waves = []
+    done = set()
+    remaining = list(invocations)
+    while remaining:
+        wave = [invocation for invocation in remaining if all(after in done for after in invocation['after'])]
+        if not wave:
+            logging.warning("Ignoring the order of {} updates that depend on each other in a loop.".format(
+                len(remaining)))
+            wave = remaining
+        waves.append(wave)
+        done.update(invocation['file'] for invocation in wave)
+        remaining = [invocation for invocation in remaining if invocation not in wave]
+    return waves
+
+
+def describePlan(waves, fileCount):
+    """
+    Logs the update commands we're about to run, what each one covers, and what it has to wait for
+    :param list waves: from planUpdates
+    :param int fileCount: how many dependency files discovery found
+    :return: void
+    """
+    lines = []
+    for number, wave in enumerate(waves, 1):
+        if 1 < len(waves):
+            lines.append('Wave {}:'.format(number))
+        for invocation in wave:
+            line = '  {} ({}): {}'.format(invocation['file'], invocation['path'] or '.', invocation['command'])
+            if [invocation['file']] != invocation['covers']:
+                line += ' [covers {}]'.format(', '.join(invocation['covers']))
+            if invocation['modules'] and GO_WORK_FILE != os.path.basename(invocation['file']):
+                line += ' [workspace members {}]'.format(', '.join(invocation['modules']))
+            if invocation['after']:
+                line += ' [after {}]'.format(', '.join(invocation['after']))
+            lines.append(line)
+    count = sum(len(wave) for wave in waves)
+    logging.info("Planned {} update(s) for {} dependency file(s):\n{}".format(count, fileCount, '\n'.join(lines)))
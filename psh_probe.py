@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import time
+
+from psh_utility import runCommand
+
+ENVVAR_PROBES = 'PSH_SOP_PROBES'
+
+
+def parseComposerOutdated(output):
+    """
+    Parses `composer outdated --format=json`. Depending on the flags used, packages are listed under `installed` or
+    `locked`
+    :param string output: probe output
+    :return: int: number of upgradable packages
+    """
+    report = json.loads(output)
+    if not isinstance(report, dict):
+        raise ValueError('Unexpected composer outdated output')
+
+    return sum(len(packages) for packages in report.values() if isinstance(packages, list))
+
+
+def parseNpmOutdated(output):
+    """
+    Parses `npm outdated --all --json`: an object keyed on package name, empty when everything is up-to-date. A package
+    installed at several versions (ie as a transitive dependency of different packages) has a list of entries instead
+    :param string output: probe output
+    :return: int: number of upgradable packages
+    """
+    if not output.strip():
+        # npm prints nothing at all when there's nothing outdated
+        return 0
+    report = json.loads(output)
+    if not isinstance(report, dict) or 'error' in report:
+        raise ValueError('Unexpected npm outdated output')
+
+    return sum(len(entries) if isinstance(entries, list) else 1 for entries in report.values())
+
+
+def parseLines(output):
+    """
+    Parses probes that print one line per upgradable package and nothing when everything is up-to-date
+    :param string output: probe output
+    :return: int: number of upgradable packages
+    """
+    return len([line for line in output.splitlines() if line.strip()])
+
+
+PROBE_PARSERS = {
+    'composer': parseComposerOutdated,
+    'npm': parseNpmOutdated,
+    'lines': parseLines,
+}
+
+
+def probesEnabled():
+    """
+    Probes can be turned off by setting PSH_SOP_PROBES to 0
+    :return: bool
+    """
+    return '0' != os.getenv(ENVVAR_PROBES, '1')
+
+
+def runProbe(probe, rcwd, label, env=None):
+    """
+    Runs an updater's outdated probe
+    :param dict probe: {command: string, format: key of PROBE_PARSERS, exitCodes: tuple (optional) of the exit codes
+        that mean the probe worked, ie 1 for tools that exit 1 when something is outdated}
+    :param string rcwd: path to run the probe in
+    :param string label: what we're probing, for logging
+    :param dict env: additional environmental variables for the probe
+    :return: int|None: number of upgradable packages, or None if we couldn't tell
+    """
+    start = time.monotonic()
+    procProbe = runCommand(probe['command'], rcwd, env)
+    duration = time.monotonic() - start
+    upgradable = None
+    # anything else means the probe itself failed, and whatever it printed doesn't tell us what's outdated
+    if procProbe['exitCode'] in probe.get('exitCodes', (0,)):
+        try:
+            upgradable = PROBE_PARSERS[probe['format']](procProbe['output'])
+        except (ValueError, TypeError) as e:
+            logging.debug("Unable to parse the output of {}: {}".format(probe['command'], e))
+
+    if upgradable is None:
+        # we can't tell, so the safe thing is to run the full update
+        logging.info("Outdated probe for {} was inconclusive ({:.1f}s).".format(label, duration))
+    else:
+        logging.info("Outdated probe for {} found {} upgradable package(s) ({:.1f}s).".format(label, upgradable,
+                                                                                            duration))
+
+    return upgradable
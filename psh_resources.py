@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import logging
+import os
+import re
+import signal
+import sys
+
+from psh_utility import getEnvNumber
+
+# memory (in MB) and CPU time (in seconds) an updater may use. Either can be set per ecosystem by appending its name in
+# upper case (ie PSH_SOP_MEMORY_LIMIT_COMPOSER), which takes precedence
+ENVVAR_MEMORY_LIMIT = 'PSH_SOP_MEMORY_LIMIT'
+ENVVAR_CPU_LIMIT = 'PSH_SOP_CPU_LIMIT'
+# cgroup files that hold the container's memory limit (v2, then v1)
+CGROUP_MEMORY_FILES = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+# how close to its memory limit an updater has to get for a failure to be blamed on the limit
+MEMORY_LIMIT_MARGIN = 0.9
+# what the package managers (and the runtimes under them) say when they run out of memory
+OUT_OF_MEMORY = re.compile(r'Allowed memory size of \d+ bytes exhausted|JavaScript heap out of memory|MemoryError|'
+                           r'Cannot allocate memory|out of memory|failed to map segment', re.IGNORECASE)
+
+
+def getLimits(ecosystem):
+    """
+    :param string ecosystem: ecosystem name from the updaters table
+    :return: dict: {memory: MB or 0, cpu: seconds or 0}, 0 meaning no limit
+    """
+    suffix = '_' + ecosystem.upper()
+    return {
+        'memory': max(0, getEnvNumber(ENVVAR_MEMORY_LIMIT + suffix, getEnvNumber(ENVVAR_MEMORY_LIMIT, 0))),
+        'cpu': max(0, getEnvNumber(ENVVAR_CPU_LIMIT + suffix, getEnvNumber(ENVVAR_CPU_LIMIT, 0))),
+    }
+
+
+def applyLimits(command, updater, limits):
+    """
+    Prefixes a command with the ulimits that enforce an updater's limits. The address space limit is only used for
+    tools that don't reserve far more address space than they use (go and node do), those get told their budget through
+    the updater's memoryEnv instead
+    :param string command: the update command
+    :param dict updater: its entry in the updaters table
+    :param dict limits: from getLimits
+    :return: string: the command to run
+    """
+    ulimits = []
+    if limits['memory'] and updater.get('limitAddressSpace', True):
+        ulimits.append('ulimit -v {}'.format(limits['memory'] * 1024))
+    if limits['cpu']:
+        ulimits.append('ulimit -t {}'.format(limits['cpu']))
+    return ' && '.join(ulimits + ['{ ' + command + '; }']) if ulimits else command
+
+
+def getLimitEnv(updater, limits):
+    """
+    Builds the environmental variables that tell a tool its memory budget (ie COMPOSER_MEMORY_LIMIT), so it stops with a
+    clear error instead of being killed
+    :param dict updater: its entry in the updaters table
+    :param dict limits: from getLimits
+    :return: dict
+    """
+    if not limits['memory']:
+        return {}
+    limitEnv = {}
+    for envVar, template in updater.get('memoryEnv', {}).items():
+        value = template.format(limits['memory'])
+        # options that take a list of flags keep whatever was already set
+        limitEnv[envVar] = ' '.join(filter(None, [os.getenv(envVar, ''), value])) if 'OPTIONS' in envVar else value
+    return limitEnv
+
+
+def getUsage(rusage):
+    """
+    :param resource.struct_rusage rusage: from os.wait4
+    :return: dict: {cpuUser: seconds, cpuSystem: seconds, maxRssMb: MB}
+    """
+    # linux reports the peak resident set size in KB, macOS in bytes
+    maxRssMb = rusage.ru_maxrss / (1024 * 1024 if 'darwin' == sys.platform else 1024)
+    return {'cpuUser': round(rusage.ru_utime, 3), 'cpuSystem': round(rusage.ru_stime, 3),
+            'maxRssMb': round(maxRssMb, 1)}
+
+
+def getSignal(exitCode):
+    """
+    :param int exitCode: exit code of a command run through the shell
+    :return: int|None: the signal that killed it, if one did. The shell reports a signal either way
+    """
+    if exitCode is None:
+        return None
+    if 0 > exitCode:
+        return -exitCode
+    if 128 < exitCode < 128 + 65:
+        return exitCode - 128
+    return None
+
+
+def describeViolation(updateRun, limits):
+    """
+    Works out if a failed update ran into its memory or CPU limit, or the container's, so it can be reported as such
+    instead of as an unexplained exit code
+    :param dict updateRun: runCommand result
+    :param dict limits: from getLimits
+    :return: string|None: what happened, or None if it wasn't a limit
+    """
+    if updateRun['result']:
+        return None
+    usage = updateRun.get('usage') or {}
+    killedBy = getSignal(updateRun.get('exitCode'))
+    if signal.SIGXCPU == killedBy or (limits['cpu'] and usage.get('cpuUser', 0) + usage.get('cpuSystem', 0)
+                                      >= limits['cpu']):
+        return 'Exceeded its CPU time limit of {}s'.format(limits['cpu'])
+    nearLimit = limits['memory'] and usage.get('maxRssMb', 0) >= limits['memory'] * MEMORY_LIMIT_MARGIN
+    if OUT_OF_MEMORY.search(updateRun['message'] or '') or nearLimit:
+        return 'Ran out of memory (peak {} MB{})'.format(
+            usage.get('maxRssMb', '?'), ', limit {} MB'.format(limits['memory']) if limits['memory'] else '')
+    if signal.SIGKILL == killedBy:
+        return 'Was killed (peak {} MB), most likely by the out of memory killer because the container ran out of ' \
+               'memory'.format(usage.get('maxRssMb', '?'))
+    return None
+
+
+def getContainerMemoryMb():
+    """
+    :return: float|None: the memory limit of the container we run in, None if there isn't one we can read
+    """
+    for path in CGROUP_MEMORY_FILES:
+        try:
+            with open(path) as limitFile:
+                limit = limitFile.read().strip()
+        except OSError:
+            continue
+        # no limit reads as "max" (v2) or an absurdly high number (v1)
+        if limit.isdigit() and int(limit) < 2 ** 60:
+            return int(limit) / (1024 * 1024)
+    return None
+
+
+def summarizeUsage(updaterSpans, maxWorkers):
+    """
+    Logs which updater used the most memory and CPU, and how many updaters of that size fit in the container at once
+    :param list updaterSpans: the updater spans of this run
+    :param int maxWorkers: how many updaters may currently run at the same time
+    :return: void
+    """
+    measured = [record for record in updaterSpans if 'maxRssMb' in record['args']]
+    if not measured:
+        return
+    largest = max(measured, key=lambda record: record['args']['maxRssMb'])
+    cpuSeconds = sum(record['args']['cpuUser'] + record['args']['cpuSystem'] for record in measured)
+    summary = "Updaters used {:.1f}s of CPU in total, the largest peak memory was {} MB ({})".format(
+        cpuSeconds, largest['args']['maxRssMb'], largest['name'])
+    containerMemory = getContainerMemoryMb()
+    if containerMemory and largest['args']['maxRssMb']:
+        fits = int(containerMemory // largest['args']['maxRssMb'])
+        summary += ". The container's {:.0f} MB fits {} updater(s) that size at once".format(containerMemory, fits)
+        if fits < maxWorkers:
+            logging.warning("{}, fewer than the {} allowed to run at the same time (PSH_SOP_MAX_WORKERS).".format(
+                summary, maxWorkers))
+            return
+    logging.info(summary + '.')
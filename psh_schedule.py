@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import logging
+import statistics
+import time
+
+from psh_history import DEFAULT_BASELINE_RUNS, ENVVAR_BASELINE_RUNS, getUpdaterHistory
+from psh_trace import traced
+from psh_utility import getEnvNumber
+
+# seconds a whole sop-autoupdate run may take. 0 means no budget, every update runs
+ENVVAR_TIME_BUDGET = 'PSH_SOP_TIME_BUDGET'
+# share of the budget kept back for committing what finished (the git status, diffs and commit)
+BUDGET_RESERVE = 0.1
+# seconds we expect an update to take when no previous run took it and nothing else ran before either
+DEFAULT_UPDATE_ESTIMATE = 60.0
+
+
+def getTimeBudget():
+    """
+    :return: float: seconds the run may take, 0 for no budget
+    """
+    return max(0.0, getEnvNumber(ENVVAR_TIME_BUDGET, 0, float))
+
+
+def estimateElapsed(waves, estimates, maxWorkers):
+    """
+    Estimates how long running the waves takes, handing every update to whichever worker frees up first
+    :param list waves: from planUpdates
+    :param dict estimates: invocation file => seconds
+    :param int maxWorkers: how many updates run at the same time
+    :return: float: seconds
+    """
+    elapsed = 0.0
+    for wave in waves:
+        workers = [0.0] * max(1, min(maxWorkers, len(wave)))
+        for invocation in sorted(wave, key=lambda item: estimates[item['file']], reverse=True):
+            workers[workers.index(min(workers))] += estimates[invocation['file']]
+        elapsed += max(workers) if wave else 0.0
+    return elapsed
+
+
+def filterWaves(waves, files):
+    """
+    :param list waves: from planUpdates
+    :param set files: the invocations to keep
+    :return: list: the waves with only those invocations, and without waves left empty
+    """
+    return [wave for wave in ([invocation for invocation in wave if invocation['file'] in files] for wave in waves)
+            if wave]
+
+
+@traced('update scheduling')
+def scheduleUpdates(waves, available, maxWorkers, command='sop-autoupdate'):
+    """
+    Picks the updates that fit in the time budget, based on how long each took in the previous runs it completed. The
+    ones that went the longest without completing go first, and an update that doesn't fit this run is only passed over
+    for ones that completed less recently, so it moves up every run until it's first in line, when it runs as long as
+    it fits the budget on its own. An update that previous runs show takes longer than the whole budget can't complete
+    in any run, so it's left out as unschedulable rather than started (and stopped) ahead of the others every time. One
+    we have no timings of its own for still runs when it's first in line, so we find out how long it takes
+    :param list waves: from planUpdates
+    :param float available: seconds left for running updates
+    :param int maxWorkers: how many updates run at the same time
+    :param string command: whose history to read
+    :return: dict: {waves: the waves to run now, deferred: invocations left for a later run, unschedulable: invocations
+        expected to take longer than is available, estimates: invocation file => seconds, lastCompleted: invocation file
+        => time.time() it last completed, None if it never did, available: seconds left for running updates}
+    """
+    invocations = [invocation for wave in waves for invocation in wave]
+    history = getUpdaterHistory(command, max(1, getEnvNumber(ENVVAR_BASELINE_RUNS, DEFAULT_BASELINE_RUNS)))
+    known = {invocation['file']: statistics.median(history[invocation['file']]['durations'])
+             for invocation in invocations if history.get(invocation['file'], {}).get('durations')}
+    fallback = statistics.median(known.values()) if known else DEFAULT_UPDATE_ESTIMATE
+    # an update that was stopped before it finished takes at least as long as it got to run
+    estimates = {invocation['file']: max(known.get(invocation['file'], fallback),
+                                         history.get(invocation['file'], {}).get('stoppedAfter', 0))
+                 for invocation in invocations}
+    lastCompleted = {invocation['file']: history.get(invocation['file'], {}).get('lastCompleted')
+                     for invocation in invocations}
+    # updates we have no timings of our own for are only guessed at, so they get a run to find out
+    untimed = {invocation['file'] for invocation in invocations
+               if invocation['file'] not in known and not history.get(invocation['file'], {}).get('stoppedAfter')}
+
+    chosen = set()
+    deferred = []
+    unschedulable = []
+    for invocation in sorted(invocations, key=lambda item: (lastCompleted[item['file']] or 0.0, item['file'])):
+        candidate = chosen | {invocation['file']}
+        if estimates[invocation['file']] > available and invocation['file'] not in untimed:
+            unschedulable.append(invocation)
+        elif not chosen or estimateElapsed(filterWaves(waves, candidate), estimates, maxWorkers) <= available:
+            chosen = candidate
+        else:
+            deferred.append(invocation)
+
+    return {'waves': filterWaves(waves, chosen), 'deferred': deferred, 'unschedulable': unschedulable,
+            'estimates': estimates, 'lastCompleted': lastCompleted, 'available': available}
+
+
+def describeSchedule(schedule, budget, maxWorkers):
+    """
+    Logs which updates run now, how long we expect them to take, which wait for a later run and which don't fit at all
+    :param dict schedule: from scheduleUpdates
+    :param float budget: seconds the run may take
+    :param int maxWorkers: how many updates run at the same time
+    :return: void
+    """
+    waves, deferred, estimates = schedule['waves'], schedule['deferred'], schedule['estimates']
+    unschedulable = schedule['unschedulable']
+    scheduled = [invocation for wave in waves for invocation in wave]
+    lines = ['  {} (~{:.0f}s)'.format(invocation['file'], estimates[invocation['file']]) for invocation in scheduled]
+    logging.info("Scheduled {} of {} update(s) for an estimated {:.0f}s of the {:.0f}s left in the {:.0f}s budget:"
+                 "\n{}".format(len(scheduled), len(scheduled) + len(deferred) + len(unschedulable),
+                              estimateElapsed(waves, estimates, maxWorkers), schedule['available'], budget,
+                              '\n'.join(lines)))
+    if unschedulable:
+        logging.warning("{} update(s) are expected to take longer than the {:.0f}s left, so they're skipped until "
+                        "{} is raised:\n{}".format(
+                            len(unschedulable), schedule['available'], ENVVAR_TIME_BUDGET,
+                            '\n'.join('  {} (~{:.0f}s)'.format(invocation['file'], estimates[invocation['file']])
+                                      for invocation in unschedulable)))
+    if not deferred:
+        return
+    lines = []
+    for invocation in deferred:
+        completed = schedule['lastCompleted'][invocation['file']]
+        lines.append('  {} (~{:.0f}s, last completed {})'.format(
+            invocation['file'], estimates[invocation['file']],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(completed)) if completed else 'never'))
+    logging.info("Deferred {} update(s) to a later run:\n{}".format(len(deferred), '\n'.join(lines)))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import re
+import signal
+import socketserver
+import statistics
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import psh_api
+import psh_metadata
+import psh_trace
+import psh_utility
+from psh_history import recordRun
+from psh_logging import outputError
+from psh_utility import getEnvNumber
+
+# listen on this unix socket instead of a port
+ENVVAR_SERVE_SOCKET = 'PSH_SOP_SERVE_SOCKET'
+ENVVAR_SERVE_PORT = 'PSH_SOP_SERVE_PORT'
+DEFAULT_SERVE_PORT = 8787
+# the endpoint is only ever meant for whatever runs next to us
+SERVE_HOST = '127.0.0.1'
+# a branch runs once no new trigger for it has arrived for this many seconds...
+ENVVAR_SERVE_DEBOUNCE = 'PSH_SOP_SERVE_DEBOUNCE'
+DEFAULT_SERVE_DEBOUNCE = 30
+# ...or once its oldest trigger has waited this many times the debounce, so a steady trickle can't hold it back forever
+MAX_DEBOUNCE_FACTOR = 10
+# how many of the most recent runs the status endpoint lists
+STATUS_RECENT_RUNS = 20
+# the trigger settings a request may give, and the trigger_autoupdate config key each one maps to
+REQUEST_KEYS = {'branch': 'updateBranch', 'sourceOp': 'sourceOp'}
+# those settings end up in branch names and cli commands, so they're limited to what a branch name can safely hold
+REQUEST_VALUE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._/-]*$')
+
+
+class TriggerQueue(object):
+    """
+    Collects trigger requests and runs the trigger once per update branch for every burst of them. Runs happen one at
+    a time, so a branch asked for while it's running gets a follow-up run afterwards
+    """
+    def __init__(self, runTrigger, debounce):
+        self.runTrigger = runTrigger
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        # update branch ('' for the default) => {config, first, last, requests}
+        self.pending = {}
+        self.running = None
+        self.recentRuns = deque(maxlen=STATUS_RECENT_RUNS)
+        self.completed = 0
+        self.stopping = False
+        self.started = time.time()
+
+    def request(self, config):
+        """
+        Queues a trigger run, merging it with whatever is already queued for the same update branch
+        :param dict config: trigger_autoupdate config
+        :return: dict: what is now queued for that branch
+        """
+        key = config.get('updateBranch') or ''
+        now = time.time()
+        with self.condition:
+            entry = self.pending.setdefault(key, {'config': {}, 'first': now, 'requests': 0})
+            entry['config'].update({setting: value for setting, value in config.items() if 'force' != setting})
+            # one forced request is enough to force the whole burst
+            entry['config']['force'] = entry['config'].get('force', False) or config.get('force', False)
+            entry['last'] = now
+            entry['requests'] += 1
+            self.condition.notify()
+            return {'branch': key, 'requests': entry['requests'], 'queued': len(self.pending)}
+
+    def takeReady(self):
+        """
+        Waits until a queued branch is due to run
+        :return: tuple|None: (branch, entry), or None once we're stopping
+        """
+        with self.condition:
+            while not self.stopping:
+                now = time.time()
+                wait = None
+                for key, entry in sorted(self.pending.items(), key=lambda item: item[1]['first']):
+                    due = min(entry['last'] + self.debounce, entry['first'] + self.debounce * MAX_DEBOUNCE_FACTOR)
+                    if due <= now:
+                        del self.pending[key]
+                        self.running = {'branch': key, 'started': now, 'requests': entry['requests']}
+                        return key, entry
+                    wait = due - now if wait is None else min(wait, due - now)
+                self.condition.wait(wait)
+        return None
+
+    def work(self):
+        """
+        Runs the queued triggers until we're stopped
+        :return: void
+        """
+        while True:
+            ready = self.takeReady()
+            if ready is None:
+                return
+            key, entry = ready
+            started = time.time()
+            logging.info("Running the trigger for {} ({} request(s), waited {:.1f}s)".format(
+                key or 'the default update branch', entry['requests'], started - entry['first']))
+            try:
+                result = self.runTrigger(entry['config'])
+            except Exception as e:
+                # one broken run must not take the worker down with it
+                logging.exception("The trigger for {} failed: {}".format(key or 'the default update branch', e))
+                result = False
+            finished = time.time()
+            with self.condition:
+                self.running = None
+                self.completed += 1
+                self.recentRuns.append({'branch': key, 'result': result is not False, 'requests': entry['requests'],
+                                        'requested': entry['first'], 'started': started, 'finished': finished,
+                                        'latency': round(started - entry['first'], 3),
+                                        'duration': round(finished - started, 3)})
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def status(self):
+        """
+        :return: dict: queue depth, what's waiting and running, and how the recent runs went
+        """
+        now = time.time()
+        with self.condition:
+            latencies = [run['latency'] for run in self.recentRuns]
+            return {
+                'uptime': round(now - self.started, 3),
+                'debounce': self.debounce,
+                'queueDepth': len(self.pending),
+                'pending': [{'branch': key, 'requests': entry['requests'], 'waiting': round(now - entry['first'], 3)}
+                            for key, entry in sorted(self.pending.items())],
+                'running': dict(self.running, elapsed=round(now - self.running['started'], 3))
+                if self.running else None,
+                'completed': self.completed,
+                'latency': {'median': statistics.median(latencies), 'max': max(latencies)} if latencies else None,
+                'recentRuns': list(self.recentRuns),
+            }
+
+
+class TriggerRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /trigger queues a run, optionally with a json body (or query string) giving the update `branch`, `sourceOp`
+    and `force`. GET /status reports on the queue
+    """
+    def sendJson(self, status, data):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if '/status' == path:
+            return self.sendJson(200, self.server.triggerQueue.status())
+        if '/health' == path:
+            return self.sendJson(200, {'ok': True})
+        self.sendJson(404, {'error': 'Unknown endpoint {}'.format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if '/trigger' != url.path:
+            return self.sendJson(404, {'error': 'Unknown endpoint {}'.format(url.path)})
+
+        settings = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return self.sendJson(400, {'error': 'The Content-Length header is not a number'})
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self.sendJson(400, {'error': 'The request body is not valid json'})
+            if not isinstance(body, dict):
+                return self.sendJson(400, {'error': 'The request body must be a json object'})
+            settings.update(body)
+
+        config = {REQUEST_KEYS[key]: str(value) for key, value in settings.items() if key in REQUEST_KEYS and value}
+        for key, configKey in REQUEST_KEYS.items():
+            if configKey in config and not REQUEST_VALUE.match(config[configKey]):
+                return self.sendJson(400, {'error': "The {} may only contain letters, digits, '.', '_', '/' and '-', "
+                                                    "and must start with a letter or digit".format(key)})
+        config['force'] = settings.get('force') in (True, 1, '1', 'true')
+        self.sendJson(202, self.server.triggerQueue.request(config))
+
+    def log_message(self, format, *args):
+        logging.debug("serve: {}".format(format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def runTriggerOnce(config):
+    """
+    Runs the trigger the way `sourceOp trigger-sopupdate` would, recording it in the history and reporting its timing
+    :param dict config: trigger_autoupdate config
+    :return: bool
+    """
+    from cron_trigger_autoupdate import trigger_autoupdate
+    started = time.time()
+    psh_trace.reset()
+    result = trigger_autoupdate(config)
+    recordRun('trigger-sopupdate', result, started)
+    psh_trace.report('trigger-sopupdate')
+    # the spans of a run are only needed for its own report
+    psh_trace.reset()
+    return result
+
+
+def keepWarm(triggerQueue, stopped):
+    """
+    Re-verifies the API token before its cached validity expires, while nothing is running, so a trigger never waits
+    on it. With the native API client this also keeps its access token and connections fresh
+    :param TriggerQueue triggerQueue: the queue, to stay out of the way of running triggers
+    :param threading.Event stopped: set when we're stopping
+    :return: void
+    """
+    projectID = psh_api.getProjectID()
+    ttl = getEnvNumber(psh_metadata.ENVVAR_METADATA_TTL, psh_metadata.DEFAULT_METADATA_TTL, float)
+    interval = max(60, ttl / 2) if 0 < ttl else 0
+    while interval and not stopped.wait(interval):
+        if triggerQueue.running:
+            continue
+        key = psh_metadata.getTokenKey('tokenValidity')
+        psh_metadata.invalidateMetadata(projectID, key)
+        if not psh_metadata.getCachedMetadata(projectID, key, psh_utility.verifyPshCliTokenValidity):
+            logging.warning("The API token is no longer valid, triggers will fail until it is replaced.")
+
+
+def serve():
+    """
+    Runs as a long-lived worker: accepts trigger requests over a local HTTP endpoint (on PSH_SOP_SERVE_PORT, or the
+    unix socket in PSH_SOP_SERVE_SOCKET) and runs the trigger once per update branch for every burst of requests
+    :return: bool
+    """
+    debounce = max(0, getEnvNumber(ENVVAR_SERVE_DEBOUNCE, DEFAULT_SERVE_DEBOUNCE, float))
+    triggerQueue = TriggerQueue(runTriggerOnce, debounce)
+    socketPath = os.getenv(ENVVAR_SERVE_SOCKET)
+    try:
+        if socketPath:
+            if os.path.exists(socketPath):
+                os.remove(socketPath)
+            server = UnixHTTPServer(socketPath, TriggerRequestHandler)
+            address = socketPath
+        else:
+            server = ThreadingHTTPServer((SERVE_HOST, getEnvNumber(ENVVAR_SERVE_PORT, DEFAULT_SERVE_PORT)),
+                                         TriggerRequestHandler)
+            address = 'http://{}:{}'.format(*server.server_address[:2])
+    except OSError as e:
+        return outputError('Starting the trigger server', str(e))
+    server.triggerQueue = triggerQueue
+
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        logging.info("Stopping once the current run, if any, finishes...")
+        stopped.set()
+        triggerQueue.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=keepWarm, args=(triggerQueue, stopped), daemon=True).start()
+    logging.info("Listening for triggers on {} (debouncing bursts for {:g}s)".format(address, debounce))
+    worker = threading.Thread(target=triggerQueue.work)
+    worker.start()
+    # the main thread stays free to handle signals
+    while worker.is_alive():
+        worker.join(1)
+
+    server.shutdown()
+    server.server_close()
+    if socketPath and os.path.exists(socketPath):
+        os.remove(socketPath)
+    return True
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import fnmatch
+import logging
+import os
+import re
+
+from psh_logging import outputError
+
+# shards and the apps each one covers, ie `api=services/api,services/auth;web=frontend/*;js=npm,yarn`. A pattern is
+# either an ecosystem from the updaters table or matched against the app's path relative to the project root. An app
+# belongs to the first shard with a pattern that matches it
+ENVVAR_SHARDS = 'PSH_SOP_SHARDS'
+# the shard a sop-autoupdate run is limited to. Set by the trigger on the source operation it runs for that shard
+ENVVAR_SHARD = 'PSH_SOP_SHARD'
+# shard names end up in branch names
+SHARD_NAME = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+
+def getShardSpec(config=None):
+    """
+    :param dict config: trigger_autoupdate config. Its `shards`, when set at all (even empty), is used instead of
+        PSH_SOP_SHARDS
+    :return: string: the shard spec, empty if we're not sharded
+    """
+    config = config or {}
+    return (config['shards'] if 'shards' in config else os.getenv(ENVVAR_SHARDS, '')).strip()
+
+
+def parseShards(spec):
+    """
+    :param string spec: shards separated by `;`, each a name, `=` and comma separated patterns
+    :return: list|bool: (name, patterns) in the order given, or False if the spec is unusable
+    """
+    event = "Reading the shards in {}".format(ENVVAR_SHARDS)
+    shards = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(';'))):
+        name, _, patterns = entry.partition('=')
+        name = name.strip()
+        patterns = [pattern.strip().strip('/') or '.' for pattern in patterns.split(',') if pattern.strip()]
+        if not SHARD_NAME.match(name):
+            return outputError(event, "Shard names may only contain lower case letters, digits and dashes: {}".format(
+                entry))
+        if not patterns:
+            return outputError(event, "Shard {} doesn't list any apps or ecosystems".format(name))
+        if name in [shard[0] for shard in shards]:
+            return outputError(event, "Shard {} is listed more than once".format(name))
+        shards.append((name, patterns))
+
+    return shards or outputError(event, "No shards given")
+
+
+def getShardOf(path, ecosystem, shards):
+    """
+    :param string path: directory of the update, relative to the project root ('' for the root itself)
+    :param string ecosystem: ecosystem of its updater
+    :param list shards: from parseShards
+    :return: string|None: the shard it belongs to, None if it doesn't match any
+    """
+    for name, patterns in shards:
+        if any(ecosystem == pattern or fnmatch.fnmatchcase(path or '.', pattern) for pattern in patterns):
+            return name
+    return None
+
+
+def selectShard(waves, updaters, shardName, spec):
+    """
+    Limits the planned updates to the ones in our shard
+    :param list waves: from planUpdates
+    :param dict updaters: the updaters table
+    :param string shardName: the shard we're updating
+    :param string spec: the shard spec
+    :return: list|bool: the waves with only our shard's updates (and without waves left empty), False if the spec is
+        unusable or doesn't have our shard
+    """
+    shards = parseShards(spec)
+    if not shards:
+        return False
+    if shardName not in [name for name, _ in shards]:
+        return outputError("Limiting the update to shard {}".format(shardName),
+                           "There is no shard {} in {}".format(shardName, ENVVAR_SHARDS))
+
+    selected = []
+    unassigned = []
+    for wave in waves:
+        shardWave = []
+        for invocation in wave:
+            shard = getShardOf(invocation['path'], updaters[invocation['updater']]['ecosystem'], shards)
+            if shardName == shard:
+                shardWave.append(invocation)
+            elif shard is None:
+                unassigned.append(invocation['file'])
+        if shardWave:
+            selected.append(shardWave)
+
+    count = sum(len(wave) for wave in selected)
+    logging.info("Shard {} covers {} of the {} planned update(s).".format(
+        shardName, count, sum(len(wave) for wave in waves)))
+    if unassigned:
+        logging.warning("{} update(s) don't belong to any shard, so no shard updates them: {}".format(
+            len(unassigned), ', '.join(unassigned)))
+    return selected
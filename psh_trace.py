@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from psh_logging import logPhase
+
+ENVVAR_TRACE_FILE = 'PSH_SOP_TRACE_FILE'
+# how many of the slowest commands we list in the summary
+SUMMARY_COMMANDS = 10
+
+traceLock = threading.Lock()
+finishedSpans = []
+
+
+@contextmanager
+def span(name, category='phase', **args):
+    """
+    Times a block of work. Anything added to the yielded dict's 'args' ends up in the trace (ie an exit code)
+    :param string name: what we're timing
+    :param string category: phase, updater, command or request
+    :param args: extra details to record with the span
+    :return: dict: the span record
+    """
+    record = {'name': name, 'cat': category, 'args': args, 'tid': threading.get_ident()}
+    # whatever is logged inside a phase or an updater is tagged with it
+    phaseToken = logPhase.set(name) if category in ('phase', 'updater') else None
+    record['start'] = time.time()
+    startCounter = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['duration'] = time.perf_counter() - startCounter
+        with traceLock:
+            finishedSpans.append(record)
+        logging.debug("{} took {:.2f}s".format((name.splitlines() or [''])[0], record['duration']),
+                      extra={'duration': round(record['duration'], 6),
+                             'command': args.get('command') if 'command' == category else None})
+        if phaseToken:
+            logPhase.reset(phaseToken)
+
+
+def recordSpan(name, start, duration, category='phase', **args):
+    """
+    Records a span that was timed some other way (ie before we were imported)
+    :param string name: what was timed
+    :param float start: time.time() when it started
+    :param float duration: seconds it took
+    :param string category: phase, updater, command or request
+    :param args: extra details to record with the span
+    :return: void
+    """
+    record = {'name': name, 'cat': category, 'args': args, 'tid': threading.get_ident(), 'start': start,
+              'duration': duration}
+    with traceLock:
+        finishedSpans.append(record)
+
+
+def traced(name, category='phase'):
+    """
+    Decorator version of span()
+    :param string name: what we're timing
+    :param string category: phase, updater, command or request
+    :return: function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def getSpans(category=None):
+    """
+    Gets the spans finished so far, oldest first
+    :param string category: only return spans of this category
+    :return: list
+    """
+    with traceLock:
+        spans = sorted(finishedSpans, key=lambda record: record['start'])
+    return [record for record in spans if category is None or record['cat'] == category]
+
+
+def reset():
+    """
+    Forgets every span recorded so far, for processes that run more than once
+    :return: void
+    """
+    with traceLock:
+        del finishedSpans[:]
+
+
+def writeChromeTrace(path):
+    """
+    Writes the spans in the Chrome trace event format, which can be loaded in chrome://tracing or ui.perfetto.dev
+    :param string path: where to write the trace
+    :return: bool
+    """
+    # psh_utility times its commands with us, so it can only be imported once we're in use
+    from psh_utility import writeJsonFile
+    pid = os.getpid()
+    events = []
+    for record in getSpans():
+        events.append({'name': record['name'], 'cat': record['cat'], 'ph': 'X', 'pid': pid, 'tid': record['tid'],
+                       'ts': int(record['start'] * 1000000), 'dur': int(record['duration'] * 1000000),
+                       'args': record['args']})
+
+    return writeJsonFile(path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+def report(runName):
+    """
+    Logs a summary table of the phases and the slowest commands, then writes the trace file to PSH_SOP_TRACE_FILE
+    (defaults to trace-<runName>.json in our cache location)
+    :param string runName: name of what just ran (ie sop-autoupdate)
+    :return: void
+    """
+    spans = getSpans()
+    if not spans:
+        return
+
+    def rowName(record):
+        # commands can span several lines (ie a commit message), only their first line fits in the table
+        return (record['name'].splitlines() or [''])[0][:60]
+
+    rowFormat = "{:<60} {:>10} {:>6}"
+    rows = [rowFormat.format('Phase', 'Seconds', 'Exit')]
+    for record in spans:
+        if record['cat'] not in ('command', 'request'):
+            rows.append(rowFormat.format(rowName(record), '{:.2f}'.format(record['duration']), ''))
+
+    commands = sorted(getSpans('command') + getSpans('request'), key=lambda record: record['duration'], reverse=True)
+    if commands:
+        rows.append(rowFormat.format('Slowest commands and requests', '', ''))
+        for record in commands[:SUMMARY_COMMANDS]:
+            rows.append(rowFormat.format(rowName(record), '{:.2f}'.format(record['duration']),
+                                         str(record['args'].get('exitCode', record['args'].get('status', '')))))
+
+    logging.info("Timing summary for {}:\n{}".format(runName, '\n'.join(rows)))
+
+    from psh_utility import getCacheDir
+    tracePath = os.getenv(ENVVAR_TRACE_FILE) or os.path.join(getCacheDir(), 'trace-{}.json'.format(runName))
+    if writeChromeTrace(tracePath):
+        logging.info("Trace written to {}".format(tracePath))
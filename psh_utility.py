@@ -1,10 +1,23 @@
 #!/usr/bin/env python
+import contextvars
+import json
 import logging
 import os
+import signal
 import subprocess
+import threading
+import time
+from collections import deque
+import psh_trace
 from psh_logging import outputError
 
 SOURCE_OP_TOOLS_VERSION = '0.3.2'
+# name of the directory inside our writable location where we persist indexes, caches and state between runs
+SOURCE_OP_CACHE_DIRNAME = 'source-operations-data'
+# how many of the most recent output lines a streamed command keeps for error reporting
+DEFAULT_TAIL_LINES = 200
+# how long a timed out process group gets to exit after SIGTERM before we SIGKILL it
+KILL_GRACE_PERIOD = 5
 PSH_COMMON_MESSAGES = {
     'psh_cli': {
         'event': 'Checking for the Platform.sh CLI tool',
@@ -33,17 +46,64 @@ PSH_COMMON_MESSAGES = {
 }
 
 
-def runCommand(command, rcwd=None):
+def runCommand(command, rcwd=None, env=None, stream=False, timeout=None, tailLines=DEFAULT_TAIL_LINES, label=None):
     """
     Runs a subprocess on the system. Mostly used to interact with psh cli and git
     :param string|list command: Command to be run as a string or as a list
     :param string rcwd: path to where we need the process to be run
-    :return: dict {result: boolean, message: strdout|stderr }
+    :param dict env: additional environmental variables to set for the process
+    :param bool stream: log output lines as they arrive instead of buffering them. Only the last tailLines lines are
+        kept, so in this mode message holds the tail of the output instead of all of it
+    :param int|float timeout: seconds after which the process, and everything it started, is killed
+    :param int tailLines: how many lines of output to keep when streaming
+    :param string label: prefix for streamed output lines. Defaults to the command
+    :return: dict {result: boolean, message: strdout|stderr, output: stdout (whatever the outcome), exitCode: int,
+        timedOut: boolean, usage: {cpuUser, cpuSystem, maxRssMb} (only when streaming)}
     """
-    procUpdate = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=rcwd)
-    output, procerror = procUpdate.communicate()
+    procEnv = None
+    rusage = None
+    if env:
+        procEnv = os.environ.copy()
+        procEnv.update(env)
+    with psh_trace.span(label or command, 'command', command=command, cwd=rcwd or os.getcwd()) as commandSpan:
+        # with a timeout, the command gets its own process group so we can kill whatever it has started along with it
+        procUpdate = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      universal_newlines=True, cwd=rcwd, env=procEnv, start_new_session=bool(timeout))
+        timedOut = False
+        if stream:
+            label = label or command
+            outputTail = deque(maxlen=tailLines)
+            errorTail = deque(maxlen=tailLines)
+            # the readers log on our behalf, so they get a copy of our context (ie the log prefix)
+            readers = [threading.Thread(target=contextvars.copy_context().run, daemon=True,
+                                        args=(streamOutput, procUpdate.stdout, outputTail, label)),
+                       threading.Thread(target=contextvars.copy_context().run, daemon=True,
+                                        args=(streamOutput, procUpdate.stderr, errorTail, label))]
+            for reader in readers:
+                reader.start()
+            try:
+                rusage = waitForExit(procUpdate, timeout)
+            except subprocess.TimeoutExpired:
+                timedOut = True
+                killProcessGroup(procUpdate)
+            for reader in readers:
+                reader.join(KILL_GRACE_PERIOD)
+            output = ''.join(outputTail)
+            # plenty of tools report their errors on stdout, and we've already shown everything in the log
+            procerror = ''.join(errorTail) or output
+        else:
+            try:
+                output, procerror = procUpdate.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timedOut = True
+                killProcessGroup(procUpdate)
+                output, procerror = procUpdate.communicate()
+        commandSpan['args']['exitCode'] = procUpdate.returncode
+        if rusage is not None:
+            from psh_resources import getUsage
+            commandSpan['args'].update(getUsage(rusage))
 
-    if 0 == procUpdate.returncode:
+    if 0 == procUpdate.returncode and not timedOut:
         returnStatement = True
         # @todo Should we add a .strip() before we return the message?
         #  there are numerous situations where the message contains trailing \n that cause issues later when attempting
@@ -52,8 +112,89 @@ def runCommand(command, rcwd=None):
     else:
         returnStatement = False
         message = procerror
+        if timedOut:
+            message = "Command timed out after {} seconds and was stopped.\n{}".format(timeout, message)
 
-    return {"result": returnStatement, "message": message}
+    commandResult = {"result": returnStatement, "message": message, "output": output,
+                     "exitCode": procUpdate.returncode, "timedOut": timedOut}
+    if rusage is not None:
+        commandResult['usage'] = {key: commandSpan['args'][key] for key in ('cpuUser', 'cpuSystem', 'maxRssMb')}
+    return commandResult
+
+
+def waitForExit(process, timeout=None):
+    """
+    Waits for a process the way Popen.wait() does, but reaps it with wait4 so we also learn what it, and everything it
+    waited for, used
+    :param subprocess.Popen process: the process
+    :param int|float timeout: seconds to wait before raising subprocess.TimeoutExpired
+    :return: resource.struct_rusage|None: its resource usage, None if it had already been reaped
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    delay = 0.001
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG if deadline else 0)
+        except ChildProcessError:
+            process.wait()
+            return None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return rusage
+        remaining = deadline - time.monotonic()
+        if 0 >= remaining:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+
+
+def streamOutput(pipe, tail, label):
+    """
+    Forwards each line from a process pipe to the log as it arrives, keeping only the most recent lines
+    :param pipe: stdout or stderr of the process
+    :param deque tail: bounded buffer that receives the lines
+    :param string label: prefix for the logged lines
+    :return: void
+    """
+    with pipe:
+        for line in pipe:
+            tail.append(line)
+            logging.info("[{}] {}".format(label, line.rstrip('\n')), extra={'command': label})
+
+
+def killProcessGroup(process):
+    """
+    Stops a process started in its own session and every process it started: SIGTERM first, then SIGKILL if they
+    haven't exited after a grace period
+    :param subprocess.Popen process: the process to stop
+    :return: void
+    """
+    for killSignal in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, killSignal)
+        except OSError:
+            # already gone
+            pass
+        try:
+            process.wait(timeout=KILL_GRACE_PERIOD)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def getEnvNumber(envVar, default, cast=int):
+    """
+    Reads a numeric setting from an environmental variable, falling back to the default if it's missing or invalid
+    :param string envVar: name of the environmental variable
+    :param int|float default: default value
+    :param type cast: int or float
+    :return: int|float
+    """
+    try:
+        return cast(os.getenv(envVar, default))
+    except (TypeError, ValueError):
+        logging.warning("Ignoring invalid value for {}, using {}".format(envVar, default))
+        return default
 
 
 def verifyPshCliInstalled():
@@ -62,6 +203,10 @@ def verifyPshCliInstalled():
     :return: bool
     @todo since we've moved the messaging, is this one needed anymore?
     """
+    import psh_api
+    if psh_api.nativeClientEnabled():
+        # we talk to the API directly, so we dont need the cli
+        return True
     procResult = runCommand("which platform")
     return procResult['result']
 
@@ -75,6 +220,61 @@ def verifyPshCliToken():
 
 
 def verifyPshCliTokenValidity():
+    import psh_api
+    apiClient = psh_api.getClient()
+    if apiClient:
+        return apiClient.verifyToken()
     command = "platform auth:info > /dev/null 2>&1"
     validityResult = runCommand(command)
     return validityResult['result']
+
+
+def getCacheDir(*subdirs):
+    """
+    Gets (and creates if needed) the writable location where we persist data between runs: the cache directory on a
+    psh environment, TMPDIR in most systems, or /tmp as a fallback. Mirrors the logic used in setup.sh
+    :param string subdirs: optional subdirectory path parts inside our cache location
+    :return: string: full path to the directory
+    """
+    tmpDir = os.getenv('PLATFORM_CACHE_DIR') or os.getenv('TMPDIR') or '/tmp'
+    cacheDir = os.path.join(tmpDir, SOURCE_OP_CACHE_DIRNAME, *subdirs)
+    os.makedirs(cacheDir, exist_ok=True)
+    return cacheDir
+
+
+def readJsonFile(path, default=None):
+    """
+    Reads a json file we previously stored. A missing or corrupt file is not an error, we just return the default
+    :param string path: full path to the json file
+    :param default: value to return if the file can't be read
+    :return: the decoded contents or the default
+    """
+    try:
+        with open(path, 'r') as jsonFile:
+            return json.load(jsonFile)
+    except (OSError, ValueError):
+        return default
+
+
+def writeJsonFile(path, data):
+    """
+    Atomically writes data as json so a concurrent reader, or a run that is killed mid-write, never sees a partial file
+    :param string path: full path to the json file
+    :param data: json serializable data
+    :return: bool
+    """
+    # threads of the same process write the same files too (ie the metadata cache), so each gets its own temp file
+    tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpPath, 'w') as jsonFile:
+            json.dump(data, jsonFile)
+        os.replace(tmpPath, path)
+    except OSError as e:
+        logging.debug("Unable to write {}: {}".format(path, e))
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        return False
+
+    return True
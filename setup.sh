@@ -13,11 +13,34 @@
 
 # https://github.com/platformsh/source-operations.git
 
+# lets sourceOp include our own time in the startup time it reports
+export PSH_SOP_LAUNCHED="$(date +%s.%N)"
+
 # Repo for our source ops support scripts
 gitSourceOps="https://github.com/platformsh/source-operations.git"
 # A writable location where we can store things: cache directory on a psh environment, TMPDIR in most systems, or fallback
 tmpDir=${PLATFORM_CACHE_DIR:-${TMPDIR:-/tmp}}
 dirSourceOps="${tmpDir}/source-operations"
+# where sourceOp stores the single file bundle of the toolkit. See psh_bundle.py
+dirBundle="${tmpDir}/source-operations-data/bundle"
+# seconds between checks for a new version of the toolkit. Until then we run the bundle we already have
+updateInterval=${PSH_SOP_UPDATE_INTERVAL:-3600}
+
+# Runs the current bundle if it exists, is intact and was checked for updates recently enough
+runBundle() {
+  local bundleName bundleChecksum lastCheck
+  [[ -f "${dirBundle}/current" ]] && [[ -f "${dirBundle}/last-check" ]] || return 1
+  read -r bundleName bundleChecksum < "${dirBundle}/current" || return 1
+  lastCheck=$(stat -c %Y "${dirBundle}/last-check" 2>/dev/null) || return 1
+  (( $(date +%s) - lastCheck < updateInterval )) || return 1
+  printf "%s  %s\n" "${bundleChecksum}" "${dirBundle}/${bundleName}" | sha256sum -c --status - 2>/dev/null || return 1
+  python3 "${dirBundle}/${bundleName}" "$@"
+  exit $?
+}
+
+if (( 0 < updateInterval )); then
+  runBundle "${1:-'nothing'}" "${@:2}"
+fi
 
 #Does the temp directory exist and more importantly, can we write to it?
 if [ ! -d "${tmpDir}" ] || [ ! -w "${tmpDir}" ]; then
@@ -47,6 +70,11 @@ fi
 # Add our directory to PATH so we can call it
 export PATH="${dirSourceOps}:${PATH}"
 
-sourceOp "${1:-'nothing'}"
+# rebuild the bundle so the next runs can skip all of the above
+if (( 0 < updateInterval )) && sourceOp bundle >/dev/null 2>&1; then
+  touch "${dirBundle}/last-check"
+fi
+
+sourceOp "${1:-'nothing'}" "${@:2}"
 #return the exit code from sourceOp
 exit $?
\ No newline at end of file
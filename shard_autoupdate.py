@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psh_api
+from cron_trigger_autoupdate import DEFAULT_UPDATE_BRANCH, ENVVAR_UPDATE_BRANCH, trigger_autoupdate
+from psh_checkpoint import TriggerCheckpoint
+from psh_logging import logPrefix, outputError, CBOLD, CRESET, CWARN
+from psh_shard import getShardSpec, parseShards
+from psh_trace import span
+from psh_utility import getEnvNumber
+
+ENVVAR_SHARD_CONCURRENCY = 'PSH_SOP_SHARD_CONCURRENCY'
+DEFAULT_SHARD_CONCURRENCY = 4
+
+
+class PruneBranchesGuard(object):
+    """
+    prune_branches is a setting of the project's git integration, shared by every shard. Whichever shard first needs
+    it disabled disables it, and it's only re-enabled once every shard is done, so one shard finishing can't get
+    another shard's new branch deleted. Whether it's disabled is kept in a checkpoint of its own, so an interrupted
+    run still gets it re-enabled
+    """
+    def __init__(self, projectID, updateBranchName):
+        self.lock = threading.Lock()
+        # a colon can't be part of a branch name, so this never collides with an update branch's checkpoint
+        self.checkpoint = TriggerCheckpoint(projectID, '{}:shards'.format(updateBranchName))
+        self.integrationID = self.checkpoint.get('pruneBranchesIntegration')
+        self.enable = None
+        # the shards whose runs happened here rather than being handed over to a run already in progress
+        self.ranShards = set()
+
+    def offer(self, shardName, enable):
+        """
+        Every shard's run offers a way to re-enable prune_branches, since any of them might be the one to disable it
+        :param string shardName: the shard whose run this is
+        :param function enable: takes the integration ID, returns bool
+        :return: void
+        """
+        with self.lock:
+            self.enable = self.enable or enable
+            self.ranShards.add(shardName)
+
+    def disable(self, integrationID, disable):
+        """
+        Disables prune_branches, unless another shard already did
+        :param string integrationID: the git integration
+        :param function disable: takes the integration ID, returns bool
+        :return: bool
+        """
+        with self.lock:
+            if integrationID == self.integrationID:
+                return True
+            if not disable(integrationID):
+                return False
+            self.integrationID = integrationID
+            self.checkpoint.update(pruneBranchesIntegration=integrationID)
+            return True
+
+    def adopt(self, integrationID):
+        """
+        Takes over re-enabling prune_branches for the integration (ie from a shard whose earlier run disabled it)
+        :param string integrationID: the git integration
+        :return: void
+        """
+        with self.lock:
+            self.integrationID = integrationID
+            self.checkpoint.update(pruneBranchesIntegration=integrationID)
+
+    def restore(self, shardNames):
+        """
+        Re-enables prune_branches if a shard disabled it, as long as every shard ran here. A shard that was handed over
+        to a run already in progress may still need it disabled, and that run re-enables it once it's done
+        :param list shardNames: every shard
+        :return: bool
+        """
+        if not self.integrationID:
+            return True
+        handedOver = [name for name in shardNames if name not in self.ranShards]
+        if handedOver:
+            logging.info("Shard(s) {} were handed over to a run already in progress, which re-enables 'prune_branches' "
+                         "on integration {} once it's done.".format(', '.join(handedOver), self.integrationID))
+            return True
+        logging.info("Every shard is done, re-enabling 'prune_branches' on integration {}...".format(
+            self.integrationID))
+        if self.enable and self.enable(self.integrationID):
+            logging.info("'prune_branches' for integration {} was successfully re-enabled.".format(self.integrationID))
+            self.checkpoint.clear()
+            return True
+
+        message = "I was unable to re-enable the 'prune_branches' setting for git integration {}.".format(
+            self.integrationID)
+        message += " You will need to manually update the integration and re-enable this setting, or I will try again "
+        message += "on the next run."
+        return outputError("Trying to update 'prune_branches' to true on git integration {}".format(
+            self.integrationID), message)
+
+
+def runShard(config):
+    """
+    Runs the auto-update trigger for one shard, on its own update branch
+    :param dict config: trigger_autoupdate config
+    :return: dict {shard: string, branch: string, result: bool, duration: float}
+    """
+    # every shard runs in its own copy of the context, so this only prefixes what this shard logs
+    logPrefix.set('[{}] '.format(config['updateBranch']))
+    start = time.perf_counter()
+    try:
+        with span(config['updateBranch'], 'shard'):
+            result = trigger_autoupdate(config)
+    except Exception as e:
+        # one broken shard shouldn't hold up the others
+        outputError("Auto update of shard {}".format(config['shard']), repr(e))
+        result = False
+
+    return {'shard': config['shard'], 'branch': config['updateBranch'], 'result': result is not False,
+            'duration': time.perf_counter() - start}
+
+
+def reportShards(outcomes, duration):
+    """
+    Logs one table with the outcome of every shard
+    :param list outcomes: what runShard returned for each shard
+    :param float duration: seconds all of them took
+    :return: void
+    """
+    rowFormat = "{:<20} {:<30} {:>8} {:>10}"
+    rows = [rowFormat.format('Shard', 'Branch', 'Result', 'Seconds')]
+    for outcome in outcomes:
+        rows.append(rowFormat.format(outcome['shard'], outcome['branch'], 'success' if outcome['result'] else 'FAILED',
+                                     '{:.2f}'.format(outcome['duration'])))
+    failed = [outcome['shard'] for outcome in outcomes if not outcome['result']]
+    logging.info("Sharded auto update results:\n{}".format('\n'.join(rows)))
+    summary = "{} of {} shards updated successfully in {:.2f} seconds.".format(len(outcomes) - len(failed),
+                                                                                len(outcomes), duration)
+    if failed:
+        logging.warning("{}{} Failed: {}{}".format(CWARN, summary, ', '.join(failed), CRESET))
+    else:
+        logging.info("{}{}{}".format(CBOLD, summary, CRESET))
+
+
+def shard_autoupdate(config=None):
+    """
+    Runs the auto-update source operation once per shard in PSH_SOP_SHARDS, each on its own update branch (the update
+    branch name followed by the shard name, ie update-api), at most PSH_SOP_SHARD_CONCURRENCY at a time. Each shard's
+    source operation is told its shard, and each branch is created, synced and restored to its previous state on its
+    own, so one broken shard doesn't hold up the others
+    :param dict config: trigger_autoupdate config, applied to every shard
+    :return: bool: whether every shard was updated successfully
+    """
+    config = dict(config or {})
+    spec = getShardSpec(config)
+    shards = parseShards(spec)
+    if not shards:
+        return False
+
+    projectID = config.get('project') or psh_api.getProjectID()
+    updateBranchName = config.get('updateBranch') or os.getenv(ENVVAR_UPDATE_BRANCH, DEFAULT_UPDATE_BRANCH)
+    pruneGuard = PruneBranchesGuard(projectID, updateBranchName)
+    configs = [dict(config, updateBranch='{}-{}'.format(updateBranchName, name), shard=name, shards=spec,
+                    pruneGuard=pruneGuard) for name, _ in shards]
+
+    concurrency = max(1, getEnvNumber(ENVVAR_SHARD_CONCURRENCY, DEFAULT_SHARD_CONCURRENCY))
+    logging.info("Triggering auto updates for {} shards ({}), {} at a time...".format(
+        len(configs), ', '.join(shardConfig['updateBranch'] for shardConfig in configs), concurrency))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(configs))) as pool:
+        # copy the context so any context variables the caller has set carry over to the worker threads
+        futures = [pool.submit(contextvars.copy_context().run, runShard, shardConfig) for shardConfig in configs]
+        outcomes = [future.result() for future in futures]
+    reportShards(outcomes, time.perf_counter() - start)
+
+    succeeded = all(outcome['result'] for outcome in outcomes)
+    if not succeeded:
+        # a shard that failed part way may still need its new branch, and its next run picks up from there
+        if pruneGuard.integrationID:
+            logging.info("'prune_branches' stays disabled until every shard has completed a run.")
+        return False
+
+    return pruneGuard.restore([name for name, _ in shards])